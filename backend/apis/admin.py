@@ -1,16 +1,36 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
-from .models import TestModel, CustomUser, Card, TradeOffer
+from .models import TestModel, CustomUser, Card, TradeOffer, LedgerEntry
+
+
+class CustomUserAdmin(UserAdmin):
+    # Balances only move through the ledger (see apis/ledger.py), so they are
+    # shown but can't be edited here
+    fieldsets = UserAdmin.fieldsets + (
+        ('PokéTrade Info', {'fields': ('account_balance',)}),
+    )
+    readonly_fields = UserAdmin.readonly_fields + ('account_balance',)
+
+
+class LedgerEntryAdmin(admin.ModelAdmin):
+    """The ledger is append-only, so the admin only shows it"""
+    list_display = ('id', 'user', 'amount', 'kind', 'card', 'created_at')
+    list_filter = ('kind',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 # Register your models here.
 admin.site.register(TestModel)
 admin.site.register(Card)
-admin.site.register(CustomUser, UserAdmin)
+admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(TradeOffer)
-
-# Add account_balance to the fieldsets of UserAdmin
-UserAdmin.fieldsets += (
-    ('PokéTrade Info', {'fields': ('account_balance',)}),
-)
\ No newline at end of file
+admin.site.register(LedgerEntry, LedgerEntryAdmin)
@@ -0,0 +1,150 @@
+"""
+JWT authentication helpers
+
+CachedJWTAuthentication resolves the user behind an access token from a
+short-lived in-process cache instead of loading them on every request.
+Saving or deleting a user drops them from this process's cache; other
+processes notice once the entry times out.
+
+Cached users may be a few seconds stale, so nothing that moves money or
+cards trusts their balance: purchases and trades go through the ledger
+and locked reads by primary key (see apis/ledger.py).
+
+Settings (AUTH_USER_CACHE):
+    TIMEOUT: seconds a user is cached for, default 30; 0 disables the cache
+    MAX_ENTRIES: users kept per process, default 10000
+"""
+import copy
+import threading
+import time
+
+from django.conf import settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+
+class UserCache:
+    """Thread-safe cache of users by primary key, with a time to live"""
+
+    def __init__(self, timeout, max_entries):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        # pk -> (expiry, user), oldest first
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, pk):
+        """
+        Returns:
+            CustomUser: A copy of the cached user, so that one request
+                changing its user can't affect another, or None
+        """
+        with self._lock:
+            entry = self._entries.get(pk)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[pk]
+                return None
+            return copy.copy(entry[1])
+
+    def set(self, user):
+        if self.timeout <= 0:
+            return
+        with self._lock:
+            self._entries.pop(user.pk, None)
+            while self._entries and len(self._entries) >= self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            self._entries[user.pk] = (time.monotonic() + self.timeout, copy.copy(user))
+
+    def forget(self, pk):
+        with self._lock:
+            self._entries.pop(pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_user_cache = None
+_user_cache_lock = threading.Lock()
+
+
+def get_user_cache():
+    global _user_cache
+    if _user_cache is None:
+        with _user_cache_lock:
+            if _user_cache is None:
+                options = getattr(settings, "AUTH_USER_CACHE", {})
+                _user_cache = UserCache(
+                    timeout=options.get("TIMEOUT", 30),
+                    max_entries=options.get("MAX_ENTRIES", 10_000),
+                )
+    return _user_cache
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that loads each user at most once per cache timeout"""
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken("Token contained no recognizable user identification")
+
+        cache = get_user_cache()
+        # Claims are strings or ints depending on how the token was made
+        pk = self.user_model._meta.pk.to_python(user_id)
+        user = cache.get(pk)
+        if user is None:
+            user = super().get_user(validated_token)
+            cache.set(user)
+        return user
+
+
+def raw_token(request):
+    """
+    Get the JWT access token from a plain Django request
+
+    EventSource and similar browser APIs cannot set headers, so the token is
+    also accepted as a ?token= query parameter.
+    """
+    header = request.headers.get("Authorization", "")
+    if header.startswith("Bearer "):
+        return header[len("Bearer "):]
+    return request.GET.get("token")
+
+
+def user_from_token(token):
+    """
+    Resolve the user a raw access token belongs to
+
+    Returns:
+        CustomUser: The user, or None if the token is missing or invalid
+    """
+    if not token:
+        return None
+
+    authentication = CachedJWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+def user_id_from_token(token):
+    """
+    Read the user id out of a raw access token, without loading the user
+
+    Returns:
+        The id, or None if the token is missing or invalid
+    """
+    if not token:
+        return None
+
+    try:
+        validated = JWTAuthentication().get_validated_token(token)
+    except InvalidToken:
+        return None
+    return validated.get(api_settings.USER_ID_CLAIM)
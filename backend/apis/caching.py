@@ -0,0 +1,252 @@
+"""
+Generation-keyed cache of rendered collection payloads
+
+Views look up the Generation counters their payload depends on and fold
+them into the cache key, so a write anywhere in the collection makes the
+old entries unreachable. Nothing is ever invalidated explicitly; stale
+entries age out of the LRU or time out of the shared tier.
+
+The same key doubles as the payload's ETag. A request whose
+If-None-Match still matches gets a 304 without the cache being consulted
+at all, so a client refreshing an unchanged collection costs one
+generation lookup.
+
+Payloads are stored as rendered JSON, so a hit skips both serialization
+and rendering. There are two tiers: a per-process LRU bounded by the
+total size of its entries, then optionally a Django cache shared by all
+workers.
+
+Settings (COLLECTION_CACHE):
+    MAX_BYTES: size of the in-process tier, default 32 MiB; 0 disables it
+    SHARED_ALIAS: a CACHES alias for the shared tier, default None (off)
+    TIMEOUT: how long entries live in the shared tier, default 300 seconds
+"""
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
+
+from .models import Generation
+from .renderers import render_json
+
+
+class LRUCache:
+    """Thread-safe LRU of byte strings, bounded by their total length"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = Counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CollectionCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, shared_alias=None, timeout=300):
+        self.local = LRUCache(max_bytes) if max_bytes else None
+        self.shared = caches[shared_alias] if shared_alias else None
+        self.timeout = timeout
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def get_or_build(self, key, build):
+        """
+        Return the cached payload for `key`, building and storing it on a miss
+
+        Args:
+            key (str): A key from collection_key()
+            build (callable): Returns the data to render; exceptions propagate
+                and nothing is cached
+
+        Returns:
+            tuple: (rendered JSON, "local", "shared" or "miss")
+        """
+        if self.local is not None:
+            content = self.local.get(key)
+            if content is not None:
+                self._count("local_hits")
+                return content, "local"
+
+        if self.shared is not None:
+            content = self.shared.get(key)
+            if content is not None:
+                self._count("shared_hits")
+                if self.local is not None:
+                    self.local.set(key, content)
+                return content, "shared"
+
+        self._count("misses")
+        content = render_json(build())
+        if self.local is not None:
+            self.local.set(key, content)
+        if self.shared is not None:
+            self.shared.set(key, content, self.timeout)
+        return content, "miss"
+
+    async def aget_or_build(self, key, build):
+        """Async version of get_or_build(); `build` is a coroutine function"""
+        if self.local is not None:
+            content = self.local.get(key)
+            if content is not None:
+                self._count("local_hits")
+                return content, "local"
+
+        if self.shared is not None:
+            content = await self.shared.aget(key)
+            if content is not None:
+                self._count("shared_hits")
+                if self.local is not None:
+                    self.local.set(key, content)
+                return content, "shared"
+
+        self._count("misses")
+        content = render_json(await build())
+        if self.local is not None:
+            self.local.set(key, content)
+        if self.shared is not None:
+            await self.shared.aset(key, content, self.timeout)
+        return content, "miss"
+
+    def get_stats(self):
+        stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+        with self._lock:
+            stats.update(self.stats)
+        if self.local is not None:
+            stats["evictions"] = self.local.stats["evictions"]
+            stats["entries"] = len(self.local)
+            stats["bytes"] = self.local.size
+            stats["max_bytes"] = self.local.max_bytes
+        lookups = stats["local_hits"] + stats["shared_hits"] + stats["misses"]
+        stats["hit_rate"] = (lookups - stats["misses"]) / lookups if lookups else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                options = getattr(settings, "COLLECTION_CACHE", {})
+                _cache = CollectionCache(
+                    max_bytes=options.get("MAX_BYTES", 32 * 1024 * 1024),
+                    shared_alias=options.get("SHARED_ALIAS"),
+                    timeout=options.get("TIMEOUT", 300),
+                )
+    return _cache
+
+
+def collection_key(name, generations, **params):
+    """
+    Build the cache key for one view of a collection
+
+    Args:
+        name (str): The collection, e.g. "marketplace"
+        generations (dict): The Generation values the payload depends on
+        **params: Everything else that shapes the payload
+    """
+    parts = sorted(generations.items()) + sorted(
+        (key, str(value)) for key, value in params.items() if value is not None
+    )
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()
+    return f"collection:{name}:{digest}"
+
+
+def etag_for(key):
+    return '"%s"' % key.rsplit(":", 1)[1]
+
+
+def _not_modified(request, etag):
+    """A 304 if the client already holds the payload tagged `etag`, else None"""
+    header = request.headers.get("If-None-Match")
+    if header is None:
+        return None
+    etags = parse_etags(header)
+    # If-None-Match uses weak comparison
+    if "*" in etags or etag in {tag.removeprefix("W/") for tag in etags}:
+        response = HttpResponseNotModified()
+        _set_validators(response, etag)
+        return response
+    return None
+
+
+def _set_validators(response, etag):
+    response["ETag"] = etag
+    # Let clients keep the payload, but make them revalidate every time
+    response["Cache-Control"] = "private, no-cache"
+
+
+def cached_response(request, name, generation_keys, build, **params):
+    """
+    Serve a collection payload from the cache, or a 304
+
+    Costs one query to read the generations on a hit. The X-Cache header
+    says which tier answered.
+    """
+    generations = Generation.current(*generation_keys)
+    key = collection_key(name, generations, **params)
+    not_modified = _not_modified(request, etag_for(key))
+    if not_modified is not None:
+        return not_modified
+
+    content, source = get_cache().get_or_build(key, build)
+    return _response(key, content, source)
+
+
+async def acached_response(request, name, generation_keys, build, **params):
+    """Async version of cached_response(); `build` is a coroutine function"""
+    generations = await Generation.acurrent(*generation_keys)
+    key = collection_key(name, generations, **params)
+    not_modified = _not_modified(request, etag_for(key))
+    if not_modified is not None:
+        return not_modified
+
+    content, source = await get_cache().aget_or_build(key, build)
+    return _response(key, content, source)
+
+
+def _response(key, content, source):
+    response = HttpResponse(content, content_type="application/json")
+    response["X-Cache"] = source
+    _set_validators(response, etag_for(key))
+    return response
@@ -0,0 +1,94 @@
+"""
+Delta sync over the change log
+
+A client first fetches its collections in full together with the current
+cursor, then asks for the changes after that cursor on every refresh.
+Changes are folded per object and resolved against the current state, so
+the client only learns where each object ended up: still one of its cards
+(or trades), or removed.
+
+Old entries are deleted by compact(). A cursor older than what is left
+can no longer be served, and the client has to start over.
+"""
+from datetime import timedelta
+
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from .models import Card, ChangeLogEntry, TradeOffer
+
+
+class CursorExpired(Exception):
+    """Raised when the entries after a cursor have been compacted away"""
+
+
+def current_cursor():
+    """The cursor a client should sync from after a full fetch"""
+    return ChangeLogEntry.objects.aggregate(last=Max("id"))["last"] or 0
+
+
+def changes_since(user, since, limit=500):
+    """
+    Collect what changed for `user` after cursor `since`
+
+    Returns:
+        dict: cards / trades: the current state of every changed object
+            the user can still see; removed_cards / removed_trades: ids of
+            the ones they can't; cursor: where to continue from; has_more:
+            whether another call would return more
+
+    Raises:
+        CursorExpired: If entries after `since` may have been compacted
+    """
+    oldest = ChangeLogEntry.objects.aggregate(first=Min("id"))["first"]
+    # compact() always keeps the newest entry, so a gap means a lost cursor
+    if oldest is not None and since < oldest - 1:
+        raise CursorExpired(f"Cursor {since} is older than the change log")
+
+    entries = list(
+        ChangeLogEntry.objects.filter(user=user, id__gt=since)
+        .order_by("id")
+        .values_list("id", "kind", "object_id")[: limit + 1]
+    )
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+
+    changed = {ChangeLogEntry.CARD: set(), ChangeLogEntry.TRADE: set()}
+    for _, kind, object_id in entries:
+        changed[kind].add(object_id)
+
+    cards = Card.objects.select_related("owner").in_bulk(changed[ChangeLogEntry.CARD])
+    trades = TradeOffer.objects.select_related(
+        "sender", "sender_card", "recipient_card"
+    ).in_bulk(changed[ChangeLogEntry.TRADE])
+
+    # A card that changed hands is gone from this user's collection
+    kept_cards = [card for card in cards.values() if card.owner_id == user.pk]
+    return {
+        "cards": kept_cards,
+        "removed_cards": sorted(
+            changed[ChangeLogEntry.CARD] - {card.pk for card in kept_cards}
+        ),
+        "trades": list(trades.values()),
+        "removed_trades": sorted(changed[ChangeLogEntry.TRADE] - set(trades)),
+        "cursor": entries[-1][0] if entries else max(since, 0),
+        "has_more": has_more,
+    }
+
+
+def compact(keep_days=7):
+    """
+    Delete entries older than `keep_days`, except the newest one
+
+    Keeping the newest entry means the oldest remaining id always marks how
+    far back cursors are still valid.
+
+    Returns:
+        int: The number of entries deleted
+    """
+    newest = current_cursor()
+    cutoff = timezone.now() - timedelta(days=keep_days)
+    deleted, _ = ChangeLogEntry.objects.filter(
+        created_at__lt=cutoff, id__lt=newest
+    ).delete()
+    return deleted
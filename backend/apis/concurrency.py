@@ -0,0 +1,59 @@
+import functools
+import random
+import time
+
+from django.db import OperationalError, transaction
+
+# Lock contention messages from SQLite and PostgreSQL
+LOCK_ERROR_MARKERS = (
+    "database is locked",
+    "database table is locked",
+    "deadlock detected",
+    "could not serialize access",
+)
+
+
+class ConcurrentUpdate(Exception):
+    """Raised when a row changed between being read and being written"""
+
+
+def is_lock_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in LOCK_ERROR_MARKERS)
+
+
+def retry_on_conflict(func=None, *, attempts=5, backoff=0.005, using=None):
+    """
+    Run the decorated function in a transaction, retrying it from the start
+    when it loses a race
+
+    A retry happens on ConcurrentUpdate and on lock errors from the
+    database. The function must therefore do all of its reads inside the
+    call, so each attempt sees fresh rows. If we are already inside an
+    atomic block the outer transaction cannot be replayed, so the function
+    runs once and the error propagates to the caller.
+    """
+    if func is None:
+        return functools.partial(
+            retry_on_conflict, attempts=attempts, backoff=backoff, using=using
+        )
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if transaction.get_connection(using).in_atomic_block:
+            with transaction.atomic(using=using):
+                return func(*args, **kwargs)
+
+        for attempt in range(attempts):
+            try:
+                with transaction.atomic(using=using):
+                    return func(*args, **kwargs)
+            except (ConcurrentUpdate, OperationalError) as error:
+                if isinstance(error, OperationalError) and not is_lock_error(error):
+                    raise
+                if attempt == attempts - 1:
+                    raise ConcurrentUpdate(str(error)) from error
+                # Jittered exponential backoff so the losers don't collide again
+                time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    return wrapper
@@ -0,0 +1,117 @@
+"""
+Change events pushed to connected clients
+
+Views publish an event after their transaction commits; the event stream
+view (served under ASGI) forwards it to every subscriber allowed to see
+it. The broker is chosen with the EVENT_BROKER setting. InProcessBroker
+only reaches clients connected to the same process, so a deployment with
+several workers swaps in a broker backed by a shared pub/sub. Committed
+events are also counted in the metrics (see apis/metrics.py).
+
+Event types:
+    card.listed, card.delisted, card.sold, card.transferred
+    trade.created, trade.accepted, trade.declined, trade.canceled
+"""
+import asyncio
+import itertools
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import metrics
+
+
+class Subscription:
+    """One client's queue of pending events, read from its event loop"""
+
+    def __init__(self, broker, loop, maxsize):
+        self.broker = broker
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        # Set when events had to be dropped; the client must refetch
+        self.overflowed = False
+
+    def deliver(self, event):
+        """Queue `event`; safe to call from any thread"""
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The client's event loop has shut down under us
+            self.close()
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    def __init__(self, max_queue=100):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def publish(self, event):
+        event = dict(event, id=next(self._ids))
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.deliver(event)
+
+    def subscribe(self):
+        """Must be called from the event loop that will read the subscription"""
+        subscription = Subscription(self, asyncio.get_running_loop(), self.max_queue)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                path = getattr(settings, "EVENT_BROKER", "apis.events.InProcessBroker")
+                _broker = import_string(path)()
+    return _broker
+
+
+def publish(event_type, users=None, **payload):
+    """
+    Publish an event once the current transaction commits
+
+    Args:
+        event_type (str): e.g. "card.sold"
+        users (list): ids of the only users allowed to receive it, or None
+            for an event everyone may see
+        **payload: The serialized objects the event is about
+    """
+    event = dict(payload, type=event_type, users=users)
+
+    def committed():
+        metrics.record_event(event)
+        get_broker().publish(event)
+
+    transaction.on_commit(committed)
+
+
+def visible_to(event, user_id):
+    return event["users"] is None or user_id in event["users"]
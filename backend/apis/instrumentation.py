@@ -0,0 +1,214 @@
+"""
+Per-request ORM instrumentation
+
+QueryInstrumentationMiddleware counts the queries a request runs and the
+time spent in the database, spots repeated same-shape queries (the N+1
+pattern) and enforces the `query_budget` declared on views.
+
+Settings:
+    QUERY_INSTRUMENTATION_HEADERS: expose the numbers as X-DB-* response
+        headers and trace N+1 queries back to the serializer field that ran
+        them. Defaults to DEBUG, since the tracing walks the call stack.
+    QUERY_BUDGET_STRICT: raise QueryBudgetExceeded instead of logging a
+        warning when a view goes over its budget. Defaults to False; the
+        tests turn it on with override_settings.
+    N_PLUS_ONE_THRESHOLD: how many times one query shape may run in a single
+        request before it is reported as an N+1. Defaults to 3.
+
+The middleware works under both WSGI and ASGI. Async views run their
+queries on a shared worker thread, so instead of wrapping the connections
+of the calling thread, every connection carries a dispatcher that hands
+each query to the collector of the current context. asgiref carries the
+context into that worker thread, which keeps concurrent requests apart.
+"""
+import logging
+import re
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from rest_framework.fields import Field
+from rest_framework.serializers import BaseSerializer
+
+logger = logging.getLogger(__name__)
+
+_IN_LIST = re.compile(r"IN \((?:%s, )*%s\)")
+_NUMBER = re.compile(r"\b\d+\b")
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised in strict mode when a view runs more queries than it declared"""
+
+
+def query_shape(sql):
+    """Reduce a query to its shape so that queries differing only in values match"""
+    return _NUMBER.sub("?", _IN_LIST.sub("IN (...)", sql))
+
+
+def serializer_origin():
+    """
+    Find the serializer field currently being rendered, if any
+
+    Returns:
+        str: "SerializerName.field_name", or None outside of serialization
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        field = frame.f_locals.get("self")
+        if (
+            isinstance(field, Field)
+            and not isinstance(field, BaseSerializer)
+            and field.field_name
+        ):
+            return f"{type(field.parent).__name__}.{field.field_name}"
+        frame = frame.f_back
+    return None
+
+
+class QueryCollector:
+    """Database execute wrapper that records every query run through it"""
+
+    def __init__(self, trace_origins=False):
+        self.trace_origins = trace_origins
+        self.count = 0
+        self.duration = 0.0
+        # shape -> [times run, serializer field that repeated it]
+        self.shapes = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+            entry = self.shapes.setdefault(query_shape(sql), [0, None])
+            entry[0] += 1
+            # The first run of a shape is usually legitimate; trace the repeat
+            if entry[0] == 2 and self.trace_origins:
+                entry[1] = serializer_origin()
+
+    def repeated_queries(self, threshold):
+        """
+        Returns:
+            list: (shape, times run, origin) for every shape run at least
+                `threshold` times, most repeated first
+        """
+        repeated = [
+            (shape, runs, origin)
+            for shape, (runs, origin) in self.shapes.items()
+            if runs >= threshold
+        ]
+        return sorted(repeated, key=lambda item: item[1], reverse=True)
+
+
+_active_collector = ContextVar("query_collector", default=None)
+
+
+def _dispatch(execute, sql, params, many, context):
+    collector = _active_collector.get()
+    if collector is None:
+        return execute(sql, params, many, context)
+    return collector(execute, sql, params, many, context)
+
+
+def install(connection):
+    """Route the queries of `connection` to the collector of the running context"""
+    if _dispatch not in connection.execute_wrappers:
+        # Outermost, so wrappers pushed and popped by others stay balanced
+        connection.execute_wrappers.insert(0, _dispatch)
+
+
+@contextmanager
+def collect_queries(trace_origins=False):
+    """Record the queries run on every configured database inside the block"""
+    for connection in connections.all():
+        install(connection)
+    collector = QueryCollector(trace_origins=trace_origins)
+    token = _active_collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _active_collector.reset(token)
+
+
+def view_query_budget(view_func, method):
+    """
+    Look up the `query_budget` declared on the view class behind `view_func`
+
+    The budget is either an int, or a dict keyed by action name ("list",
+    "retrieve", ...) for viewsets and by lowercase method for other views.
+    """
+    view_class = getattr(view_func, "cls", None) or getattr(view_func, "view_class", None)
+    budget = getattr(view_class, "query_budget", None)
+
+    if isinstance(budget, dict):
+        actions = getattr(view_func, "actions", None) or {}
+        return budget.get(actions.get(method.lower(), method.lower()))
+    return budget
+
+
+class QueryInstrumentationMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        expose = getattr(settings, "QUERY_INSTRUMENTATION_HEADERS", settings.DEBUG)
+        request.query_budget = None
+        with collect_queries(trace_origins=expose) as collector:
+            response = self.get_response(request)
+        return self.report(request, response, collector, expose)
+
+    async def __acall__(self, request):
+        expose = getattr(settings, "QUERY_INSTRUMENTATION_HEADERS", settings.DEBUG)
+        request.query_budget = None
+        with collect_queries(trace_origins=expose) as collector:
+            response = await self.get_response(request)
+        return self.report(request, response, collector, expose)
+
+    def report(self, request, response, collector, expose):
+        # Left on the request for whoever handled it, e.g. bench_endpoints
+        request.query_collector = collector
+        threshold = getattr(settings, "N_PLUS_ONE_THRESHOLD", 3)
+        repeated = collector.repeated_queries(threshold)
+        for shape, runs, origin in repeated:
+            logger.warning(
+                "N+1 query on %s: %s ran %d times (from %s)",
+                request.path, shape, runs, origin or "unknown",
+            )
+
+        if expose:
+            response["X-DB-Query-Count"] = str(collector.count)
+            response["X-DB-Time-Ms"] = f"{collector.duration * 1000:.2f}"
+            if repeated:
+                response["X-DB-N-Plus-One"] = "; ".join(
+                    f"{origin or 'unknown'} x{runs}" for _, runs, origin in repeated
+                )
+
+        budget = request.query_budget
+        if budget is not None and collector.count > budget:
+            message = (
+                f"{request.method} {request.path} ran {collector.count} queries, "
+                f"over its budget of {budget}"
+            )
+            if getattr(settings, "QUERY_BUDGET_STRICT", False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = view_query_budget(view_func, request.method)
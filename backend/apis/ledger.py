@@ -0,0 +1,226 @@
+"""
+Credit ledger
+
+Every change to a balance goes through this module, which applies it to
+the balance columns and appends a LedgerEntry for it in the same
+transaction. Callers must already be inside a transaction.
+
+With LEDGER_BALANCE_SHARDS = N > 0, incoming credits land on one of N
+BalanceShard rows picked at random instead of on CustomUser.account_balance,
+so sales to a popular seller don't all queue on one row lock. Debits still
+come out of account_balance; shards are folded back into it when a debit
+would otherwise fail, and periodically by the compact_ledger command.
+"""
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import BalanceShard, BalanceSnapshot, CustomUser, LedgerEntry
+
+
+def _snapshot_watermark():
+    """The last entry folded into the entry's user's snapshot, 0 if none"""
+    return Coalesce(
+        Subquery(
+            BalanceSnapshot.objects.filter(user=OuterRef("user")).values(
+                "last_entry_id"
+            )[:1]
+        ),
+        0,
+    )
+
+
+def shard_count():
+    return getattr(settings, "LEDGER_BALANCE_SHARDS", 0)
+
+
+def balance(user_id):
+    """A user's spendable balance: account_balance plus all their shards"""
+    user = CustomUser.objects.filter(pk=user_id).annotate(
+        sharded=Coalesce(Sum("balance_shards__amount"), 0)
+    ).values_list("account_balance", "sharded").get()
+    return user[0] + user[1]
+
+
+def credit(user_id, amount, kind, card=None):
+    """Add `amount` credits to a user and record it"""
+    shards = shard_count()
+    if shards:
+        _credit_shard(user_id, random.randrange(shards), amount)
+    else:
+        CustomUser.credit(user_id, amount)
+    LedgerEntry.objects.create(user_id=user_id, amount=amount, kind=kind, card=card)
+
+
+def debit(user_id, amount, kind, card=None):
+    """
+    Take `amount` credits from a user and record it
+
+    Returns:
+        bool: False if the balance doesn't cover it; no credits leave then
+    """
+    if not CustomUser.debit(user_id, amount):
+        # The money may be sitting in shards; pull it in and try once more
+        if not fold_shards(user_id) or not CustomUser.debit(user_id, amount):
+            return False
+    LedgerEntry.objects.create(user_id=user_id, amount=-amount, kind=kind, card=card)
+    return True
+
+
+def transfer(buyer_id, seller_id, amount, card=None):
+    """
+    Move `amount` credits from buyer to seller for `card`
+
+    Returns:
+        bool: False if the buyer can't afford it; no credits move then
+    """
+    if not debit(buyer_id, amount, "purchase", card=card):
+        return False
+    credit(seller_id, amount, "sale", card=card)
+    return True
+
+
+def record_opening_balances(users):
+    """Record the starting balance of users created without going through credit()"""
+    LedgerEntry.objects.bulk_create(
+        LedgerEntry(user_id=user.pk, amount=user.account_balance, kind="opening")
+        for user in users
+        if user.account_balance
+    )
+
+
+def _credit_shard(user_id, shard, amount):
+    updated = BalanceShard.objects.filter(user_id=user_id, shard=shard).update(
+        amount=F("amount") + amount
+    )
+    if not updated:
+        # First credit to this shard; another request may be creating it too
+        BalanceShard.objects.bulk_create(
+            [BalanceShard(user_id=user_id, shard=shard)], ignore_conflicts=True
+        )
+        BalanceShard.objects.filter(user_id=user_id, shard=shard).update(
+            amount=F("amount") + amount
+        )
+
+
+def fold_shards(user_id):
+    """
+    Move everything in a user's shards into their account_balance
+
+    Each shard is decremented by exactly the amount read from it, so credits
+    landing concurrently are never lost.
+
+    Returns:
+        int: The number of credits moved
+    """
+    moved = 0
+    for shard in BalanceShard.objects.select_for_update().filter(
+        user_id=user_id
+    ).exclude(amount=0):
+        BalanceShard.objects.filter(pk=shard.pk).update(
+            amount=F("amount") - shard.amount
+        )
+        moved += shard.amount
+    if moved:
+        CustomUser.credit(user_id, moved)
+    return moved
+
+
+def compact(prune=False, settle_seconds=60):
+    """
+    Fold settled ledger entries into per-user snapshots
+
+    Every user with entries since the last compaction gets a snapshot that
+    covers up to the newest entry older than `settle_seconds`. The lag keeps
+    us clear of entries whose transactions may still be in flight. Entries
+    covered by a snapshot may then be deleted with `prune`.
+
+    Returns:
+        tuple: (snapshots written, entries pruned)
+    """
+    settled = timezone.now() - timedelta(seconds=settle_seconds)
+    upto = LedgerEntry.objects.filter(created_at__lte=settled).aggregate(
+        last=Max("id")
+    )["last"]
+    if upto is None:
+        return 0, 0
+
+    totals = list(
+        LedgerEntry.objects.filter(id__lte=upto)
+        .filter(id__gt=_snapshot_watermark())
+        .values("user")
+        .annotate(total=Sum("amount"))
+    )
+    snapshots = BalanceSnapshot.objects.in_bulk([row["user"] for row in totals])
+
+    written = []
+    for row in totals:
+        snapshot = snapshots.get(row["user"]) or BalanceSnapshot(
+            user_id=row["user"], balance=0
+        )
+        snapshot.balance += row["total"]
+        snapshot.last_entry_id = upto
+        written.append(snapshot)
+
+    BalanceSnapshot.objects.bulk_create(
+        written,
+        update_conflicts=True,
+        unique_fields=["user"],
+        update_fields=["balance", "last_entry_id", "updated_at"],
+    )
+
+    pruned = 0
+    if prune:
+        pruned, _ = LedgerEntry.objects.filter(
+            id__lte=_snapshot_watermark()
+        ).delete()
+    return len(written), pruned
+
+
+def reconcile(users=None):
+    """
+    Compare every user's ledger total with their actual balance
+
+    Args:
+        users (QuerySet): Only check these users, default everyone
+
+    Returns:
+        list: (user id, ledger total, balance) for every user that disagrees
+    """
+    if users is None:
+        users = CustomUser.objects.all()
+    user_ids = users.values("pk")
+
+    ledger = {
+        row["user"]: row["total"]
+        for row in LedgerEntry.objects.filter(
+            user__in=user_ids, id__gt=_snapshot_watermark()
+        )
+        .values("user")
+        .annotate(total=Sum("amount"))
+    }
+    snapshots = dict(
+        BalanceSnapshot.objects.filter(user__in=user_ids).values_list(
+            "user_id", "balance"
+        )
+    )
+
+    mismatches = []
+    users = users.annotate(
+        sharded=Coalesce(Sum("balance_shards__amount"), 0)
+    ).values_list("pk", "account_balance", "sharded")
+    for user_id, account_balance, sharded in users.iterator():
+        expected = snapshots.get(user_id, 0) + ledger.get(user_id, 0)
+        actual = account_balance + sharded
+        if expected != actual:
+            mismatches.append((user_id, expected, actual))
+    return mismatches
+
+
+def adjust(user_id, amount):
+    """Record a correction so the ledger matches a balance changed outside it"""
+    LedgerEntry.objects.create(user_id=user_id, amount=amount, kind="adjustment")
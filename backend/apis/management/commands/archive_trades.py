@@ -0,0 +1,65 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apis.models import ArchivedTradeOffer, TradeOffer
+
+
+class Command(BaseCommand):
+    help = (
+        "Move trade offers settled before the trade list's window "
+        "(TRADE_HISTORY_DAYS) from the trade offer table to the archive, in "
+        "batches that each commit on their own. Safe to interrupt and rerun."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            help="Archive offers settled more than this many days ago "
+            "(default: up to the trade list's window)",
+        )
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between batches, to leave room for other writers",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] <= 0:
+            raise CommandError("--batch-size must be positive")
+        horizon = TradeOffer.settled_horizon()
+        if options["days"] is not None:
+            horizon = timezone.now() - timedelta(days=options["days"])
+            if horizon > TradeOffer.settled_horizon():
+                raise CommandError(
+                    "That would archive offers still shown in the trade list"
+                )
+
+        started = time.perf_counter()
+        moved = batches = 0
+        last_id = 0
+        while True:
+            count, last_id = ArchivedTradeOffer.archive_batch(
+                horizon, after_id=last_id, batch_size=options["batch_size"]
+            )
+            if last_id is None:
+                break
+            moved += count
+            batches += 1
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Archived up to offer {last_id}")
+            if options["pause"]:
+                time.sleep(options["pause"])
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Archived {moved} trade offers settled before "
+                f"{horizon:%Y-%m-%d %H:%M} in {batches} batches, "
+                f"{time.perf_counter() - started:.2f}s"
+            )
+        )
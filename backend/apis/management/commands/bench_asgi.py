@@ -0,0 +1,180 @@
+import asyncio
+import io
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from rest_framework_simplejwt.tokens import AccessToken
+
+from apis.models import CustomUser
+
+# endpoint -> (WSGI path, ASGI path)
+ENDPOINTS = {
+    "marketplace": ("/api/cards/marketplace/", "/api/async/cards/marketplace/"),
+    "by-user": ("/api/cards/by-user/", "/api/async/cards/by-user/"),
+    "trades": ("/api/trades/", "/api/async/trades/"),
+}
+
+
+def wsgi_request(application, path, query, token):
+    environ = {
+        "REQUEST_METHOD": "GET",
+        "PATH_INFO": path,
+        "QUERY_STRING": query,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "HTTP_HOST": "localhost",
+        "HTTP_AUTHORIZATION": f"Bearer {token}",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": io.StringIO(),
+        "wsgi.url_scheme": "http",
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    status = []
+    started = time.perf_counter()
+    body = application(environ, lambda code, headers: status.append(code))
+    try:
+        b"".join(body)
+    finally:
+        body.close()
+    return int(status[0].split()[0]), time.perf_counter() - started
+
+
+async def asgi_request(application, path, query, token):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [
+            (b"host", b"localhost"),
+            (b"authorization", f"Bearer {token}".encode()),
+        ],
+        "client": ("127.0.0.1", 0),
+        "server": ("localhost", 80),
+    }
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    disconnected = asyncio.Event()
+    status = []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # The client stays connected until the response is complete
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    started = time.perf_counter()
+    await application(scope, receive, send)
+    disconnected.set()
+    return status[0], time.perf_counter() - started
+
+
+def run_wsgi(path, query, token, requests, concurrency):
+    application = get_wsgi_application()
+
+    def worker(count):
+        try:
+            return [wsgi_request(application, path, query, token) for _ in range(count)]
+        finally:
+            connections.close_all()
+
+    shares = [requests // concurrency] * concurrency
+    with ThreadPoolExecutor(concurrency) as pool:
+        return [result for results in pool.map(worker, shares) for result in results]
+
+
+def run_asgi(path, query, token, requests, concurrency):
+    application = get_asgi_application()
+
+    async def worker(count):
+        return [await asgi_request(application, path, query, token) for _ in range(count)]
+
+    async def main():
+        shares = [requests // concurrency] * concurrency
+        results = await asyncio.gather(*(worker(count) for count in shares))
+        return [result for batch in results for result in batch]
+
+    return asyncio.run(main())
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the throughput of the read endpoints served through the WSGI "
+        "handler with their async versions served through the ASGI handler"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--username", help="User to authenticate as, default the first user"
+        )
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            nargs="+",
+            default=[1, 8, 32],
+            help="Concurrent connections; one run per value",
+        )
+        parser.add_argument(
+            "--endpoint",
+            choices=ENDPOINTS,
+            nargs="+",
+            default=list(ENDPOINTS),
+        )
+
+    def handle(self, *args, **options):
+        users = CustomUser.objects.order_by("pk")
+        if options["username"]:
+            users = users.filter(username=options["username"])
+        user = users.first()
+        if user is None:
+            raise CommandError("No user to authenticate as; seed some data first")
+        token = str(AccessToken.for_user(user))
+        queries = {"by-user": urlencode({"username": user.username})}
+
+        self.stdout.write(
+            f"{'endpoint':<12} {'stack':<5} {'conns':>5} {'req/s':>9} "
+            f"{'p50 ms':>8} {'p95 ms':>8} {'errors':>6}"
+        )
+        for endpoint in options["endpoint"]:
+            wsgi_path, asgi_path = ENDPOINTS[endpoint]
+            query = queries.get(endpoint, "")
+            for concurrency in options["concurrency"]:
+                runs = [
+                    ("wsgi", run_wsgi, wsgi_path),
+                    ("asgi", run_asgi, asgi_path),
+                ]
+                for stack, run, path in runs:
+                    started = time.perf_counter()
+                    results = run(path, query, token, options["requests"], concurrency)
+                    elapsed = time.perf_counter() - started
+                    self.report(endpoint, stack, concurrency, results, elapsed)
+
+    def report(self, endpoint, stack, concurrency, results, elapsed):
+        latencies = sorted(duration for _, duration in results)
+        errors = sum(1 for code, _ in results if code != 200)
+        p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+        self.stdout.write(
+            f"{endpoint:<12} {stack:<5} {concurrency:>5} "
+            f"{len(results) / elapsed:>9.1f} "
+            f"{statistics.median(latencies) * 1000:>8.2f} "
+            f"{p95 * 1000:>8.2f} {errors:>6}"
+        )
@@ -0,0 +1,512 @@
+import json
+import logging
+import math
+import platform
+import random
+import subprocess
+import time
+from collections import Counter, namedtuple
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from apis import caching, changelog
+from apis.models import Card, CustomUser, TestModel, TradeOffer
+
+Call = namedtuple("Call", "method path data user", defaults=(None, None))
+
+# Routes that can't be driven request by request
+SKIPPED = {
+    "event-stream": "streams until the client disconnects",
+}
+
+# The URL name of the route behind endpoints named otherwise
+ROUTE_NAMES = {
+    "token": "token_obtain_pair",
+    "token-refresh": "token_refresh",
+    "card-marketplace-list": "card-marketplace",
+    "trade-offers-create": "trade-offers-list",
+}
+
+
+def covered_routes(endpoints):
+    """The URL names of the routes `endpoints` drive, or SKIPPED explains"""
+    return {ROUTE_NAMES.get(name, name) for name in endpoints} | set(SKIPPED)
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list"""
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Population:
+    """The seeded users and cards, and random picks from them"""
+
+    def __init__(self, prefix, rng):
+        self.rng = rng
+        self.prefix = prefix
+        self.users = list(
+            CustomUser.objects.filter(username__startswith=prefix).order_by("pk")
+        )
+        if len(self.users) < 2:
+            raise CommandError(
+                f"No users prefixed '{prefix}'; run seed_data first"
+            )
+        self.users_by_id = {user.pk: user for user in self.users}
+        self.card_ids = list(
+            Card.objects.filter(owner__in=self.users).values_list("pk", flat=True)
+        )
+        if not self.card_ids:
+            raise CommandError("The seeded users own no cards; run seed_data first")
+        self.admin, _ = CustomUser.objects.update_or_create(
+            username=f"{prefix}bench_admin", defaults={"is_staff": True}
+        )
+        self.test_model, _ = TestModel.objects.get_or_create(
+            title=f"{prefix}bench", defaults={"description": "bench_endpoints"}
+        )
+        self.tokens = {}
+        self.created = 0
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def token(self, user):
+        if user.pk not in self.tokens:
+            self.tokens[user.pk] = str(AccessToken.for_user(user))
+        return self.tokens[user.pk]
+
+    def card(self, listed=None, exclude_owner=None):
+        """A random seeded card as a values() dict, optionally listed or not"""
+        for _ in range(100):
+            card = (
+                Card.objects.filter(pk=self.rng.choice(self.card_ids))
+                .values("id", "owner_id", "price")
+                .first()
+            )
+            if card is None or card["owner_id"] not in self.users_by_id:
+                continue
+            if listed is not None and (card["price"] >= 0) != listed:
+                continue
+            if card["owner_id"] == exclude_owner:
+                continue
+            return card
+        raise CommandError("Could not find a suitable card; seed more data")
+
+    def offer(self):
+        offer = (
+            TradeOffer.objects.filter(
+                sender__in=self.users, recipient__in=self.users, status="pending"
+            )
+            .values("id", "sender_id", "recipient_id")
+            .order_by("?")
+            .first()
+        )
+        if offer is None:
+            raise CommandError("No pending trade offers left; seed more data")
+        return offer
+
+    def new_user(self):
+        """A throwaway user to sign up or delete"""
+        self.created += 1
+        return f"{self.prefix}bench_{time.time_ns()}_{self.created}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive every API route through Django's test client against the data "
+        "from seed_data, and write a JSON report of latency percentiles, "
+        "throughput and query counts per endpoint for diffing between "
+        "commits. By default the run is one transaction that is rolled back "
+        "afterwards, so every write is a savepoint: commits, on_commit hooks, "
+        "conflict retries and database write locks are left out of the "
+        "timings. --keep commits each write like in production; run it "
+        "against a throwaway copy of the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200, help="Per endpoint")
+        parser.add_argument(
+            "--warmup", type=int, default=10, help="Unmeasured requests per endpoint"
+        )
+        parser.add_argument("--endpoint", nargs="+", help="Only these endpoints")
+        parser.add_argument("--prefix", default="seed_", help="seed_data's --prefix")
+        parser.add_argument("--password", default="password", help="seed_data's --password")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the report here instead of stdout")
+        parser.add_argument(
+            "--compare", help="An earlier report to print the differences from"
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Commit each write as it is made instead of rolling them all back",
+        )
+
+    def handle(self, *args, **options):
+        endpoints = self.endpoints()
+        selected = options["endpoint"] or list(endpoints)
+        unknown = set(selected) - set(endpoints)
+        if unknown:
+            raise CommandError(
+                f"Unknown endpoints: {', '.join(sorted(unknown))}; "
+                f"choose from {', '.join(endpoints)}"
+            )
+
+        self.options = options
+        self.client = Client(raise_request_exception=False)
+        # What production runs: no query logging, no origin tracing
+        overrides = override_settings(
+            DEBUG=False,
+            QUERY_INSTRUMENTATION_HEADERS=False,
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"],
+        )
+        # Budget overruns go in the report instead of one warning per request
+        instrumentation = logging.getLogger("apis.instrumentation")
+        level = instrumentation.level
+        instrumentation.setLevel(logging.ERROR)
+        if not options["keep"]:
+            self.stderr.write(
+                "Writes run as savepoints of one rolled back transaction and "
+                "never commit; use --keep on a throwaway database to time commits"
+            )
+        try:
+            with overrides, nullcontext() if options["keep"] else transaction.atomic():
+                self.population = Population(
+                    options["prefix"], random.Random(options["seed"])
+                )
+                report = self.run(endpoints, selected)
+                if not options["keep"]:
+                    raise Rollback
+        except Rollback:
+            # Entries built inside the rolled back transaction must go too
+            cache = caching.get_cache()
+            if cache.local is not None:
+                cache.local.clear()
+            if cache.shared is not None:
+                self.stderr.write(
+                    "The shared collection cache may hold entries built from "
+                    "rolled back writes; clear it before serving traffic"
+                )
+        finally:
+            instrumentation.setLevel(level)
+
+        content = json.dumps(report, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                file.write(content + "\n")
+        else:
+            self.stdout.write(content)
+
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                self.compare(json.load(file), report)
+
+    def run(self, endpoints, selected):
+        population = self.population
+        results = {}
+        for name in selected:
+            method, route, build = endpoints[name]
+            for _ in range(self.options["warmup"]):
+                self.request(build(population))
+
+            # Only the requests are timed, not picking what to send
+            samples = [
+                self.request(build(population))
+                for _ in range(self.options["requests"])
+            ]
+            results[name] = self.summarize(method, route, samples)
+            latency = results[name]["latency_ms"]
+            self.stderr.write(
+                f"{name:<24} p50 {latency['p50']:>8.2f} ms  "
+                f"p99 {latency['p99']:>8.2f} ms  "
+                f"{results[name]['queries']['mean']:>5.1f} queries"
+            )
+
+        return {
+            "meta": {
+                "commit": git_commit(),
+                "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+                "population": {
+                    "users": len(population.users),
+                    "cards": len(population.card_ids),
+                    "offers": TradeOffer.objects.filter(
+                        sender__in=population.users
+                    ).count(),
+                },
+                "requests": self.options["requests"],
+                "warmup": self.options["warmup"],
+                "writes": "committed" if self.options["keep"] else "rolled back",
+                "seed": self.options["seed"],
+            },
+            "endpoints": results,
+            "skipped": {name: reason for name, reason in SKIPPED.items()},
+        }
+
+    def request(self, call):
+        """
+        Returns:
+            tuple: (status code, seconds, queries run, the view's query budget,
+                X-Cache header or None)
+        """
+        headers = {}
+        if call.user is not None:
+            headers["Authorization"] = f"Bearer {self.population.token(call.user)}"
+        data = json.dumps(call.data) if call.data is not None else None
+
+        started = time.perf_counter()
+        response = self.client.generic(
+            call.method,
+            call.path,
+            data or "",
+            content_type="application/json",
+            headers=headers,
+        )
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        else:
+            response.content
+        elapsed = time.perf_counter() - started
+
+        collector = getattr(response.wsgi_request, "query_collector", None)
+        queries = collector.count if collector is not None else 0
+        budget = getattr(response.wsgi_request, "query_budget", None)
+        return response.status_code, elapsed, queries, budget, response.get("X-Cache")
+
+    def summarize(self, method, route, samples):
+        latencies = sorted(elapsed for _, elapsed, _, _, _ in samples)
+        queries = [count for _, _, count, _, _ in samples]
+        budget = samples[0][3]
+        statuses = Counter(str(code) for code, _, _, _, _ in samples)
+        cache = Counter(source for *_, source in samples if source)
+        total = sum(latencies)
+        return {
+            "method": method,
+            "route": route,
+            "requests": len(samples),
+            "statuses": dict(statuses),
+            "errors": sum(1 for code, *_ in samples if code >= 400),
+            "latency_ms": {
+                "p50": round(percentile(latencies, 50) * 1000, 3),
+                "p95": round(percentile(latencies, 95) * 1000, 3),
+                "p99": round(percentile(latencies, 99) * 1000, 3),
+                "mean": round(total / len(latencies) * 1000, 3),
+                "max": round(latencies[-1] * 1000, 3),
+            },
+            "throughput_rps": round(len(latencies) / total, 1) if total else None,
+            "queries": {
+                "mean": round(sum(queries) / len(queries), 2),
+                "max": max(queries),
+                "budget": budget,
+                "over_budget": sum(
+                    1 for count in queries if budget is not None and count > budget
+                ),
+            },
+            "cache": dict(cache),
+        }
+
+    def compare(self, before, after):
+        self.stderr.write(
+            f"\n{'endpoint':<24} {'p50 ms':>19} {'p95 ms':>19} {'queries':>13}"
+        )
+        for name, new in after["endpoints"].items():
+            old = before.get("endpoints", {}).get(name)
+            if old is None:
+                self.stderr.write(f"{name:<24} (new)")
+                continue
+            columns = []
+            for p in ("p50", "p95"):
+                was, now = old["latency_ms"][p], new["latency_ms"][p]
+                change = (now - was) / was * 100 if was else 0
+                columns.append(f"{was:>7.2f} {now:>7.2f} {change:>+4.0f}%")
+            columns.append(f"{old['queries']['mean']:>6.1f} {new['queries']['mean']:>6.1f}")
+            self.stderr.write(f"{name:<24} " + " ".join(columns))
+
+    def endpoints(self):
+        """name -> (method, route, function building a Call from the population)"""
+
+        def get(path, **params):
+            return f"{path}?{urlencode(params)}" if params else path
+
+        def purchase(population):
+            buyer = population.users[0]
+            card = population.card(listed=True, exclude_owner=buyer.pk)
+            return Call("POST", "/api/cards/purchase/", {"card_id": card["id"]}, buyer)
+
+        def list_card(population):
+            card = population.card()
+            owner = population.users_by_id[card["owner_id"]]
+            data = {"card_id": card["id"], "price": population.rng.randint(1, 500)}
+            return Call("POST", "/api/cards/marketplace/", data, owner)
+
+        def transfer(population):
+            card = population.card()
+            owner = population.users_by_id[card["owner_id"]]
+            recipient = population.user()
+            data = {"card_id": card["id"], "recipient_username": recipient.username}
+            return Call("POST", "/api/cards/transfer/", data, owner)
+
+        def create_offer(population):
+            mine = population.card(listed=False)
+            theirs = population.card(listed=False, exclude_owner=mine["owner_id"])
+            data = {
+                "sender_card": mine["id"],
+                "recipient_card": theirs["id"],
+                "recipient_username": population.users_by_id[theirs["owner_id"]].username,
+            }
+            return Call("POST", "/api/trades/", data, population.users_by_id[mine["owner_id"]])
+
+        def offer_action(population):
+            offer = population.offer()
+            if population.rng.random() < 0.5:
+                user, action = offer["recipient_id"], population.rng.choice(["accept", "decline"])
+            else:
+                user, action = offer["sender_id"], "cancel"
+            data = {"trade_id": offer["id"], "action": action}
+            return Call("POST", "/api/trades/action/", data, population.users_by_id[user])
+
+        def batch_action(population):
+            # Some of one sender's pending offers, canceled together
+            sender = population.users_by_id[population.offer()["sender_id"]]
+            offer_ids = TradeOffer.objects.filter(
+                sender=sender, status="pending"
+            ).values_list("id", flat=True)[:10]
+            data = {"actions": [{"trade_id": pk, "action": "cancel"} for pk in offer_ids]}
+            return Call("POST", "/api/trades/action/batch/", data, sender)
+
+        def offer_detail(population):
+            offer = population.offer()
+            return Call(
+                "GET", f"/api/trades/{offer['id']}/", user=population.users_by_id[offer["sender_id"]]
+            )
+
+        def changes(population):
+            since = max(changelog.current_cursor() - 200, 0)
+            return Call("GET", get("/api/changes/", since=since), user=population.user())
+
+        def obtain_token(population):
+            data = {"username": population.user().username, "password": self.options["password"]}
+            return Call("POST", "/api/token/", data)
+
+        def refresh_token(population):
+            refresh = str(RefreshToken.for_user(population.user()))
+            return Call("POST", "/api/token/refresh/", {"refresh": refresh})
+
+        def sign_up(population):
+            data = {"username": population.new_user(), "password": "bench-password"}
+            return Call("POST", "/api/user/create/", data)
+
+        def destroy(population):
+            user = CustomUser.objects.create(username=population.new_user())
+            return Call("DELETE", "/api/user/destroy/", user=user)
+
+        def search(population):
+            name = population.rng.choice(["char", "pika", "mew", "eevee", "holo", "dra"])
+            return Call("GET", get("/api/cards/search/", q=name), user=population.user())
+
+        def owned_by(population, path, param):
+            user = population.user()
+            return Call("GET", get(path, **{param: user.username}), user=user)
+
+        return {
+            "api-root": ("GET", "/api/", lambda p: Call("GET", "/api/", user=p.user())),
+            "token": ("POST", "/api/token/", obtain_token),
+            "token-refresh": ("POST", "/api/token/refresh/", refresh_token),
+            "user-create": ("POST", "/api/user/create/", sign_up),
+            "user-destroy": ("DELETE", "/api/user/destroy/", destroy),
+            "testmodel-list": (
+                "GET", "/api/testmodel/", lambda p: Call("GET", "/api/testmodel/", user=p.user())
+            ),
+            "testmodel-detail": (
+                "GET",
+                "/api/testmodel/<id>/",
+                lambda p: Call("GET", f"/api/testmodel/{p.test_model.pk}/", user=p.user()),
+            ),
+            "card-list": (
+                "GET", "/api/card/?owner=", lambda p: owned_by(p, "/api/card/", "owner")
+            ),
+            "card-detail": (
+                "GET",
+                "/api/card/<id>/",
+                lambda p: Call("GET", f"/api/card/{p.card()['id']}/", user=p.user()),
+            ),
+            "card-export": (
+                "GET",
+                "/api/card/export/?owner=",
+                lambda p: owned_by(p, "/api/card/export/", "owner"),
+            ),
+            "card-marketplace": (
+                "GET",
+                "/api/cards/marketplace/",
+                lambda p: Call("GET", "/api/cards/marketplace/", user=p.user()),
+            ),
+            "card-marketplace-list": ("POST", "/api/cards/marketplace/", list_card),
+            "cards-by-user": (
+                "GET",
+                "/api/cards/by-user/",
+                lambda p: owned_by(p, "/api/cards/by-user/", "username"),
+            ),
+            "card-search": ("GET", "/api/cards/search/", search),
+            "card-purchase": ("POST", "/api/cards/purchase/", purchase),
+            "card-transfer": ("POST", "/api/cards/transfer/", transfer),
+            "trade-offers-list": (
+                "GET", "/api/trades/", lambda p: Call("GET", "/api/trades/", user=p.user())
+            ),
+            "trade-offers-detail": ("GET", "/api/trades/<id>/", offer_detail),
+            "trade-offers-create": ("POST", "/api/trades/", create_offer),
+            "trade-action": ("POST", "/api/trades/action/", offer_action),
+            "trade-action-batch": ("POST", "/api/trades/action/batch/", batch_action),
+            "trade-history": (
+                "GET",
+                "/api/trades/history/",
+                lambda p: Call("GET", "/api/trades/history/", user=p.user()),
+            ),
+            "changes": ("GET", "/api/changes/", changes),
+            "cache-stats": (
+                "GET", "/api/cache/stats/", lambda p: Call("GET", "/api/cache/stats/", user=p.admin)
+            ),
+            "metrics": (
+                "GET", "/api/metrics/", lambda p: Call("GET", "/api/metrics/", user=p.admin)
+            ),
+            "async-card-marketplace": (
+                "GET",
+                "/api/async/cards/marketplace/",
+                lambda p: Call("GET", "/api/async/cards/marketplace/", user=p.user()),
+            ),
+            "async-cards-by-user": (
+                "GET",
+                "/api/async/cards/by-user/",
+                lambda p: owned_by(p, "/api/async/cards/by-user/", "username"),
+            ),
+            "async-trade-list": (
+                "GET",
+                "/api/async/trades/",
+                lambda p: Call("GET", "/api/async/trades/", user=p.user()),
+            ),
+        }
@@ -0,0 +1,108 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from apis import projections
+from apis.models import Card, CustomUser, TradeOffer
+from apis.renderers import FastJSONRenderer, orjson
+from apis.serializers import CardSerializer, TradeOfferSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure rows/sec of the card and trade lists, serialized through the "
+        "DRF serializers or the values() projections, and rendered by DRF's "
+        "JSON renderer or the orjson one. Build times include fetching the rows. "
+        "Rows are created in a transaction that is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=5000)
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="Runs per variant; the best one counts"
+        )
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stdout.write("orjson is not installed; the fast renderer falls back to DRF's")
+        try:
+            with transaction.atomic():
+                cards, trades = self.populate(options["rows"])
+                self.run(cards, trades, options["repeat"])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def populate(self, rows):
+        rng = random.Random(0)
+        users = CustomUser.objects.bulk_create(
+            CustomUser(username=f"bench_serializers_{i}") for i in range(50)
+        )
+        created = Card.objects.bulk_create(
+            Card(name=f"Card {i}", owner=rng.choice(users), price=rng.randint(-1, 500))
+            for i in range(rows * 2)
+        )
+        TradeOffer.objects.bulk_create(
+            TradeOffer(
+                sender_id=sender.owner_id,
+                recipient_id=recipient.owner_id,
+                sender_card=sender,
+                recipient_card=recipient,
+            )
+            for sender, recipient in zip(created[:rows], created[rows:])
+        )
+        user_ids = [user.pk for user in users]
+        cards = Card.objects.filter(owner__in=user_ids).select_related("owner")
+        trades = TradeOffer.objects.filter(sender__in=user_ids).select_related(
+            "sender", "sender_card", "recipient_card"
+        )
+        return cards[:rows], trades[:rows]
+
+    def run(self, cards, trades, repeat):
+        # Every run fetches from a fresh queryset, so the serializers can't
+        # reuse the rows an earlier run left in the queryset's cache
+        variants = [
+            ("cards", "serializer", lambda: CardSerializer(cards.all(), many=True).data),
+            ("cards", "values", lambda: list(projections.cards(cards.all()))),
+            (
+                "trades",
+                "serializer",
+                lambda: TradeOfferSerializer(trades.all(), many=True).data,
+            ),
+            (
+                "trades",
+                "values",
+                lambda: [
+                    projections.format_trade(row)
+                    for row in projections.trades(trades.all())
+                ],
+            ),
+        ]
+        renderers = [("drf", JSONRenderer()), ("orjson", FastJSONRenderer())]
+
+        self.stdout.write(
+            f"{'list':<7} {'build':<11} {'render':<7} {'rows/s':>10} {'build ms':>9} {'render ms':>10}"
+        )
+        for name, build_name, build in variants:
+            for render_name, renderer in renderers:
+                best = None
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    data = build()
+                    built = time.perf_counter()
+                    renderer.render(data)
+                    done = time.perf_counter()
+                    timing = (done - started, built - started, done - built)
+                    best = timing if best is None or timing < best else best
+                self.stdout.write(
+                    f"{name:<7} {build_name:<11} {render_name:<7} "
+                    f"{len(data) / best[0]:>10.0f} {best[1] * 1000:>9.1f} "
+                    f"{best[2] * 1000:>10.1f}"
+                )
@@ -0,0 +1,137 @@
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from apis.management.commands import bench_asgi, stress_market
+from apis.models import CustomUser
+from apis.storage import PROFILES
+
+# The default profile is measured as things were: a connection per request
+CONN_MAX_AGE = {"default": 0}
+
+
+def stress_users():
+    return CustomUser.objects.filter(username__startswith=stress_market.USER_PREFIX)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the SQLite storage profiles under concurrent purchases, "
+        "listings and trade accepts (the stress_market workload), under "
+        "marketplace reads through the WSGI handler, and under both at once. "
+        "Uses the configured database, like stress_market."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--profile", choices=PROFILES, nargs="+", default=list(PROFILES)
+        )
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--cards", type=int, default=200)
+        parser.add_argument("--offers", type=int, default=100)
+        parser.add_argument("--operations", type=int, default=400)
+        parser.add_argument("--workers", type=int, default=8, help="Writer threads")
+        parser.add_argument("--reads", type=int, default=400)
+        parser.add_argument("--readers", type=int, default=8, help="Reader threads")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("Storage profiles only apply to SQLite")
+        if stress_users().exists():
+            raise CommandError(
+                f"Users prefixed '{stress_market.USER_PREFIX}' already exist; "
+                "remove them first"
+            )
+
+        self.options = options
+        self.workload = {
+            "users": options["users"],
+            "cards": options["cards"],
+            "offers": options["offers"],
+            "operations": options["operations"],
+            "workers": options["workers"],
+            "processes": False,
+            "balance": 1000,
+            "seed": 0,
+        }
+        database = connections.settings["default"]
+        configured_age = database["CONN_MAX_AGE"]
+
+        self.stdout.write(
+            f"{'profile':<8} {'phase':<6} {'load':<6} {'ops/s':>8} {'p50 ms':>8} "
+            f"{'p95 ms':>8} {'2xx':>6} {'409':>5} {'4xx':>5} {'5xx':>5}"
+        )
+        try:
+            for profile in options["profile"]:
+                database["CONN_MAX_AGE"] = CONN_MAX_AGE.get(profile, configured_age)
+                with override_settings(SQLITE_PROFILE=profile):
+                    # Reconnect so the profile is applied
+                    connections.close_all()
+                    self.measure(profile)
+        finally:
+            database["CONN_MAX_AGE"] = configured_age
+            connections.close_all()
+
+    def measure(self, profile):
+        stress = stress_market.Command()
+        stress.populate(random.Random(0), self.workload)
+        try:
+            token = str(AccessToken.for_user(stress_users().first()))
+
+            self.report(profile, "writes", "writes", *self.write(stress))
+            self.report(profile, "reads", "reads", *self.read(token))
+
+            # Readers and writers at once, where WAL should matter most
+            reads = []
+            reader = threading.Thread(target=lambda: reads.append(self.read(token)))
+            reader.start()
+            writes = self.write(stress)
+            reader.join()
+            self.report(profile, "mixed", "writes", *writes)
+            self.report(profile, "mixed", "reads", *reads[0])
+        finally:
+            stress_users().delete()
+
+    def write(self, stress):
+        """Returns: (status codes, seconds taken, latencies or None)"""
+        results, elapsed = stress.run_workload(self.workload)
+        codes = Counter()
+        for (_, code), count in results.items():
+            codes[code] += count
+        return codes, elapsed, None
+
+    def read(self, token):
+        """Returns: (status codes, seconds taken, latencies)"""
+        started = time.perf_counter()
+        results = bench_asgi.run_wsgi(
+            "/api/cards/marketplace/",
+            "",
+            token,
+            self.options["reads"],
+            self.options["readers"],
+        )
+        elapsed = time.perf_counter() - started
+        codes = Counter(code for code, _ in results)
+        return codes, elapsed, sorted(duration for _, duration in results)
+
+    def report(self, profile, phase, load, codes, elapsed, latencies):
+        ok = sum(count for code, count in codes.items() if code < 300)
+        conflicts = codes[409]
+        server_errors = sum(count for code, count in codes.items() if code >= 500)
+        rejected = sum(codes.values()) - ok - conflicts - server_errors
+        if latencies:
+            p50 = f"{statistics.median(latencies) * 1000:.2f}"
+            p95 = f"{latencies[int(len(latencies) * 0.95) - 1] * 1000:.2f}"
+        else:
+            p50 = p95 = "-"
+        self.stdout.write(
+            f"{profile:<8} {phase:<6} {load:<6} {sum(codes.values()) / elapsed:>8.1f} "
+            f"{p50:>8} {p95:>8} {ok:>6} {conflicts:>5} {rejected:>5} {server_errors:>5}"
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from apis import changelog
+
+
+class Command(BaseCommand):
+    help = "Delete change log entries that delta sync clients no longer need"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep-days",
+            type=int,
+            default=7,
+            help="Keep entries younger than this many days (default: 7)",
+        )
+
+    def handle(self, *args, **options):
+        deleted = changelog.compact(keep_days=options["keep_days"])
+        self.stdout.write(f"Deleted {deleted} change log entries")
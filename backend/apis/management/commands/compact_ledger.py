@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apis import ledger
+from apis.models import BalanceShard
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold ledger entries into per-user balance snapshots and sharded "
+        "balance counters back into account balances"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help="Delete ledger entries that are covered by a snapshot",
+        )
+        parser.add_argument(
+            "--settle-seconds",
+            type=int,
+            default=60,
+            help="Leave entries younger than this for the next run (default: 60)",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            written, pruned = ledger.compact(
+                prune=options["prune"], settle_seconds=options["settle_seconds"]
+            )
+        self.stdout.write(f"Wrote {written} snapshots, pruned {pruned} entries")
+
+        user_ids = (
+            BalanceShard.objects.exclude(amount=0)
+            .values_list("user_id", flat=True)
+            .distinct()
+        )
+        moved = 0
+        for user_id in list(user_ids):
+            # One short transaction per user keeps the shard locks brief
+            with transaction.atomic():
+                moved += ledger.fold_shards(user_id)
+        self.stdout.write(f"Folded {moved} credits from balance shards")
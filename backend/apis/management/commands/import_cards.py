@@ -0,0 +1,315 @@
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from apis import search
+from apis.models import Card, CustomUser, ImportCheckpoint
+
+MAX_NAME_LENGTH = Card._meta.get_field("name").max_length
+
+# No single row comes anywhere near this; more means the input is broken
+MAX_ROW_BYTES = 1024 * 1024
+
+# Stay under SQLite's limit on query parameters
+OWNER_LOOKUP_BATCH = 900
+
+# Owners remembered between batches, most loads hand cards to far fewer
+MAX_CACHED_OWNERS = 100_000
+
+PROGRESS_SECONDS = 2
+
+
+class BadInput(ValueError):
+    pass
+
+
+def read_csv(stream):
+    return csv.DictReader(stream)
+
+
+def read_json(stream, chunk_size=64 * 1024):
+    """
+    Yield the objects of a JSON array, or of newline-delimited JSON,
+    reading `stream` a chunk at a time
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+    array = None
+
+    while True:
+        while position < len(buffer) and (
+            buffer[position].isspace() or (array and buffer[position] == ",")
+        ):
+            position += 1
+        if position == len(buffer):
+            if eof:
+                if array:
+                    raise BadInput("unterminated JSON array")
+                return
+            buffer, position = stream.read(chunk_size), 0
+            eof = not buffer
+            continue
+
+        if array is None:
+            array = buffer[position] == "["
+            position += array
+            continue
+        if array and buffer[position] == "]":
+            return
+
+        try:
+            row, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Most likely the row runs past the end of the buffer
+            if eof or len(buffer) - position > MAX_ROW_BYTES:
+                raise BadInput(f"invalid JSON near {buffer[position:position + 40]!r}")
+            more = stream.read(chunk_size)
+            buffer, position, eof = buffer[position:] + more, 0, not more
+            continue
+        yield row
+
+
+READERS = {"csv": read_csv, "json": read_json}
+
+
+def parse_row(row):
+    """
+    Returns:
+        tuple: (name, owner's username, price)
+
+    Raises:
+        ValueError: If the row isn't a valid card
+    """
+    if not isinstance(row, dict):
+        raise ValueError("expected an object with name, owner and price")
+
+    name = str(row.get("name") or "").strip()
+    if not name or len(name) > MAX_NAME_LENGTH:
+        raise ValueError(f"name must be 1 to {MAX_NAME_LENGTH} characters")
+
+    # Exports carry the owner's id in "owner" and their name alongside
+    username = row.get("owner_username") or row.get("owner")
+    if not username:
+        raise ValueError("no owner")
+
+    price = row.get("price")
+    if price is None or price == "":
+        price = -1
+    try:
+        price = int(price)
+    except (TypeError, ValueError):
+        raise ValueError(f"price {price!r} is not a whole number")
+    if price < -1:
+        raise ValueError("price must be -1 (not for sale) or more")
+
+    return name, str(username), price
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Mint cards in bulk from CSV or JSON rows with name, owner (a username) "
+        "and optionally price, defaulting to -1 (not for sale). Files written "
+        "by /api/card/export/ can be loaded as they are. Each batch commits "
+        "with a checkpoint, so rerunning an interrupted import resumes it; "
+        "don't edit the input in between."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Input file, or - for standard input")
+        parser.add_argument(
+            "--format",
+            choices=READERS,
+            help="csv, or json for an array or one object per line; "
+            "default from the file extension",
+        )
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--checkpoint",
+            help="Name to save progress under, default derived from the path; "
+            "required to resume reading from standard input",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore any saved progress and start from the first row",
+        )
+        parser.add_argument(
+            "--skip-invalid",
+            action="store_true",
+            help="Skip rows that are invalid or name an unknown owner "
+            "instead of stopping at the first one",
+        )
+        parser.add_argument(
+            "--defer-indexes",
+            action="store_true",
+            help="Drop the card indexes while loading and rebuild them at the "
+            "end, which is much faster for loads adding many cards",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        format = options["format"]
+        if format is None:
+            if path == "-":
+                raise CommandError("Pass --format when reading standard input")
+            format = "csv" if path.lower().endswith(".csv") else "json"
+
+        key = options["checkpoint"]
+        if key is None and path != "-":
+            digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+            key = f"import_cards:{digest[:32]}"
+
+        start = 0
+        if key is not None:
+            if options["restart"]:
+                ImportCheckpoint.objects.filter(key=key).delete()
+            else:
+                start = (
+                    ImportCheckpoint.objects.filter(key=key)
+                    .values_list("rows", flat=True)
+                    .first()
+                    or 0
+                )
+                if start:
+                    self.stdout.write(f"Resuming after row {start}")
+
+        try:
+            stream = (
+                sys.stdin
+                if path == "-"
+                else open(path, newline="", encoding="utf-8-sig")
+            )
+        except OSError as error:
+            raise CommandError(error)
+
+        self.verbosity = options["verbosity"]
+        self.owners = {}
+        self.counts = {"rows": start, "cards": 0, "skipped": 0}
+        self.started = self.reported = time.monotonic()
+        try:
+            rows = islice(enumerate(READERS[format](stream), 1), start, None)
+            with self.deferred_indexes(options["defer_indexes"]):
+                for batch in batches(rows, options["batch_size"]):
+                    self.load(batch, key, options["skip_invalid"])
+        except BadInput as error:
+            raise CommandError(
+                f"{error}; earlier batches were saved, rerun to resume once fixed"
+            )
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        if key is not None:
+            ImportCheckpoint.objects.filter(key=key).delete()
+        self.report()
+        self.stdout.write(self.style.SUCCESS("Import complete"))
+
+    def load(self, batch, key, skip_invalid):
+        """Insert one batch of (row number, row) and advance the checkpoint"""
+        parsed = []
+        for number, row in batch:
+            try:
+                parsed.append((number, *parse_row(row)))
+            except ValueError as error:
+                if not skip_invalid:
+                    raise BadInput(f"Row {number}: {error}")
+                self.counts["skipped"] += 1
+        self.resolve_owners({username for _, _, username, _ in parsed})
+
+        cards = []
+        for number, name, username, price in parsed:
+            owner_id = self.owners.get(username)
+            if owner_id is None:
+                if not skip_invalid:
+                    raise BadInput(f"Row {number}: no user named {username!r}")
+                self.counts["skipped"] += 1
+                continue
+            cards.append(Card(name=name, owner_id=owner_id, price=price))
+
+        with transaction.atomic():
+            Card.objects.bulk_create(cards)
+            if cards:
+                # bulk_create() bypasses the signals that normally do this
+                Card.record_created(cards)
+            if key is not None:
+                ImportCheckpoint.objects.update_or_create(
+                    key=key, defaults={"rows": batch[-1][0]}
+                )
+
+        self.counts["rows"] = batch[-1][0]
+        self.counts["cards"] += len(cards)
+        if time.monotonic() - self.reported >= PROGRESS_SECONDS:
+            self.report()
+
+    def resolve_owners(self, usernames):
+        missing = [username for username in usernames if username not in self.owners]
+        if len(self.owners) + len(missing) > MAX_CACHED_OWNERS:
+            self.owners.clear()
+            missing = list(usernames)
+        for chunk in batches(missing, OWNER_LOOKUP_BATCH):
+            self.owners.update(
+                CustomUser.objects.filter(username__in=chunk).values_list(
+                    "username", "pk"
+                )
+            )
+
+    def report(self):
+        self.reported = time.monotonic()
+        elapsed = self.reported - self.started
+        if self.verbosity:
+            self.stdout.write(
+                f"{self.counts['rows']} rows read, {self.counts['cards']} cards "
+                f"added, {self.counts['skipped']} skipped "
+                f"({self.counts['cards'] / elapsed if elapsed else 0:.0f} cards/s)"
+            )
+
+    @contextmanager
+    def deferred_indexes(self, enabled):
+        """Drop the indexes on apis_card for the duration, then rebuild them"""
+        if not enabled:
+            yield
+            return
+
+        self.drop_indexes()
+        try:
+            yield
+        finally:
+            self.stdout.write("Rebuilding card indexes")
+            self.create_indexes()
+
+    def existing_indexes(self):
+        with connection.cursor() as cursor:
+            return connection.introspection.get_constraints(
+                cursor, Card._meta.db_table
+            )
+
+    def drop_indexes(self):
+        existing = self.existing_indexes()
+        with connection.schema_editor() as editor:
+            for index in Card._meta.indexes:
+                if index.name in existing:
+                    editor.remove_index(Card, index)
+        search.suspend()
+
+    def create_indexes(self):
+        # Also repairs indexes left dropped by an import that was killed
+        existing = self.existing_indexes()
+        with connection.schema_editor() as editor:
+            for index in Card._meta.indexes:
+                if index.name not in existing:
+                    editor.add_index(Card, index)
+        search.resume()
@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from apis.matching import MatchingEngine, matching_settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Look for multi-party trades through every pending offer and execute "
+        "them. New offers are matched as they are made; this catches up "
+        "after imports, or with ON_CREATE turned off."
+    )
+
+    def add_arguments(self, parser):
+        options = matching_settings()
+        parser.add_argument(
+            "--max-length",
+            type=int,
+            default=options["MAX_CYCLE_LENGTH"],
+            help="Most offers in one trade (default: TRADE_MATCHING setting)",
+        )
+        parser.add_argument(
+            "--max-visits",
+            type=int,
+            default=options["MAX_VISITS"],
+            help="Cards one search may visit (default: TRADE_MATCHING setting)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the cycles found, without accepting any offers",
+        )
+
+    def handle(self, *args, **options):
+        engine = MatchingEngine(
+            max_cycle_length=options["max_length"],
+            max_visits=options["max_visits"],
+        )
+        started = time.perf_counter()
+        engine.load()
+        self.stdout.write(
+            f"Loaded {len(engine.graph)} pending offers in "
+            f"{time.perf_counter() - started:.2f}s"
+        )
+
+        started = time.perf_counter()
+        cycles = offers = 0
+        for cycle in engine.match_all(dry_run=options["dry_run"]):
+            cycles += 1
+            offers += len(cycle)
+            if options["verbosity"] > 1:
+                self.stdout.write(" -> ".join(str(offer_id) for offer_id in cycle))
+
+        verb = "Found" if options["dry_run"] else "Executed"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{verb} {cycles} trades of {offers} offers in "
+                f"{time.perf_counter() - started:.2f}s"
+            )
+        )
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from apis import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the card name search index from the apis_card table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database",
+            default="default",
+            help="Database alias to rebuild the index on (default: default)",
+        )
+
+    def handle(self, *args, **options):
+        if not search.rebuild(using=options["database"]):
+            raise CommandError(
+                "No search index on this database; name searches use icontains"
+            )
+        self.stdout.write(self.style.SUCCESS("Card search index rebuilt"))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from apis import ledger
+
+
+class Command(BaseCommand):
+    help = "Check that every user's ledger total matches their balance"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--fix",
+            action="store_true",
+            help="Record adjustment entries so the ledger matches the balances",
+        )
+
+    def handle(self, *args, **options):
+        # One transaction, so the ledger and balances are read at the same point
+        with transaction.atomic():
+            mismatches = ledger.reconcile()
+            for user_id, expected, actual in mismatches:
+                self.stdout.write(
+                    f"User {user_id}: ledger says {expected}, balance is {actual}"
+                )
+                if options["fix"]:
+                    ledger.adjust(user_id, actual - expected)
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("Ledger matches all balances"))
+        elif options["fix"]:
+            self.stdout.write(f"Recorded {len(mismatches)} adjustments")
+        else:
+            raise CommandError(f"{len(mismatches)} balances disagree with the ledger")
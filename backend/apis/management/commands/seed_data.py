@@ -0,0 +1,168 @@
+import random
+from itertools import accumulate, islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from apis import ledger
+from apis.models import Card, CustomUser, TradeOffer
+
+SPECIES = [
+    "Bulbasaur", "Charmander", "Squirtle", "Pikachu", "Jigglypuff", "Meowth",
+    "Psyduck", "Growlithe", "Abra", "Machop", "Geodude", "Gastly", "Onix",
+    "Cubone", "Magikarp", "Gyarados", "Lapras", "Ditto", "Eevee", "Snorlax",
+    "Dratini", "Dragonite", "Mewtwo", "Mew", "Charizard", "Blastoise",
+]
+SETS = ["Base Set", "Jungle", "Fossil", "Team Rocket", "Gym Heroes", "Neo Genesis"]
+VARIANTS = ["", "", "", " Holo", " Reverse Holo", " 1st Edition", " Shadowless"]
+
+# Trade offers are mostly still open; accepted ones would have moved cards
+OFFER_STATUSES = ["pending", "declined", "canceled"]
+OFFER_WEIGHTS = [70, 20, 10]
+
+BATCH_SIZE = 5000
+
+
+def batches(iterable, size=BATCH_SIZE):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate users, cards and trade offers for benchmarking. A few whale "
+        "accounts own most of the cards, and prices and balances are "
+        "heavy-tailed. Every generated user shares one password."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--cards", type=int, default=100_000)
+        parser.add_argument("--offers", type=int, default=10_000)
+        parser.add_argument(
+            "--whales",
+            type=float,
+            default=0.01,
+            help="Fraction of users who are whales (default: 0.01)",
+        )
+        parser.add_argument(
+            "--whale-share",
+            type=float,
+            default=0.8,
+            help="Fraction of cards the whales own between them (default: 0.8)",
+        )
+        parser.add_argument(
+            "--listed",
+            type=float,
+            default=0.3,
+            help="Fraction of cards on the marketplace (default: 0.3)",
+        )
+        parser.add_argument(
+            "--price-alpha",
+            type=float,
+            default=1.2,
+            help="Pareto shape of listed prices; lower is heavier-tailed (default: 1.2)",
+        )
+        parser.add_argument("--password", default="password")
+        parser.add_argument("--prefix", default="seed_", help="Username prefix")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--clear",
+            action="store_true",
+            help="Delete users with the prefix, and everything they own, first",
+        )
+
+    def handle(self, *args, **options):
+        prefix = options["prefix"]
+        existing = CustomUser.objects.filter(username__startswith=prefix)
+        if options["clear"]:
+            existing.delete()
+        elif existing.exists():
+            raise CommandError(
+                f"Users prefixed '{prefix}' already exist; pass --clear to replace them"
+            )
+        if options["users"] < 2:
+            raise CommandError("Need at least two users")
+
+        rng = random.Random(options["seed"])
+        users = self.create_users(rng, options)
+        self.stdout.write(f"{len(users)} users")
+        cards = self.create_cards(rng, users, options)
+        self.stdout.write(f"{len(cards)} cards")
+        offers = self.create_offers(rng, cards, options)
+        self.stdout.write(f"{offers} trade offers")
+        self.stdout.write(self.style.SUCCESS("Seeded"))
+
+    def create_users(self, rng, options):
+        # Hashing is deliberately slow, so every user shares one hash
+        password = make_password(options["password"])
+        whales = max(1, round(options["users"] * options["whales"]))
+        users = []
+        with transaction.atomic():
+            for i in range(options["users"]):
+                balance = int(rng.lognormvariate(6, 1.5))
+                users.append(
+                    CustomUser(
+                        username=f"{options['prefix']}{i}",
+                        password=password,
+                        # Whales come first, and spend like it
+                        account_balance=balance * 20 if i < whales else balance,
+                    )
+                )
+            users = CustomUser.objects.bulk_create(users, batch_size=BATCH_SIZE)
+            ledger.record_opening_balances(users)
+
+        self.whales = whales
+        return users
+
+    def create_cards(self, rng, users, options):
+        """Returns: list of (card id, owner id, price) for every card"""
+        whales, others = self.whales, len(users) - self.whales
+        share = options["whale_share"] if others else 1.0
+        weights = [share / whales] * whales + [(1 - share) / others] * others
+        cumulative = list(accumulate(weights))
+
+        def card(i):
+            price = -1
+            if rng.random() < options["listed"]:
+                price = min(int(rng.paretovariate(options["price_alpha"]) * 5), 1_000_000)
+            return Card(
+                name=f"{rng.choice(SPECIES)}{rng.choice(VARIANTS)} ({rng.choice(SETS)})",
+                owner=rng.choices(users, cum_weights=cumulative)[0],
+                price=price,
+            )
+
+        created = []
+        for batch in batches(card(i) for i in range(options["cards"])):
+            with transaction.atomic():
+                Card.objects.bulk_create(batch)
+                Card.record_created(batch)
+            created.extend((card.pk, card.owner_id, card.price) for card in batch)
+        return created
+
+    def create_offers(self, rng, cards, options):
+        unlisted = [(card_id, owner_id) for card_id, owner_id, price in cards if price < 0]
+        if len(unlisted) < 2:
+            return 0
+
+        def offers():
+            for _ in range(options["offers"]):
+                (sender_card, sender), (recipient_card, recipient) = rng.sample(unlisted, 2)
+                if sender != recipient:
+                    yield TradeOffer(
+                        sender_id=sender,
+                        recipient_id=recipient,
+                        sender_card_id=sender_card,
+                        recipient_card_id=recipient_card,
+                        status=rng.choices(OFFER_STATUSES, OFFER_WEIGHTS)[0],
+                    )
+
+        count = 0
+        for batch in batches(offers()):
+            with transaction.atomic():
+                TradeOffer.objects.bulk_create(batch)
+                TradeOffer.record_changes(batch)
+            count += len(batch)
+        return count
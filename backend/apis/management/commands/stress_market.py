@@ -0,0 +1,227 @@
+import multiprocessing
+import random
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from apis import ledger
+from apis.concurrency import ConcurrentUpdate, retry_on_conflict
+from apis.models import Card, CustomUser, TradeOffer
+from apis.views import CardMarketplaceView, CardPurchaseView, TradeOfferActionView
+
+USER_PREFIX = "stress_"
+
+factory = APIRequestFactory()
+purchase_view = CardPurchaseView.as_view()
+listing_view = CardMarketplaceView.as_view()
+trade_action_view = TradeOfferActionView.as_view()
+
+
+def post(view, user, data):
+    request = factory.post("/", data, format="json")
+    force_authenticate(request, user=user)
+    return view(request).status_code
+
+
+# The harness's own reads compete for locks too, so they are retried as well
+@retry_on_conflict
+def load_population():
+    users = list(CustomUser.objects.filter(username__startswith=USER_PREFIX))
+    card_ids = list(
+        Card.objects.filter(owner__in=users).values_list("id", flat=True)
+    )
+    offers = list(
+        TradeOffer.objects.filter(sender__in=users).values_list("id", "recipient_id")
+    )
+    return users, card_ids, offers
+
+
+@retry_on_conflict
+def current_owner(card_id):
+    return Card.objects.filter(pk=card_id).values_list("owner_id", flat=True).first()
+
+
+def run_operations(seed, count):
+    """
+    Fire `count` random purchases, listings and trade accepts through the views
+
+    Returns:
+        Counter: (operation, status code) -> number of responses
+    """
+    rng = random.Random(seed)
+    users, card_ids, offers = load_population()
+    users_by_id = {user.pk: user for user in users}
+    results = Counter()
+
+    try:
+        for _ in range(count):
+            roll = rng.random()
+            if roll < 0.6:
+                # Everyone piles onto a small set of cards to force contention
+                card_id = rng.choice(card_ids[: max(len(card_ids) // 10, 1)])
+                code = post(purchase_view, rng.choice(users), {"card_id": card_id})
+                results["purchase", code] += 1
+            elif roll < 0.85 or not offers:
+                # Put a card back on the market; only its owner will succeed
+                card_id = rng.choice(card_ids)
+                try:
+                    owner_id = current_owner(card_id)
+                except ConcurrentUpdate:
+                    # Counted like a request that lost the same race
+                    results["lookup", 409] += 1
+                    continue
+                user = users_by_id.get(owner_id, rng.choice(users))
+                data = {"card_id": card_id, "price": rng.randint(1, 50)}
+                results["list", post(listing_view, user, data)] += 1
+            else:
+                trade_id, recipient_id = rng.choice(offers)
+                data = {"trade_id": trade_id, "action": "accept"}
+                code = post(trade_action_view, users_by_id[recipient_id], data)
+                results["accept", code] += 1
+    finally:
+        connections.close_all()
+
+    return results
+
+
+def run_in_process(args):
+    return run_operations(*args)
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent purchases, listings and trade accepts at the views and "
+        "check that no credits or cards were created or destroyed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20)
+        parser.add_argument("--cards", type=int, default=200)
+        parser.add_argument("--offers", type=int, default=100)
+        parser.add_argument("--operations", type=int, default=2000)
+        parser.add_argument("--workers", type=int, default=16)
+        parser.add_argument(
+            "--processes",
+            action="store_true",
+            help="Run workers as separate processes instead of threads",
+        )
+        parser.add_argument(
+            "--throttle",
+            action="store_true",
+            help="Apply the THROTTLING rates, which are off by default so that "
+            "the workload measures contention",
+        )
+        parser.add_argument("--balance", type=int, default=1000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--keep", action="store_true", help="Leave the generated rows in place"
+        )
+
+    def handle(self, *args, **options):
+        if CustomUser.objects.filter(username__startswith=USER_PREFIX).exists():
+            raise CommandError(
+                f"Users prefixed '{USER_PREFIX}' already exist; remove them first"
+            )
+
+        rng = random.Random(options["seed"])
+        self.populate(rng, options)
+        credits_before, cards_before = self.totals()
+        results, elapsed = self.run_workload(options)
+        credits_after, cards_after = self.totals()
+
+        for (operation, code), count in sorted(results.items()):
+            self.stdout.write(f"{operation:>8} {code}: {count}")
+        self.stdout.write(
+            f"{sum(results.values())} operations in {elapsed:.2f}s, "
+            f"credits {credits_before} -> {credits_after}, "
+            f"cards {cards_before} -> {cards_after}"
+        )
+
+        mismatches = ledger.reconcile(
+            CustomUser.objects.filter(username__startswith=USER_PREFIX)
+        )
+        errors = sum(count for (_, code), count in results.items() if code >= 500)
+        if not options["keep"]:
+            CustomUser.objects.filter(username__startswith=USER_PREFIX).delete()
+
+        if credits_before != credits_after or cards_before != cards_after:
+            raise CommandError("Credits or cards were not conserved")
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} balances disagree with the ledger")
+        if errors:
+            raise CommandError(f"{errors} requests failed with a server error")
+        self.stdout.write(self.style.SUCCESS("Credits and cards conserved"))
+
+    def run_workload(self, options):
+        """
+        Returns:
+            tuple: (Counter of (operation, status code), seconds taken)
+        """
+        workers = options["workers"]
+        per_worker = options["operations"] // workers
+        jobs = [(options["seed"] + worker, per_worker) for worker in range(workers)]
+
+        throttling = {
+            **getattr(settings, "THROTTLING", {}),
+            "ENABLED": options.get("throttle", False),
+        }
+        with override_settings(THROTTLING=throttling):
+            return self.run_jobs(jobs, workers, options["processes"])
+
+    def run_jobs(self, jobs, workers, processes):
+        started = time.perf_counter()
+        if processes:
+            # Children must not inherit our open database connection
+            connections.close_all()
+            context = multiprocessing.get_context("fork")
+            with context.Pool(workers) as pool:
+                outcomes = pool.map(run_in_process, jobs)
+        else:
+            with ThreadPoolExecutor(workers) as pool:
+                outcomes = list(pool.map(run_in_process, jobs))
+        return sum(outcomes, Counter()), time.perf_counter() - started
+
+    def populate(self, rng, options):
+        users = CustomUser.objects.bulk_create(
+            CustomUser(
+                username=f"{USER_PREFIX}{i}", account_balance=options["balance"]
+            )
+            for i in range(options["users"])
+        )
+        ledger.record_opening_balances(users)
+        cards = Card.objects.bulk_create(
+            Card(
+                name=f"Stress card {i}",
+                owner=rng.choice(users),
+                # Half the cards start on the market, the rest can be traded
+                price=rng.randint(1, 50) if i % 2 else -1,
+            )
+            for i in range(options["cards"])
+        )
+
+        unlisted = [card for card in cards if card.price < 0]
+        offers = []
+        for _ in range(options["offers"]):
+            sender_card, recipient_card = rng.sample(unlisted, 2)
+            if sender_card.owner_id != recipient_card.owner_id:
+                offers.append(
+                    TradeOffer(
+                        sender_id=sender_card.owner_id,
+                        recipient_id=recipient_card.owner_id,
+                        sender_card=sender_card,
+                        recipient_card=recipient_card,
+                    )
+                )
+        TradeOffer.objects.bulk_create(offers)
+
+    def totals(self):
+        users = CustomUser.objects.filter(username__startswith=USER_PREFIX)
+        credits = sum(ledger.balance(user.pk) for user in users)
+        cards = Card.objects.filter(owner__in=users).count()
+        return credits, cards
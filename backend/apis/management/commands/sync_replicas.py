@@ -0,0 +1,64 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from apis.routing import replica_settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Copy the primary SQLite database over its SQLite read replicas, to "
+        "try READ_REPLICAS out locally. With --interval it keeps copying, "
+        "which gives the replicas a lag of up to that many seconds. Postgres "
+        "replicas are kept up to date by Postgres itself."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--database",
+            nargs="+",
+            help="Replica aliases to refresh (default: READ_REPLICAS['ALIASES'])",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Keep copying, waiting this many seconds between copies",
+        )
+
+    def handle(self, *args, **options):
+        aliases = options["database"] or replica_settings()["ALIASES"]
+        if not aliases:
+            raise CommandError("No replicas configured in READ_REPLICAS")
+        for alias in [DEFAULT_DB_ALIAS, *aliases]:
+            if alias not in connections:
+                raise CommandError(f"No database '{alias}' in DATABASES")
+            if connections[alias].vendor != "sqlite":
+                raise CommandError(f"'{alias}' is not a SQLite database")
+        if DEFAULT_DB_ALIAS in aliases:
+            raise CommandError("The primary can't be its own replica")
+
+        while True:
+            started = time.perf_counter()
+            for alias in aliases:
+                self.copy(alias)
+            self.stdout.write(
+                f"Copied to {', '.join(aliases)} in "
+                f"{time.perf_counter() - started:.2f}s"
+            )
+            if options["interval"] is None:
+                break
+            time.sleep(options["interval"])
+
+    def copy(self, alias):
+        primary = connections[DEFAULT_DB_ALIAS]
+        primary.ensure_connection()
+        # The replica's own connection would hold the file open
+        connections[alias].close()
+        target = sqlite3.connect(connections[alias].settings_dict["NAME"])
+        try:
+            # A consistent snapshot, even while the primary is being written
+            primary.connection.backup(target)
+        finally:
+            target.close()
@@ -0,0 +1,461 @@
+"""
+Multi-party trade matching
+
+A pending offer is an edge in a "wants" graph over cards, from the card its
+sender offers to the card they want. A cycle in that graph is a trade every
+sender has agreed to: each gives the card they offered and gets the card
+they asked for, if not always from the user they asked. Two users wanting
+each other's cards is the two-card case.
+
+WantsGraph holds every pending offer in memory. A cycle through a new
+offer u -> v needs a path from v back to u, so only the cards around those
+two are searched: breadth-first backwards from u and forwards from v, each
+for half the length limit, until the searches meet. A visit budget bounds
+the work around cards that thousands of offers involve, so the search
+finds a short cycle when there is one, not every cycle.
+
+MatchingEngine keeps its graph current from the change log, so offers
+accepted, declined or canceled by any process drop out of it, and executes
+the cycles it finds with TradeOffer.accept_cycle(). Offers whose cards
+have changed hands stay in the graph until a cycle through them is tried;
+that cancels them.
+
+New offers are matched off the request path. Once an offer commits it is
+handed to MatchingWorker, a thread per process that loads the graph when
+it starts, which wsgi.py and asgi.py do at startup, and then matches the
+offers queued for it, catching up with the change log once per batch.
+A process forked after startup, as under gunicorn --preload, inherits the
+worker but not its thread, and starts its own on the first offer.
+
+Settings (TRADE_MATCHING):
+    MAX_CYCLE_LENGTH: the most offers in one trade, default 4
+    MAX_VISITS: cards one search may visit, default 20000
+    ON_CREATE: look for a cycle whenever an offer is made, default True
+    BACKGROUND: match new offers in the worker thread, default True;
+        otherwise they are matched as their transaction commits, which the
+        tests rely on
+"""
+import logging
+import os
+import queue
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Min
+
+from . import changelog, events
+from .concurrency import ConcurrentUpdate, retry_on_conflict
+from .models import ChangeLogEntry, TradeOffer, batch_changes
+from .serializers import TradeOfferSerializer
+
+# Offers loaded per query when catching up
+SYNC_CHUNK_SIZE = 900
+# Cycles through one offer tried before giving up, each failure having
+# removed at least one stale offer from the graph
+MAX_ATTEMPTS = 5
+
+logger = logging.getLogger(__name__)
+
+
+def _breadth_first(start, neighbours, depth, budget, stop=None):
+    """
+    Returns:
+        dict: card -> (edges from `start`, the card before it on the way),
+            for every card within `depth` edges, as far as `budget` allows
+    """
+    reached = {start: (0, None)}
+    frontier = [start]
+    for distance in range(1, depth + 1):
+        next_frontier = []
+        for card in frontier:
+            if card == stop:
+                continue
+            for neighbour in neighbours.get(card, ()):
+                if neighbour in reached:
+                    continue
+                reached[neighbour] = (distance, card)
+                next_frontier.append(neighbour)
+                if len(reached) >= budget:
+                    return reached
+        frontier = next_frontier
+    return reached
+
+
+def _walk(reached, card):
+    """The cards from `card` back to the start of a _breadth_first search"""
+    path = []
+    while card is not None:
+        path.append(card)
+        card = reached[card][1]
+    return path
+
+
+class WantsGraph:
+    """Pending offers as edges from the offered card to the wanted card"""
+
+    def __init__(self):
+        # card -> {card: [offer ids]}; both directions share the lists
+        self._wants = defaultdict(dict)
+        self._wanted_by = defaultdict(dict)
+        # offer id -> (sender card, recipient card)
+        self._offers = {}
+
+    def __len__(self):
+        return len(self._offers)
+
+    def __contains__(self, offer_id):
+        return offer_id in self._offers
+
+    def add(self, offer_id, sender_card_id, recipient_card_id):
+        if offer_id in self._offers:
+            return
+        self._offers[offer_id] = (sender_card_id, recipient_card_id)
+        offers = self._wants[sender_card_id].get(recipient_card_id)
+        if offers is None:
+            offers = self._wants[sender_card_id][recipient_card_id] = []
+            self._wanted_by[recipient_card_id][sender_card_id] = offers
+        offers.append(offer_id)
+
+    def remove(self, offer_id):
+        edge = self._offers.pop(offer_id, None)
+        if edge is None:
+            return
+        sender_card_id, recipient_card_id = edge
+        offers = self._wants[sender_card_id][recipient_card_id]
+        offers.remove(offer_id)
+        if offers:
+            return
+        del self._wants[sender_card_id][recipient_card_id]
+        del self._wanted_by[recipient_card_id][sender_card_id]
+        if not self._wants[sender_card_id]:
+            del self._wants[sender_card_id]
+        if not self._wanted_by[recipient_card_id]:
+            del self._wanted_by[recipient_card_id]
+
+    def find_cycle(self, offer_id, max_length=4, max_visits=20_000):
+        """
+        Find a short cycle of offers through `offer_id`
+
+        Returns:
+            list: Offer ids starting with `offer_id`, each wanting the card
+                the next one offers, or None if the search found no cycle
+        """
+        start, end = self._offers[offer_id]
+        # The rest of the cycle is a path from `end` back to `start`
+        limit = max_length - 1
+        if limit < 1:
+            return None
+        budget = max(max_visits // 2, 1)
+        backward = _breadth_first(start, self._wanted_by, limit // 2, budget)
+        forward = _breadth_first(
+            end, self._wants, limit - limit // 2, budget, stop=start
+        )
+
+        meetings = sorted(
+            (forward[card][0] + backward[card][0], card)
+            for card in forward.keys() & backward.keys()
+            if forward[card][0] + backward[card][0] <= limit
+        )
+        for _, card in meetings:
+            # end ... card, then card ... start
+            path = _walk(forward, card)[::-1] + _walk(backward, card)[1:]
+            if len(set(path)) == len(path):
+                return [offer_id] + [
+                    self._wants[offered][wanted][0]
+                    for offered, wanted in zip(path, path[1:])
+                ]
+        return None
+
+    def offer_ids(self):
+        return list(self._offers)
+
+
+class MatchingEngine:
+    """Finds and executes cycles over this process's copy of the graph"""
+
+    def __init__(self, max_cycle_length=4, max_visits=20_000):
+        self.max_cycle_length = max_cycle_length
+        self.max_visits = max_visits
+        self.graph = WantsGraph()
+        # The change log entry the graph is current to; None until loaded
+        self.cursor = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Rebuild the graph from every pending offer"""
+        # Taken first, so offers changed during the load are replayed
+        cursor = changelog.current_cursor()
+        graph = WantsGraph()
+        pending = TradeOffer.objects.filter(status='pending').values_list(
+            "pk", "sender_card_id", "recipient_card_id"
+        )
+        for offer_id, sender_card_id, recipient_card_id in pending.iterator(
+            chunk_size=10_000
+        ):
+            graph.add(offer_id, sender_card_id, recipient_card_id)
+        self.graph, self.cursor = graph, cursor
+
+    def sync(self):
+        """Apply the trade offer changes logged since the graph was current"""
+        if self.cursor is None:
+            return self.load()
+        oldest = ChangeLogEntry.objects.aggregate(first=Min("id"))["first"]
+        # The entries we needed were compacted away
+        if oldest is not None and self.cursor < oldest - 1:
+            return self.load()
+
+        changed = set()
+        for entry_id, object_id in ChangeLogEntry.objects.filter(
+            id__gt=self.cursor, kind=ChangeLogEntry.TRADE
+        ).values_list("id", "object_id"):
+            changed.add(object_id)
+            self.cursor = max(self.cursor, entry_id)
+
+        changed = sorted(changed)
+        for i in range(0, len(changed), SYNC_CHUNK_SIZE):
+            chunk = changed[i:i + SYNC_CHUNK_SIZE]
+            found = set()
+            for offer_id, offer_status, sender_card_id, recipient_card_id in (
+                TradeOffer.objects.filter(pk__in=chunk).values_list(
+                    "pk", "status", "sender_card_id", "recipient_card_id"
+                )
+            ):
+                found.add(offer_id)
+                if offer_status == 'pending':
+                    self.graph.add(offer_id, sender_card_id, recipient_card_id)
+                else:
+                    self.graph.remove(offer_id)
+            for offer_id in set(chunk) - found:
+                self.graph.remove(offer_id)
+
+    def match(self, offer_id):
+        """
+        Look for a cycle through a pending offer and execute it
+
+        Returns:
+            list: The accepted offers, or None if there was no cycle to execute
+        """
+        with self._lock:
+            self.sync()
+            return self._match(offer_id)
+
+    def match_many(self, offer_ids):
+        """
+        match() each of `offer_ids`, catching up with the change log once
+
+        Returns:
+            list: What match() returned for each offer
+        """
+        with self._lock:
+            self.sync()
+            return [self._match(offer_id) for offer_id in offer_ids]
+
+    def _match(self, offer_id):
+        for _ in range(MAX_ATTEMPTS):
+            if offer_id not in self.graph:
+                return None
+            cycle = self.graph.find_cycle(
+                offer_id, self.max_cycle_length, self.max_visits
+            )
+            if cycle is None:
+                return None
+            accepted = self.execute(cycle)
+            if accepted:
+                return accepted
+        return None
+
+    def match_all(self, dry_run=False):
+        """
+        Look for a cycle through every pending offer, oldest first
+
+        Yields:
+            list: The offers of each cycle executed, or only found when
+                `dry_run` is set
+        """
+        with self._lock:
+            self.sync()
+            for offer_id in self.graph.offer_ids():
+                if offer_id not in self.graph:
+                    continue
+                cycle = self.graph.find_cycle(
+                    offer_id, self.max_cycle_length, self.max_visits
+                )
+                if cycle is None:
+                    continue
+                if dry_run:
+                    # Found cycles don't share offers
+                    for member in cycle:
+                        self.graph.remove(member)
+                    yield cycle
+                    continue
+                accepted = self.execute(cycle)
+                if accepted:
+                    yield [offer.pk for offer in accepted]
+            if dry_run:
+                # The graph no longer matches the database
+                self.cursor = None
+
+    def execute(self, cycle):
+        """
+        Accept the offers of a cycle together
+
+        Offers that turn out not to be pending, or whose cards changed
+        hands, are dropped from the graph.
+
+        Returns:
+            list: The accepted offers, or None if the cycle fell through
+        """
+        offers = TradeOffer.objects.select_related("sender").in_bulk(cycle)
+        missing = [offer_id for offer_id in cycle if offer_id not in offers]
+        if missing:
+            for offer_id in missing:
+                self.graph.remove(offer_id)
+            return None
+
+        ordered = [offers[offer_id] for offer_id in cycle]
+        try:
+            stale = _accept_cycle(ordered)
+        except ConcurrentUpdate:
+            return None
+        if stale:
+            for offer in stale:
+                self.graph.remove(offer.pk)
+            return None
+
+        for offer in ordered:
+            self.graph.remove(offer.pk)
+            events.publish(
+                "trade.accepted",
+                users=[offer.sender_id, offer.recipient_id],
+                trade=TradeOfferSerializer(offer).data,
+                cycle=cycle,
+            )
+        return ordered
+
+
+@retry_on_conflict
+@batch_changes()
+def _accept_cycle(offers):
+    return TradeOffer.accept_cycle(offers)
+
+
+class MatchingWorker:
+    """A thread matching the offers submitted to it, oldest first"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        # Threads don't survive a fork, only this object does
+        self.pid = os.getpid()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, name="trade-matching", daemon=True
+        )
+        self._thread.start()
+
+    def running(self):
+        return self.pid == os.getpid() and self._thread.is_alive()
+
+    def submit(self, offer_id):
+        self._queue.put(offer_id)
+
+    def stop(self):
+        """Exit once the offers submitted so far are matched"""
+        self._queue.put(None)
+
+    def _run(self):
+        # Load the graph before any offer is waiting on it
+        self._guarded(self.engine.match_many, [])
+        stopping = False
+        while not stopping:
+            offer_ids = [self._queue.get()]
+            # Offers made while the last batch ran share one sync
+            while True:
+                try:
+                    offer_ids.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in offer_ids
+            offer_ids = [offer_id for offer_id in offer_ids if offer_id is not None]
+            if offer_ids:
+                self._guarded(self.engine.match_many, offer_ids)
+
+    def _guarded(self, work, *args):
+        try:
+            work(*args)
+        except Exception:
+            logger.exception("Trade matching failed")
+            # Reloaded before the next batch, in case it failed half applied
+            self.engine.cursor = None
+        finally:
+            close_old_connections()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def matching_settings():
+    options = getattr(settings, "TRADE_MATCHING", {})
+    return {
+        "MAX_CYCLE_LENGTH": options.get("MAX_CYCLE_LENGTH", 4),
+        "MAX_VISITS": options.get("MAX_VISITS", 20_000),
+        "ON_CREATE": options.get("ON_CREATE", True),
+        "BACKGROUND": options.get("BACKGROUND", True),
+    }
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                options = matching_settings()
+                _engine = MatchingEngine(
+                    max_cycle_length=options["MAX_CYCLE_LENGTH"],
+                    max_visits=options["MAX_VISITS"],
+                )
+    return _engine
+
+
+def get_worker():
+    """The worker of this process, started anew if its thread is gone"""
+    global _engine, _worker
+    worker = _worker
+    if worker is None or not worker.running():
+        with _worker_lock:
+            if _worker is None or not _worker.running():
+                if _worker is not None:
+                    logger.warning("Trade matching thread not running, starting one")
+                    if _worker.pid != os.getpid():
+                        # Forked while the parent's thread may have held its lock
+                        _engine = None
+                _worker = MatchingWorker(get_engine())
+            worker = _worker
+    return worker
+
+
+def start():
+    """Start the worker, so the graph is loaded before the first offer comes"""
+    options = matching_settings()
+    if options["ON_CREATE"] and options["BACKGROUND"]:
+        get_worker()
+
+
+def offer_created(offer):
+    """
+    Complete a multi-party trade if a new offer closes a cycle
+
+    The offer is matched once the current transaction commits; in the
+    worker thread, unless BACKGROUND is off.
+    """
+    options = matching_settings()
+    if not options["ON_CREATE"]:
+        return
+    if options["BACKGROUND"]:
+        transaction.on_commit(lambda: get_worker().submit(offer.pk))
+    else:
+        transaction.on_commit(lambda: get_engine().match(offer.pk))
@@ -0,0 +1,397 @@
+"""
+Prometheus metrics
+
+MetricsMiddleware records every request's latency, and the database time
+and query count QueryInstrumentationMiddleware measured for it, in
+histograms labelled by route name ("card-purchase", "cards-list", ...).
+Business events are counted from the event stream as they commit (see
+apis/events.py): purchases, the credits they paid and accepted trade
+offers. /api/metrics/ serves it all in the Prometheus text format.
+
+Recording takes no lock. Every thread adds to a shard of its own, and
+collecting sums the shards; the shards of threads that have exited are
+folded into one, so servers that start a thread per request don't pile
+them up.
+
+With several worker processes, set MULTIPROCESS_DIR to a directory they
+share. Each process writes its totals there at most every FLUSH_INTERVAL
+seconds, after a request, and when it exits; the endpoint adds up every
+file. The files of exited processes are kept, so counts never go down
+when a worker is replaced. Empty the directory when deploying, as with
+prometheus_client's multiprocess mode.
+
+Settings (METRICS):
+    ENABLED: record metrics, default True
+    MULTIPROCESS_DIR: directory shared by the worker processes, default
+        None (each process serves only its own numbers)
+    FLUSH_INTERVAL: seconds between writes to that directory, default 5
+    TOKEN: a secret scrapers send as "Authorization: Bearer <token>";
+        without one, only staff can read the metrics (see MetricsView)
+"""
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def metrics_settings():
+    options = getattr(settings, "METRICS", {})
+    return {
+        "ENABLED": options.get("ENABLED", True),
+        "MULTIPROCESS_DIR": options.get("MULTIPROCESS_DIR"),
+        "FLUSH_INTERVAL": options.get("FLUSH_INTERVAL", 5),
+        "TOKEN": options.get("TOKEN"),
+    }
+
+
+class Registry:
+    """The metrics of this process, and the per-thread shards holding their values"""
+
+    def __init__(self):
+        self.metrics = {}
+        self._local = threading.local()
+        # (thread, shard) for every thread that has recorded something
+        self._shards = []
+        # Everything recorded by threads that have since exited
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def shard(self):
+        """
+        Returns:
+            dict: (metric name, label values) -> values, written only by
+                the current thread
+        """
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def collect(self):
+        """
+        Returns:
+            dict: (metric name, label values) -> values, summed over threads
+        """
+        totals = {}
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    # Nothing writes to it any more
+                    _merge(self._retired, shard.items())
+            self._shards = alive
+            _merge(totals, self._retired.items())
+            for _, shard in alive:
+                # Copied in one step, since its thread may add keys meanwhile
+                _merge(totals, list(shard.items()))
+        return totals
+
+    def clear(self):
+        with self._lock:
+            for _, shard in self._shards:
+                shard.clear()
+            self._retired.clear()
+
+
+def _merge(totals, items):
+    for key, values in items:
+        current = totals.get(key)
+        if current is None:
+            totals[key] = list(values)
+        else:
+            for i, value in enumerate(values):
+                current[i] += value
+
+
+registry = Registry()
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        if not metrics_settings()["ENABLED"]:
+            return
+        shard = registry.shard()
+        key = (self.name, tuple(str(labels[label]) for label in self.labels))
+        values = shard.get(key)
+        if values is None:
+            shard[key] = [amount]
+        else:
+            values[0] += amount
+
+    def expose(self, series):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for label_values, values in series:
+            lines.append(
+                f"{self.name}{_labels(self.labels, label_values)} {_number(values[0])}"
+            )
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        if not metrics_settings()["ENABLED"]:
+            return
+        shard = registry.shard()
+        key = (self.name, tuple(str(labels[label]) for label in self.labels))
+        values = shard.get(key)
+        if values is None:
+            # A count per bucket and one for +Inf, then the sum
+            values = shard[key] = [0] * (len(self.buckets) + 2)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def expose(self, series):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for label_values, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                labels = _labels(
+                    self.labels + ("le",), label_values + (_number(bound),)
+                )
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_number(values[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUESTS = Counter(
+    "poketrade_http_requests_total",
+    "Requests served, by route, method and status code",
+    labels=("route", "method", "status"),
+)
+REQUEST_LATENCY = Histogram(
+    "poketrade_http_request_duration_seconds",
+    "Time taken to serve a request",
+    labels=("route", "method"),
+)
+REQUEST_DB_TIME = Histogram(
+    "poketrade_http_request_db_seconds",
+    "Time a request spent in the database",
+    labels=("route", "method"),
+)
+REQUEST_QUERIES = Histogram(
+    "poketrade_http_request_queries",
+    "Queries a request ran",
+    labels=("route", "method"),
+    buckets=QUERY_BUCKETS,
+)
+PURCHASES = Counter("poketrade_purchases_total", "Cards bought on the marketplace")
+TRADES_ACCEPTED = Counter(
+    "poketrade_trades_accepted_total",
+    "Trade offers accepted, one per offer of a multi-party trade",
+)
+CREDITS_MOVED = Counter(
+    "poketrade_credits_moved_total", "Credits paid from buyers to sellers"
+)
+EVENTS = Counter(
+    "poketrade_events_total", "Events published to the event stream", labels=("type",)
+)
+
+# The counters business events feed, by event type
+EVENT_COUNTERS = {
+    "card.sold": PURCHASES,
+    "trade.accepted": TRADES_ACCEPTED,
+}
+
+
+def record_event(event):
+    """Count an event that has been committed"""
+    EVENTS.inc(type=event["type"])
+    counter = EVENT_COUNTERS.get(event["type"])
+    if counter is not None:
+        counter.inc()
+    if event["type"] == "card.sold":
+        CREDITS_MOVED.inc(event["price"])
+
+
+def route_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None or not match.url_name:
+        return "unmatched"
+    return match.url_name
+
+
+def record_request(request, response, duration):
+    method = request.method
+    route = route_name(request)
+    REQUESTS.inc(route=route, method=method, status=response.status_code)
+    REQUEST_LATENCY.observe(duration, route=route, method=method)
+    collector = getattr(request, "query_collector", None)
+    if collector is not None:
+        REQUEST_DB_TIME.observe(collector.duration, route=route, method=method)
+        REQUEST_QUERIES.observe(collector.count, route=route, method=method)
+
+
+class MetricsMiddleware:
+    """
+    Record each request in the histograms
+
+    Must come before QueryInstrumentationMiddleware, whose numbers it reads.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        started = time.perf_counter()
+        response = self.get_response(request)
+        self.record(request, response, started)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.record(request, response, started)
+        return response
+
+    def record(self, request, response, started):
+        if not metrics_settings()["ENABLED"]:
+            return
+        record_request(request, response, time.perf_counter() - started)
+        maybe_flush()
+
+
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+
+
+def _snapshot_path(directory, pid=None):
+    return os.path.join(directory, f"metrics-{pid or os.getpid()}.json")
+
+
+def flush():
+    """Write this process's totals to MULTIPROCESS_DIR, if there is one"""
+    global _last_flush
+    directory = metrics_settings()["MULTIPROCESS_DIR"]
+    if not directory:
+        return
+    with _flush_lock:
+        _last_flush = time.monotonic()
+        snapshot = [
+            [name, list(label_values), values]
+            for (name, label_values), values in registry.collect().items()
+        ]
+        path = _snapshot_path(directory)
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(snapshot, file)
+        # Readers see the old file or the new one, never half of one
+        os.replace(temporary, path)
+
+
+def maybe_flush():
+    options = metrics_settings()
+    if (
+        options["MULTIPROCESS_DIR"]
+        and time.monotonic() - _last_flush >= options["FLUSH_INTERVAL"]
+    ):
+        flush()
+
+
+atexit.register(flush)
+
+
+def collect():
+    """
+    Returns:
+        dict: (metric name, label values) -> values, over every process
+            in MULTIPROCESS_DIR, or only this one without it
+    """
+    directory = metrics_settings()["MULTIPROCESS_DIR"]
+    if not directory:
+        return registry.collect()
+
+    flush()
+    totals = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.startswith("metrics-") or not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            # Removed, or replaced, since it was listed
+            continue
+        _merge(
+            totals,
+            (((name, tuple(label_values)), values) for name, label_values, values in snapshot),
+        )
+    return totals
+
+
+def render():
+    """The metrics in the Prometheus text format"""
+    series = {}
+    for (name, label_values), values in sorted(collect().items()):
+        series.setdefault(name, []).append((label_values, values))
+    lines = []
+    for name, metric in registry.metrics.items():
+        lines.extend(metric.expose(series.get(name, [])))
+    return "\n".join(lines) + "\n"
+
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0003_alter_card_owner_tradeoffer'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(condition=models.Q(('price__gte', 0)), fields=['price', 'id'], name='card_listed_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(condition=models.Q(('price__gte', 0)), fields=['id'], name='card_listed_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(fields=['owner', 'price'], name='card_owner_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradeoffer',
+            index=models.Index(fields=['sender', 'status', '-created_at'], name='trade_sender_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tradeoffer',
+            index=models.Index(fields=['recipient', 'status', '-created_at'], name='trade_recipient_status_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE apis_card_search USING fts5(
+        name, content='apis_card', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER apis_card_search_insert AFTER INSERT ON apis_card BEGIN
+        INSERT INTO apis_card_search(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER apis_card_search_delete AFTER DELETE ON apis_card BEGIN
+        INSERT INTO apis_card_search(apis_card_search, rowid, name)
+        VALUES ('delete', old.id, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER apis_card_search_update AFTER UPDATE OF name ON apis_card BEGIN
+        INSERT INTO apis_card_search(apis_card_search, rowid, name)
+        VALUES ('delete', old.id, old.name);
+        INSERT INTO apis_card_search(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    "INSERT INTO apis_card_search(apis_card_search) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS apis_card_search_update",
+    "DROP TRIGGER IF EXISTS apis_card_search_delete",
+    "DROP TRIGGER IF EXISTS apis_card_search_insert",
+    "DROP TABLE IF EXISTS apis_card_search",
+]
+
+# Matches the UPPER(name) LIKE UPPER(%s) that name__icontains compiles to
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX card_name_trgm_idx ON apis_card USING gin (UPPER(name) gin_trgm_ops)",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS card_name_trgm_idx",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for statement in statements.get(vendor, []):
+            schema_editor.execute(statement)
+
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0004_card_tradeoffer_access_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({"sqlite": SQLITE_FORWARD, "postgresql": POSTGRES_FORWARD}),
+            run({"sqlite": SQLITE_BACKWARD, "postgresql": POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:37
+
+from django.db import migrations, models
+
+# The search triggers as 0005 created them
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS apis_card_search_insert AFTER INSERT ON apis_card BEGIN
+        INSERT INTO apis_card_search(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS apis_card_search_delete AFTER DELETE ON apis_card BEGIN
+        INSERT INTO apis_card_search(apis_card_search, rowid, name)
+        VALUES ('delete', old.id, old.name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS apis_card_search_update AFTER UPDATE OF name ON apis_card BEGIN
+        INSERT INTO apis_card_search(apis_card_search, rowid, name)
+        VALUES ('delete', old.id, old.name);
+        INSERT INTO apis_card_search(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    "INSERT INTO apis_card_search(apis_card_search) VALUES ('rebuild')",
+]
+
+
+def install_triggers(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for statement in SQLITE_TRIGGERS:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0005_card_name_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='card',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        # Adding a column rebuilds apis_card on SQLite, dropping the search triggers
+        migrations.RunPython(install_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def record_opening_balances(apps, schema_editor):
+    """Seed the ledger with every existing balance so it reconciles from day one"""
+    CustomUser = apps.get_model('apis', 'CustomUser')
+    LedgerEntry = apps.get_model('apis', 'LedgerEntry')
+    LedgerEntry.objects.bulk_create(
+        LedgerEntry(user_id=user_id, amount=balance, kind='opening')
+        for user_id, balance in CustomUser.objects.exclude(account_balance=0)
+        .values_list('id', 'account_balance')
+        .iterator()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0006_card_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='balance_snapshot', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('balance', models.IntegerField()),
+                ('last_entry_id', models.BigIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BalanceShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('amount', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balance_shards', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'shard'), name='balance_shard_unique')],
+            },
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField()),
+                ('kind', models.CharField(choices=[('opening', 'Opening balance'), ('purchase', 'Purchase'), ('sale', 'Sale'), ('adjustment', 'Adjustment')], max_length=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('card', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='apis.card')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='ledger_user_idx')],
+            },
+        ),
+        migrations.RunPython(record_opening_balances, migrations.RunPython.noop),
+    ]
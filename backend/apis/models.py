@@ -1,5 +1,18 @@
-from django.db import models
+import random
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.constants import OnConflict
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+from . import events
+from .concurrency import ConcurrentUpdate
 
 class CustomUser(AbstractUser):
     account_balance = models.IntegerField(default=0)
@@ -7,6 +20,42 @@ class CustomUser(AbstractUser):
     def __str__(self):
         return self.username
 
+    @classmethod
+    def debit(cls, user_id, amount):
+        """
+        Take `amount` credits from a user, if their balance covers it
+
+        The balance check and the write are one conditional UPDATE that only
+        touches account_balance, so concurrent debits can never overdraw.
+        This does not record anything; go through apis.ledger instead.
+
+        Returns:
+            bool: False if the balance was too low, nothing is written then
+        """
+        return bool(
+            cls.objects.filter(pk=user_id, account_balance__gte=amount).update(
+                account_balance=F("account_balance") - amount
+            )
+        )
+
+    @classmethod
+    def credit(cls, user_id, amount):
+        """
+        Add `amount` credits to a user's balance in a single UPDATE
+
+        Like debit, this bypasses the ledger; use apis.ledger.credit instead.
+        """
+        cls.objects.filter(pk=user_id).update(
+            account_balance=F("account_balance") + amount
+        )
+
+    @classmethod
+    def balance_of(cls, user_id):
+        """Read a user's current balance straight from the database"""
+        return cls.objects.filter(pk=user_id).values_list(
+            "account_balance", flat=True
+        ).get()
+
 
 # Create your models here.
 class TestModel(models.Model):
@@ -24,6 +73,26 @@ class Card(models.Model):
 
     # -1 denotes it's not for sale
     price = models.IntegerField()
+
+    # Bumped on every ownership or price change, for optimistic locking
+    version = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Marketplace pages, sorted by price or newest first
+            models.Index(
+                fields=["price", "id"],
+                condition=models.Q(price__gte=0),
+                name="card_listed_price_idx",
+            ),
+            models.Index(
+                fields=["id"],
+                condition=models.Q(price__gte=0),
+                name="card_listed_id_idx",
+            ),
+            # A user's cards, split into listed and unlisted
+            models.Index(fields=["owner", "price"], name="card_owner_price_idx"),
+        ]
     
     def transfer_to(self, new_owner):
         """
@@ -34,11 +103,106 @@ class Card(models.Model):
         
         Returns:
             bool: True if transfer was successful
+
+        Raises:
+            ConcurrentUpdate: If the card changed since it was loaded
         """
-        self.owner = new_owner
-        self.save()
+        self.update_versioned(owner=new_owner)
         return True
 
+    def update_versioned(self, **fields):
+        """
+        Write `fields` only if the row still has the version we loaded
+
+        Args:
+            **fields: Column values to set, e.g. owner=user, price=-1
+
+        Raises:
+            ConcurrentUpdate: If someone else changed the card in the meantime
+        """
+        updated = Card.objects.filter(pk=self.pk, version=self.version).update(
+            version=F("version") + 1, **fields
+        )
+        if not updated:
+            raise ConcurrentUpdate(f"Card {self.pk} was modified concurrently")
+
+        previous_owner_id, was_listed = self.owner_id, self.price >= 0
+        self.version += 1
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.record_change(
+            {previous_owner_id, self.owner_id}, listed=was_listed or self.price >= 0
+        )
+
+    @classmethod
+    def update_owners(cls, cards, owner_ids):
+        """
+        update_versioned(owner_id=..., price=-1) for many cards in one UPDATE
+
+        Args:
+            cards (dict): Card id -> the card as loaded
+            owner_ids (dict): Card id -> the id of its new owner
+
+        Raises:
+            ConcurrentUpdate: If any of the cards changed since it was loaded
+        """
+        moving = [cards[pk] for pk in owner_ids]
+        if not moving:
+            return
+        # CASEs rather than one OR per card, which SQLite would nest too deep
+        updated = cls.objects.filter(
+            pk__in=owner_ids,
+            version=Case(*(When(pk=card.pk, then=Value(card.version)) for card in moving)),
+        ).update(
+            owner_id=Case(
+                *(When(pk=pk, then=Value(owner_id)) for pk, owner_id in owner_ids.items())
+            ),
+            price=-1,
+            version=F("version") + 1,
+        )
+        if updated < len(moving):
+            raise ConcurrentUpdate("A card was modified concurrently")
+
+        for card in moving:
+            previous_owner_id, was_listed = card.owner_id, card.price >= 0
+            card.owner_id = owner_ids[card.pk]
+            card.price = -1
+            card.version += 1
+            card.record_change({previous_owner_id, card.owner_id}, listed=was_listed)
+
+    def record_change(self, owner_ids, listed):
+        """
+        Invalidate cached collections and log the change for delta sync
+
+        Args:
+            owner_ids (set): Every user who owned the card before or after
+            listed (bool): Whether the card was for sale before or after
+        """
+        Generation.cards_changed(owner_ids, listed)
+        ChangeLogEntry.record(ChangeLogEntry.CARD, self.pk, owner_ids)
+
+    @classmethod
+    def record_created(cls, cards):
+        """
+        record_change() for cards inserted with bulk_create(), which sends
+        no signals; one bump however many cards there are
+        """
+        Generation.cards_changed(
+            {card.owner_id for card in cards}, any(card.price >= 0 for card in cards)
+        )
+        ChangeLogEntry.record_many(
+            ChangeLogEntry.CARD, ((card.pk, card.owner_id) for card in cards)
+        )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        card = super().from_db(db, field_names, values)
+        # Remembered so a save() moving the card can invalidate the old owner,
+        # and the marketplace if the card was listed
+        card._loaded_owner_id = card.__dict__.get("owner_id")
+        card._loaded_price = card.__dict__.get("price")
+        return card
+
     def __str__(self):
         return self.name
 
@@ -50,6 +214,7 @@ class TradeOffer(models.Model):
         ('declined', 'Declined'),
         ('canceled', 'Canceled'),
     ]
+    SETTLED = ('accepted', 'declined', 'canceled')
     
     # The user who initiated the trade offer
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="sent_offers")
@@ -69,59 +234,717 @@ class TradeOffer(models.Model):
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # A user's offers, optionally by status, newest first
+            models.Index(
+                fields=["sender", "status", "-created_at"],
+                name="trade_sender_status_idx",
+            ),
+            models.Index(
+                fields=["recipient", "status", "-created_at"],
+                name="trade_recipient_status_idx",
+            ),
+        ]
     
+    @staticmethod
+    def settled_horizon():
+        """
+        Offers settled before this are history: out of the trade list, and
+        moved to ArchivedTradeOffer by archive_trades
+
+        The horizon is local midnight TRADE_HISTORY_DAYS ago, so it only
+        moves once a day.
+        """
+        days = getattr(settings, "TRADE_HISTORY_DAYS", 30)
+        day = timezone.localdate() - timedelta(days=days)
+        return timezone.make_aware(datetime.combine(day, time.min))
+
     def __str__(self):
         return f"Trade: {self.sender.username}'s {self.sender_card.name} for {self.recipient.username}'s {self.recipient_card.name}"
     
-    def accept(self):
-        """Execute the trade by swapping card ownership"""
-        if self.status != 'pending':
+    def accept(self, cards=None):
+        """
+        Execute the trade by swapping card ownership
+
+        Must run inside a transaction. The offer and both cards are locked and
+        re-read, so the checks below see the current owners. A caller that
+        has already locked the cards, as _lock_cards() does, passes them in
+        `cards` to save the query.
+
+        Every other pending offer for either card is canceled with it; how
+        many is left in self.canceled_offers.
+
+        Raises:
+            ConcurrentUpdate: If a card changed hands while the swap ran
+        """
+        self.canceled_offers = 0
+        if not self._transition('accepted'):
             return False
-        
-        # Store references to avoid confusion during the swap
-        sender = self.sender
-        recipient = self.recipient
-        sender_card = self.sender_card
-        recipient_card = self.recipient_card
-        
+
+        if cards is None:
+            cards = self._lock_cards([self])
         # Check if the cards are still owned by the original users
-        if sender_card.owner != sender or recipient_card.owner != recipient:
-            self.status = 'canceled'
-            self.save()
+        if not self._cards_still_owned(cards):
+            self._cancel_stale()
             return False
-            
-        # Execute the swap
-        sender_card.owner = recipient
-        recipient_card.owner = sender
-        
-        # Cards coming from a trade should not be for sale
-        sender_card.price = -1
-        recipient_card.price = -1
-        
-        # Save the changes
-        sender_card.save()
-        recipient_card.save()
-        
-        # Update trade status
-        self.status = 'accepted'
-        self.save()
-        
+
+        # Execute the swap; cards coming from a trade should not be for sale
+        sender_card = cards[self.sender_card_id]
+        recipient_card = cards[self.recipient_card_id]
+        sender_card.update_versioned(owner_id=self.recipient_id, price=-1)
+        recipient_card.update_versioned(owner_id=self.sender_id, price=-1)
+        self.sender_card = sender_card
+        self.recipient_card = recipient_card
+        # Only this offer's cards: `cards` may hold those of other offers too
+        self.canceled_offers = len(
+            TradeOffer.cancel_pending([self.sender_card_id, self.recipient_card_id])
+        )
+
         return True
+
+    @classmethod
+    def accept_many(cls, offers, cards):
+        """
+        accept() for many offers at once, with a statement per step instead
+        of per offer
+
+        Must run inside a transaction, with `offers` locked and their cards
+        locked by _lock_cards() and passed in `cards`. Offers are taken in id
+        order: one whose card an earlier offer in the batch has just traded
+        is left to be canceled with the other pending offers for the traded
+        cards, and one whose cards changed hands before is canceled as
+        accept() does.
+
+        Returns:
+            list: The offers that were accepted
+
+        Raises:
+            ConcurrentUpdate: If a card changed hands while the swap ran
+        """
+        accepted, stale, owner_ids = [], [], {}
+        for offer in sorted(offers, key=lambda offer: offer.pk):
+            offer.canceled_offers = 0
+            if offer.status != 'pending':
+                continue
+            if {offer.sender_card_id, offer.recipient_card_id} & owner_ids.keys():
+                continue
+            if not offer._cards_still_owned(cards):
+                stale.append(offer)
+                continue
+            owner_ids[offer.sender_card_id] = offer.recipient_id
+            owner_ids[offer.recipient_card_id] = offer.sender_id
+            accepted.append(offer)
+
+        cls.publish_canceled(cls.transition_many(stale, 'canceled'))
+        cls.transition_many(accepted, 'accepted')
+        Card.update_owners(cards, owner_ids)
+        canceled = cls.cancel_pending(owner_ids)
+        for offer in accepted:
+            offer.sender_card = cards[offer.sender_card_id]
+            offer.recipient_card = cards[offer.recipient_card_id]
+            own_cards = {offer.sender_card_id, offer.recipient_card_id}
+            offer.canceled_offers = sum(
+                1 for other in canceled
+                if {other.sender_card_id, other.recipient_card_id} & own_cards
+            )
+        return accepted
+
+    @classmethod
+    def accept_cycle(cls, offers):
+        """
+        Execute offers that form a cycle as one multi-party trade
+
+        Each offer's recipient card must be the next offer's sender card,
+        and the last offer's recipient card the first offer's sender card.
+        Every sender then gives the card they offered to the sender of the
+        previous offer, and gets the card they asked for.
+
+        Must run inside a transaction. Offers and cards are locked and re-read,
+        and the same ownership checks as accept() apply to every offer.
+
+        Returns:
+            list: The offers that stopped the cycle, canceled if their cards
+                changed hands; empty if the cycle was executed
+
+        Raises:
+            ValueError: If the offers don't form a cycle
+            ConcurrentUpdate: If a card changed hands while the trade ran
+        """
+        if len({offer.sender_card_id for offer in offers}) < len(offers):
+            raise ValueError("A card can only be traded once in a cycle")
+        for offer, following in zip(offers, offers[1:] + offers[:1]):
+            if offer.recipient_card_id != following.sender_card_id:
+                raise ValueError(f"Trade offer {offer.pk} is not followed by its card")
+
+        pending = set(
+            TradeOffer.objects.select_for_update()
+            .filter(pk__in=[offer.pk for offer in offers], status='pending')
+            .order_by('pk')
+            .values_list('pk', flat=True)
+        )
+        if len(pending) < len(offers):
+            return [offer for offer in offers if offer.pk not in pending]
+
+        cards = cls._lock_cards(offers)
+        stale = [offer for offer in offers if not offer._cards_still_owned(cards)]
+        for offer in stale:
+            offer._cancel_stale()
+        if stale:
+            return stale
+
+        # One statement for every offer; all of them are locked and pending
+        updated_at = timezone.now()
+        TradeOffer.objects.filter(pk__in=[offer.pk for offer in offers]).update(
+            status='accepted', updated_at=updated_at
+        )
+        cls.record_changes(offers)
+        for offer in offers:
+            offer.status = 'accepted'
+            offer.updated_at = updated_at
+        for offer in offers:
+            # Cards coming from a trade should not be for sale
+            cards[offer.recipient_card_id].update_versioned(
+                owner_id=offer.sender_id, price=-1
+            )
+        for offer in offers:
+            offer.sender_card = cards[offer.sender_card_id]
+            offer.recipient_card = cards[offer.recipient_card_id]
+        cls.cancel_pending(cards.keys())
+        return []
+
+    @classmethod
+    def cancel_pending(cls, card_ids):
+        """
+        Cancel every pending offer for any of `card_ids`
+
+        For cards that just changed hands or went up for sale, whose offers
+        could no longer be accepted. They are canceled with one UPDATE, which
+        must run in the transaction that changed the cards, and both parties
+        get a trade.canceled event once it commits.
+
+        Returns:
+            list: The offers that were canceled
+        """
+        card_ids = list(card_ids)
+        stale = list(
+            cls.objects.select_for_update(of=('self',))
+            .filter(
+                Q(sender_card__in=card_ids) | Q(recipient_card__in=card_ids),
+                status='pending',
+            )
+            .select_related('sender', 'sender_card', 'recipient_card')
+        )
+        if not stale:
+            return []
+
+        # Still conditional on the status, so an offer settled since the
+        # SELECT is neither canceled nor reported
+        updated_at = timezone.now()
+        canceled = cls.objects.filter(
+            pk__in=[offer.pk for offer in stale], status='pending'
+        ).update(status='canceled', updated_at=updated_at)
+        if canceled < len(stale):
+            still_ours = set(
+                cls.objects.filter(
+                    pk__in=[offer.pk for offer in stale],
+                    status='canceled',
+                    updated_at=updated_at,
+                ).values_list('pk', flat=True)
+            )
+            stale = [offer for offer in stale if offer.pk in still_ours]
+        for offer in stale:
+            offer.status = 'canceled'
+            offer.updated_at = updated_at
+        cls.record_changes(stale)
+        cls.publish_canceled(stale)
+        return stale
+
+    @staticmethod
+    def publish_canceled(offers):
+        """Send both parties of each of `offers` a trade.canceled event on commit"""
+        # The serializers import this module
+        from .serializers import TradeOfferSerializer
+
+        for offer in offers:
+            events.publish(
+                "trade.canceled",
+                users=[offer.sender_id, offer.recipient_id],
+                trade=TradeOfferSerializer(offer).data,
+            )
+
+    @staticmethod
+    def _lock_cards(offers):
+        """Lock the cards of `offers` in id order, so concurrent accepts cannot deadlock"""
+        card_ids = {
+            card_id
+            for offer in offers
+            for card_id in (offer.sender_card_id, offer.recipient_card_id)
+        }
+        return {
+            card.pk: card
+            for card in Card.objects.select_for_update()
+            .filter(pk__in=card_ids)
+            .order_by('pk')
+        }
+
+    def _cards_still_owned(self, cards):
+        """Whether both cards still belong to the users the offer was made between"""
+        sender_card = cards.get(self.sender_card_id)
+        recipient_card = cards.get(self.recipient_card_id)
+        return (
+            sender_card is not None
+            and recipient_card is not None
+            and sender_card.owner_id == self.sender_id
+            and recipient_card.owner_id == self.recipient_id
+        )
+
+    def _cancel_stale(self):
+        self.updated_at = timezone.now()
+        TradeOffer.objects.filter(pk=self.pk).update(
+            status='canceled', updated_at=self.updated_at
+        )
+        self.record_change()
+        self.status = 'canceled'
+        TradeOffer.publish_canceled([self])
     
+    def record_change(self):
+        """Invalidate both parties' cached trade lists and log the change"""
+        Generation.trades_changed(self.sender_id, self.recipient_id)
+        ChangeLogEntry.record(
+            ChangeLogEntry.TRADE, self.pk, {self.sender_id, self.recipient_id}
+        )
+
+    @classmethod
+    def record_changes(cls, offers):
+        """
+        record_change() for many offers at once, such as ones inserted with
+        bulk_create()
+        """
+        Generation.trades_changed(
+            *{user_id for offer in offers for user_id in (offer.sender_id, offer.recipient_id)}
+        )
+        ChangeLogEntry.record_many(
+            ChangeLogEntry.TRADE,
+            (
+                (offer.pk, user_id)
+                for offer in offers
+                for user_id in (offer.sender_id, offer.recipient_id)
+            ),
+        )
+
+    @classmethod
+    def transition_many(cls, offers, new_status):
+        """
+        Move the pending ones of `offers`, which the caller has locked, to
+        `new_status` with one UPDATE
+
+        Returns:
+            list: The offers that were pending and now have the new status
+        """
+        pending = [offer for offer in offers if offer.status == 'pending']
+        if not pending:
+            return []
+
+        updated_at = timezone.now()
+        cls.objects.filter(
+            pk__in=[offer.pk for offer in pending], status='pending'
+        ).update(status=new_status, updated_at=updated_at)
+        cls.record_changes(pending)
+        for offer in pending:
+            offer.status = new_status
+            offer.updated_at = updated_at
+        return pending
+
     def decline(self):
         """Decline the trade offer"""
-        if self.status != 'pending':
-            return False
-            
-        self.status = 'declined'
-        self.save()
-        return True
+        return self._transition('declined')
     
     def cancel(self):
         """Cancel the trade offer (by the sender)"""
-        if self.status != 'pending':
+        return self._transition('canceled')
+
+    def _transition(self, new_status):
+        """
+        Move a pending offer to `new_status`
+
+        The status check and the write are a single conditional UPDATE, so
+        of two concurrent actions on the same offer only one can win.
+
+        Returns:
+            bool: True if the offer was still pending
+        """
+        updated_at = timezone.now()
+        updated = TradeOffer.objects.filter(pk=self.pk, status='pending').update(
+            status=new_status, updated_at=updated_at
+        )
+        if not updated:
+            self.refresh_from_db(fields=['status', 'updated_at'])
             return False
-            
-        self.status = 'canceled'
-        self.save()
-        return True
\ No newline at end of file
+
+        self.record_change()
+        self.status = new_status
+        self.updated_at = updated_at
+        return True
+
+
+class LedgerEntry(models.Model):
+    """
+    One movement of credits into or out of a user's account
+
+    Entries are only ever appended. A user's balance is their latest
+    BalanceSnapshot plus every entry recorded after it.
+    """
+    KIND_CHOICES = [
+        ('opening', 'Opening balance'),
+        ('purchase', 'Purchase'),
+        ('sale', 'Sale'),
+        ('adjustment', 'Adjustment'),
+    ]
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="ledger_entries")
+
+    # Positive for credits, negative for debits
+    amount = models.IntegerField()
+    kind = models.CharField(max_length=12, choices=KIND_CHOICES)
+
+    # The card that was bought or sold, if any
+    card = models.ForeignKey(Card, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "id"], name="ledger_user_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.amount:+d} ({self.kind})"
+
+
+class BalanceSnapshot(models.Model):
+    """A user's ledger total up to and including entry `last_entry_id`"""
+    user = models.OneToOneField(
+        CustomUser, on_delete=models.CASCADE, primary_key=True, related_name="balance_snapshot"
+    )
+    balance = models.IntegerField()
+    last_entry_id = models.BigIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class BalanceShard(models.Model):
+    """
+    One of N counters that incoming credits are spread over
+
+    Sales to the same seller then update different rows instead of queueing
+    on the seller's CustomUser row. A user's spendable balance is
+    account_balance plus the sum of their shards.
+    """
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="balance_shards")
+    shard = models.PositiveSmallIntegerField()
+    amount = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "shard"], name="balance_shard_unique"),
+        ]
+
+
+class ArchivedTradeOffer(models.Model):
+    """
+    A settled trade offer moved out of TradeOffer by archive_trades
+
+    Keeps the offer's id. The cards may be deleted later on, so there are no
+    constraints on them and their names are kept as they were.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="+")
+    recipient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name="+")
+    sender_card = models.ForeignKey(
+        Card, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+"
+    )
+    recipient_card = models.ForeignKey(
+        Card, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+"
+    )
+    sender_card_name = models.CharField(max_length=100)
+    recipient_card_name = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=TradeOffer.STATUS_CHOICES)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # A user's history, newest first
+            models.Index(fields=["sender", "-id"], name="archive_sender_idx"),
+            models.Index(fields=["recipient", "-id"], name="archive_recipient_idx"),
+        ]
+
+    @classmethod
+    def archive_batch(cls, before, after_id=0, batch_size=5000):
+        """
+        Move the next batch of offers settled before `before` to the archive
+
+        Offers are taken in id order, after `after_id`, so a run picks up
+        where the previous batch stopped without rescanning the table. The
+        copy and the delete commit together. Rows are copied with INSERT ...
+        SELECT, since bulk_create() would spend longer preparing them.
+        Each moved offer is logged as a change for its sender and recipient,
+        so clients syncing deltas drop it too.
+
+        Returns:
+            tuple: (offers moved, id of the last one), or (0, None) when
+                there are none left
+        """
+        connection = connections[router.db_for_write(cls)]
+        offers = TradeOffer._meta.db_table
+        cards = Card._meta.db_table
+        columns = (
+            "id, sender_id, recipient_id, sender_card_id, recipient_card_id, "
+            "sender_card_name, recipient_card_name, status, created_at, "
+            "updated_at, archived_at"
+        )
+        archived_at = connection.ops.adapt_datetimefield_value(timezone.now())
+
+        with transaction.atomic(using=connection.alias):
+            batch = list(
+                TradeOffer.objects.filter(
+                    pk__gt=after_id, status__in=TradeOffer.SETTLED, updated_at__lt=before
+                )
+                .order_by("pk")
+                .values_list("pk", "sender_id", "recipient_id")[:batch_size]
+            )
+            if not batch:
+                return 0, None
+            ids = [pk for pk, _, _ in batch]
+
+            # No signals: the offers were already out of every trade list
+            with connection.cursor() as cursor:
+                for i in range(0, len(ids), 900):
+                    chunk = ids[i:i + 900]
+                    placeholders = ", ".join(["%s"] * len(chunk))
+                    # Offers a previous, interrupted run copied are skipped
+                    cursor.execute(
+                        f"{connection.ops.insert_statement(on_conflict=OnConflict.IGNORE)} "
+                        f"{cls._meta.db_table} ({columns}) "
+                        f"SELECT o.id, o.sender_id, o.recipient_id, o.sender_card_id, "
+                        f"o.recipient_card_id, s.name, r.name, o.status, o.created_at, "
+                        f"o.updated_at, %s FROM {offers} o "
+                        f"JOIN {cards} s ON s.id = o.sender_card_id "
+                        f"JOIN {cards} r ON r.id = o.recipient_card_id "
+                        f"WHERE o.id IN ({placeholders}) "
+                        f"{connection.ops.on_conflict_suffix_sql([], OnConflict.IGNORE, [], [])}",
+                        [archived_at, *chunk],
+                    )
+                    cursor.execute(
+                        f"DELETE FROM {offers} WHERE id IN ({placeholders})", chunk
+                    )
+            ChangeLogEntry.record_many(
+                ChangeLogEntry.TRADE,
+                (
+                    (pk, user_id)
+                    for pk, sender_id, recipient_id in batch
+                    for user_id in (sender_id, recipient_id)
+                ),
+            )
+        return len(ids), ids[-1]
+
+
+class Generation(models.Model):
+    """
+    A counter bumped whenever the data behind a cached collection changes
+
+    Cache keys embed the generations of everything a payload was built
+    from (see apis/caching.py), so a bump makes older entries unreachable.
+    Counters are bumped inside the writer's transaction and start at a
+    random value, so a key is never reused after the table is reset.
+    """
+    MARKETPLACE = "marketplace"
+
+    key = models.CharField(max_length=64, primary_key=True)
+    value = models.BigIntegerField()
+
+    @staticmethod
+    def owner_key(user_id):
+        """The cards owned by a user"""
+        return f"owner:{user_id}"
+
+    @staticmethod
+    def trades_key(user_id):
+        """The trade offers a user sent or received"""
+        return f"trades:{user_id}"
+
+    @classmethod
+    def bump(cls, *keys):
+        keys = set(keys)
+        batch = _batch.get()
+        if batch is not None:
+            batch.keys |= keys
+            return
+        if cls.objects.filter(key__in=keys).update(value=F("value") + 1) == len(keys):
+            return
+        cls.objects.bulk_create(
+            [cls(key=key, value=random.getrandbits(48)) for key in keys],
+            ignore_conflicts=True,
+        )
+        # Some counters may have been created concurrently and not bumped
+        # yet; bumping the others twice does no harm
+        cls.objects.filter(key__in=keys).update(value=F("value") + 1)
+
+    @classmethod
+    def current(cls, *keys):
+        """
+        Returns:
+            dict: key -> value, 0 for keys that were never bumped
+        """
+        values = dict(cls.objects.filter(key__in=keys).values_list("key", "value"))
+        return {key: values.get(key, 0) for key in keys}
+
+    @classmethod
+    async def acurrent(cls, *keys):
+        """Async version of current()"""
+        values = {
+            key: value
+            async for key, value in cls.objects.filter(key__in=keys).values_list(
+                "key", "value"
+            )
+        }
+        return {key: values.get(key, 0) for key in keys}
+
+    @classmethod
+    def cards_changed(cls, owner_ids, listed):
+        """Bump the collections of `owner_ids`, and the marketplace if `listed`"""
+        keys = [cls.owner_key(owner_id) for owner_id in owner_ids if owner_id]
+        if listed:
+            keys.append(cls.MARKETPLACE)
+        cls.bump(*keys)
+
+    @classmethod
+    def trades_changed(cls, *user_ids):
+        cls.bump(*(cls.trades_key(user_id) for user_id in user_ids))
+
+
+class ChangeLogEntry(models.Model):
+    """
+    A note that a card or trade offer changed, for one user who can see it
+
+    Ids are assigned in commit order on SQLite, which serializes writers,
+    so they double as the delta sync cursor. Entries only say what
+    changed; the current state is read when a client syncs.
+    """
+    CARD = 'card'
+    TRADE = 'trade'
+    KIND_CHOICES = [
+        (CARD, 'Card'),
+        (TRADE, 'Trade offer'),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    # No constraint: deleting a user logs changes to their cards on the way
+    user = models.ForeignKey(
+        CustomUser, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+"
+    )
+    kind = models.CharField(max_length=5, choices=KIND_CHOICES)
+    object_id = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "id"], name="changelog_user_idx"),
+        ]
+
+    @classmethod
+    def record(cls, kind, object_id, user_ids):
+        cls.record_many(
+            kind, ((object_id, user_id) for user_id in user_ids if user_id)
+        )
+
+    @classmethod
+    def record_many(cls, kind, changes):
+        """
+        Log many changes in one statement
+
+        Goes straight to executemany(): for plain rows like these,
+        bulk_create() spends longer preparing values than the database
+        takes to insert them.
+
+        Args:
+            kind (str): CARD or TRADE
+            changes (iterable): (object id, user id) pairs
+        """
+        batch = _batch.get()
+        if batch is not None:
+            batch.entries[kind].extend(changes)
+            return
+        connection = connections[router.db_for_write(cls)]
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        rows = [(user_id, kind, object_id, now) for object_id, user_id in changes]
+        if not rows:
+            return
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {cls._meta.db_table} "
+                "(user_id, kind, object_id, created_at) VALUES (%s, %s, %s, %s)",
+                rows,
+            )
+
+
+# The ChangeBatch of the innermost batch_changes() block, if any
+_batch = ContextVar("change_batch", default=None)
+
+
+class ChangeBatch:
+    """Generation bumps and change log entries held back by batch_changes()"""
+
+    def __init__(self):
+        self.keys = set()
+        # kind -> (object id, user id) pairs
+        self.entries = defaultdict(list)
+
+    def merge(self, other):
+        self.keys |= other.keys
+        for kind, entries in other.entries.items():
+            self.entries[kind].extend(entries)
+
+    def write(self):
+        if self.keys:
+            Generation.bump(*self.keys)
+        for kind, entries in self.entries.items():
+            ChangeLogEntry.record_many(kind, entries)
+
+
+@contextmanager
+def batch_changes():
+    """
+    Hold back Generation bumps and change log entries until the block ends,
+    then write them with one bump and one INSERT per kind
+
+    Must run inside the transaction making the changes. A nested block
+    hands its changes to the enclosing one; a block left by an exception
+    drops them, as its savepoint rolls back. Also a decorator, as
+    @batch_changes().
+    """
+    batch = ChangeBatch()
+    parent = _batch.get()
+    token = _batch.set(batch)
+    try:
+        yield batch
+    finally:
+        _batch.reset(token)
+    if parent is not None:
+        parent.merge(batch)
+    else:
+        batch.write()
+
+
+class ImportCheckpoint(models.Model):
+    """
+    How many input rows a resumable bulk load has committed so far
+
+    Updated in the same transaction as the rows it counts, so a load
+    interrupted at any point resumes exactly where it stopped.
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+    rows = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,127 @@
+import base64
+import binascii
+import json
+from functools import partial
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """Raised when a client supplies a cursor we did not issue"""
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row on a page as an opaque token"""
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size):
+    """
+    Decode a token produced by encode_cursor
+
+    Args:
+        cursor (str): The token sent back by the client
+        size (int): The number of values the current ordering expects
+
+    Returns:
+        list: The sort key values of the last row the client has seen
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, ValueError, UnicodeDecodeError):
+        raise InvalidCursor("Malformed cursor")
+
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor("Cursor does not match the requested sort")
+    if not all(isinstance(value, int) for value in values):
+        raise InvalidCursor("Malformed cursor")
+
+    return values
+
+
+def keyset_filter(ordering, values):
+    """
+    Build the WHERE clause selecting rows strictly after `values` in `ordering`
+
+    For an ordering of (price, id) this yields
+    price >= p AND (price > p OR (price = p AND id > i)). The redundant
+    leading bound lets the database turn it into an index range scan.
+    """
+    fields = [(name.lstrip("-"), name.startswith("-")) for name in ordering]
+
+    condition = Q()
+    for position, (field, descending) in enumerate(fields):
+        lookup = "lt" if descending else "gt"
+        branch = Q(**{f"{field}__{lookup}": values[position]})
+        for prior, (prior_field, _) in enumerate(fields[:position]):
+            branch &= Q(**{prior_field: values[prior]})
+        condition |= branch
+
+    leading, descending = fields[0]
+    bound = Q(**{f"{leading}__{'lte' if descending else 'gte'}": values[0]})
+    return bound & condition
+
+
+def _page_query(queryset, ordering, cursor, limit):
+    """The query for one page, plus one extra row to tell if another follows"""
+    if cursor:
+        values = decode_cursor(cursor, len(ordering))
+        queryset = queryset.filter(keyset_filter(ordering, values))
+    return queryset.order_by(*ordering)[: limit + 1]
+
+
+def _split_page(rows, ordering, limit):
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    # Rows are model instances, or dicts from a values() queryset
+    get = last.get if isinstance(last, dict) else partial(getattr, last)
+    next_cursor = encode_cursor(get(name.lstrip("-")) for name in ordering)
+    return rows, next_cursor
+
+
+def paginate_keyset(queryset, ordering, cursor=None, limit=50):
+    """
+    Return one page of `queryset` ordered by `ordering`
+
+    The last element of `ordering` must be unique (normally the primary key)
+    so every row has a distinct position. Each page costs a single indexed
+    query, no matter how deep into the result set the client is.
+
+    Returns:
+        tuple: (rows, next_cursor) where next_cursor is None on the last page
+    """
+    rows = list(_page_query(queryset, ordering, cursor, limit))
+    return _split_page(rows, ordering, limit)
+
+
+async def apaginate_keyset(queryset, ordering, cursor=None, limit=50):
+    """Async version of paginate_keyset"""
+    page = _page_query(queryset, ordering, cursor, limit)
+    rows = [row async for row in page.aiterator()]
+    return _split_page(rows, ordering, limit)
+
+
+def capped_count(queryset, cap):
+    """
+    Count at most `cap` rows of `queryset`
+
+    Returns:
+        tuple: (count, exact) where exact is False if there are more rows
+    """
+    return _capped(queryset[: cap + 1].count(), cap)
+
+
+async def acapped_count(queryset, cap):
+    """Async version of capped_count"""
+    return _capped(await queryset[: cap + 1].acount(), cap)
+
+
+def _capped(count, cap):
+    if count > cap:
+        return cap, False
+    return count, True
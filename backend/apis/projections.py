@@ -0,0 +1,73 @@
+"""
+Serializer-free projections for read-only lists
+
+ModelSerializer(many=True) dispatches every field of every row through a
+serializer Field, which dominates the CPU time of large lists. These
+build the same output straight from values() rows, joining in the names
+the serializers would look up, for lists that are only ever read.
+"""
+from django.db.models import F
+from django.utils import timezone
+
+CARD_FIELDS = ("id", "name", "price", "version", "owner")
+
+TRADE_FIELDS = (
+    "id",
+    "sender",
+    "recipient",
+    "sender_card",
+    "recipient_card",
+    "status",
+    "created_at",
+    "updated_at",
+)
+
+def cards(queryset):
+    """
+    CardSerializer output for every card in `queryset`
+
+    Returns:
+        QuerySet: A values() queryset; it can still be filtered, sliced and
+            paginated like the original
+    """
+    return queryset.values(*CARD_FIELDS, owner_username=F("owner__username"))
+
+
+def trades(queryset):
+    """
+    TradeOfferSerializer output for every offer in `queryset`, except that
+    the timestamps are left to format_trade()
+
+    Returns:
+        QuerySet: A values() queryset
+    """
+    return queryset.values(
+        *TRADE_FIELDS,
+        sender_username=F("sender__username"),
+        sender_card_name=F("sender_card__name"),
+        recipient_card_name=F("recipient_card__name"),
+    )
+
+
+def archived_trades(queryset):
+    """trades() for ArchivedTradeOffer rows, which keep their card names"""
+    return queryset.values(
+        *TRADE_FIELDS,
+        "sender_card_name",
+        "recipient_card_name",
+        sender_username=F("sender__username"),
+    )
+
+
+def _datetime(value, zone):
+    """What DRF's DateTimeField renders with the default ISO 8601 format"""
+    text = value.astimezone(zone).isoformat()
+    return text[:-6] + "Z" if text.endswith("+00:00") else text
+
+
+def format_trade(row):
+    """Finish a row from trades() in place, and return it"""
+    zone = timezone.get_current_timezone()
+    row["created_at"] = _datetime(row["created_at"], zone)
+    row["updated_at"] = _datetime(row["updated_at"], zone)
+    return row
@@ -0,0 +1,86 @@
+"""
+JSON rendering backed by orjson, when it is installed
+
+orjson is an optional dependency (pip install orjson). Without it, or
+for output DRF's renderer would handle differently (indented, non-compact
+or non-UTF-8), FastJSONRenderer falls back to DRF's own JSONRenderer.
+"""
+import csv
+import io
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    """Drop-in JSONRenderer producing the same bytes for compact output"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if orjson is None or indent is not None or not self.compact or self.ensure_ascii:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # Datetimes, Decimals, lazy strings and the like go through DRF's
+        # encoder, so they come out exactly as they would have
+        ret = orjson.dumps(
+            data,
+            default=self.encoder_class().default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME,
+        )
+        # Match DRF, which keeps the output a strict javascript subset
+        if b"\xe2\x80\xa8" in ret or b"\xe2\x80\xa9" in ret:
+            ret = ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(
+                b"\xe2\x80\xa9", b"\\u2029"
+            )
+        return ret
+
+
+_json = FastJSONRenderer()
+
+
+def render_json(data):
+    """Render `data` the way API responses are rendered"""
+    return _json.render(data)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline-delimited JSON, one object per line
+
+    Exports stream their rows themselves (see apis/exports.py); this
+    renders whatever else the view returns, such as errors.
+    """
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        rows = data if isinstance(data, list) else [data]
+        return b"".join(render_json(row) + b"\n" for row in rows)
+
+
+class CSVRenderer(BaseRenderer):
+    """CSV with a header row; a single object becomes a one-row table"""
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        rows = data if isinstance(data, list) else [data]
+        buffer = io.StringIO()
+        if rows:
+            writer = csv.DictWriter(buffer, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        return buffer.getvalue().encode(self.charset)
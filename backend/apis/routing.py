@@ -0,0 +1,224 @@
+"""
+Read-replica routing
+
+ReplicaRouter sends reads to a replica only while a request to a view that
+opted in with `replica_reads` is being served; everything else, and every
+write, goes to the primary ("default"). ReplicaRoutingMiddleware makes that
+decision per request:
+
+    - only GET and HEAD requests are considered;
+    - `replica_reads` on the view class is True, or a collection of the
+      viewset actions ("list", ...) or lowercase methods it covers;
+    - a user who wrote recently reads from the primary for STICKY_SECONDS
+      afterwards, so they see their own changes whatever the replica lag.
+
+Reads inside a transaction on the primary, such as the locked reads of a
+purchase or trade, stay on the primary, as do reads of related objects that
+were loaded from it.
+
+Settings:
+    READ_REPLICAS: {
+        "ALIASES": database aliases of the replicas. Each request reads
+            from one, picked at random, so all of its reads see the same
+            point in time. None by default, which keeps everything on the
+            primary.
+        "STICKY_SECONDS": how long after a write a user keeps reading from
+            the primary. Defaults to 5.
+        "CACHE_ALIAS": the Django cache that remembers recent writers. It
+            has to be shared between processes to keep them sticky across
+            workers. Defaults to "default".
+    }
+
+A local SQLite replica is a second entry in DATABASES whose file is kept
+up to date with the sync_replicas command.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .authentication import raw_token, user_id_from_token
+
+SAFE_METHODS = ("GET", "HEAD")
+
+
+def replica_settings():
+    config = getattr(settings, "READ_REPLICAS", None) or {}
+    return {
+        "ALIASES": list(config.get("ALIASES") or []),
+        "STICKY_SECONDS": config.get("STICKY_SECONDS", 5),
+        "CACHE_ALIAS": config.get("CACHE_ALIAS", "default"),
+    }
+
+
+class RoutingState:
+    """Which replica, if any, the reads of the current request go to"""
+
+    def __init__(self):
+        self.replica = None
+
+    @property
+    def replica_reads(self):
+        return self.replica is not None
+
+
+def pick_replica():
+    aliases = replica_settings()["ALIASES"]
+    return random.choice(aliases) if aliases else None
+
+
+_active_state = ContextVar("replica_routing", default=None)
+
+
+@contextmanager
+def reading_from_replicas():
+    """Let reads inside the block go to replicas, e.g. in a report command"""
+    state = RoutingState()
+    state.replica = pick_replica()
+    token = _active_state.set(state)
+    try:
+        yield
+    finally:
+        _active_state.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            return instance._state.db
+
+        state = _active_state.get()
+        if state is None or not state.replica_reads:
+            return DEFAULT_DB_ALIAS
+        # Reads that are part of a write see the primary's view of things
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        # One replica for the whole request, so that e.g. a generation and
+        # the rows cached under it can't come from replicas at different lags
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+
+def view_replica_reads(view_func, method):
+    """
+    Look up whether the view behind `view_func` reads from replicas
+
+    Like query_budget, `replica_reads` is True for the whole view, or a
+    collection of action names for viewsets and of lowercase methods for
+    other views.
+    """
+    view_class = getattr(view_func, "cls", None) or getattr(view_func, "view_class", None)
+    replica_reads = getattr(view_class, "replica_reads", False)
+
+    if isinstance(replica_reads, bool):
+        return replica_reads
+    actions = getattr(view_func, "actions", None) or {}
+    return actions.get(method.lower(), method.lower()) in replica_reads
+
+
+def request_user_id(request):
+    """
+    The id of the user making the request, without querying for the user
+
+    Returns:
+        The id from the access token, or from the session for the browsable
+        API and admin, or None for anonymous requests
+    """
+    user_id = user_id_from_token(raw_token(request))
+    if user_id is None and hasattr(request, "session"):
+        user_id = request.session.get(SESSION_KEY)
+    return None if user_id is None else str(user_id)
+
+
+def _sticky_key(user_id):
+    return f"replica-sticky:{user_id}"
+
+
+def recently_wrote(user_id):
+    config = replica_settings()
+    return bool(caches[config["CACHE_ALIAS"]].get(_sticky_key(user_id)))
+
+
+def mark_write(user_id):
+    """Keep `user_id` on the primary for the next STICKY_SECONDS"""
+    config = replica_settings()
+    caches[config["CACHE_ALIAS"]].set(
+        _sticky_key(user_id), time.time(), timeout=config["STICKY_SECONDS"]
+    )
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Allow replica reads for safe requests to opted-in views, and keep users
+    on the primary for a short while after they write
+
+    Must come after SessionMiddleware.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        token = _active_state.set(RoutingState())
+        try:
+            response = self.get_response(request)
+        finally:
+            _active_state.reset(token)
+        self.record_write(request)
+        return response
+
+    async def __acall__(self, request):
+        token = _active_state.set(RoutingState())
+        try:
+            response = await self.get_response(request)
+        finally:
+            _active_state.reset(token)
+        self.record_write(request)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        replica = None
+        if (
+            replica_settings()["ALIASES"]
+            and request.method in SAFE_METHODS
+            and view_replica_reads(view_func, request.method)
+        ):
+            user_id = request_user_id(request)
+            if user_id is None or not recently_wrote(user_id):
+                replica = pick_replica()
+
+        # Left on the request for whoever handled it, e.g. the tests
+        request.replica_reads = replica is not None
+        request.replica = replica
+        # process_view may run in another context under ASGI; the state
+        # object is shared with it, the context variable is not
+        state = _active_state.get()
+        if state is not None:
+            state.replica = replica
+
+    def record_write(self, request):
+        if request.method in SAFE_METHODS or not replica_settings()["ALIASES"]:
+            return
+        user_id = request_user_id(request)
+        if user_id is not None:
+            mark_write(user_id)
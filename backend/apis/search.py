@@ -0,0 +1,184 @@
+"""
+Card name search
+
+On SQLite, card names are mirrored into an FTS5 table using the trigram
+tokenizer (apis_card_search), kept in sync with apis_card by triggers, so
+substring matches are answered from the index instead of LIKE '%x%' scans.
+On PostgreSQL a pg_trgm GIN index makes the plain icontains lookup
+indexable instead. Both are created by migration 0005; on any other
+backend, or for queries shorter than one trigram, we fall back to
+icontains.
+"""
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+from .models import Card
+
+SEARCH_TABLE = "apis_card_search"
+TRIGRAM_INDEX = "card_name_trgm_idx"
+
+# Trigram tokens are three characters, shorter queries cannot be indexed
+MIN_INDEXED_LENGTH = 3
+
+# SQLite implements most ALTER TABLE operations by copying apis_card into a
+# new table, which silently drops these triggers. A migration altering Card
+# must recreate them with its own copy of this SQL, as 0006 does.
+SQLITE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_insert AFTER INSERT ON apis_card BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON apis_card BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, name)
+        VALUES ('delete', old.id, old.name);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_update AFTER UPDATE OF name ON apis_card BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, name)
+        VALUES ('delete', old.id, old.name);
+        INSERT INTO {SEARCH_TABLE}(rowid, name) VALUES (new.id, new.name);
+    END
+    """,
+]
+
+POSTGRES_INDEX = (
+    f"CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} "
+    "ON apis_card USING gin (UPPER(name) gin_trgm_ops)"
+)
+
+_enabled = {}
+
+
+def fts_enabled(using="default"):
+    """Return True if the FTS5 shadow table exists on the `using` database"""
+    if using not in _enabled:
+        connection = connections[using]
+        _enabled[using] = (
+            connection.vendor == "sqlite"
+            and SEARCH_TABLE in connection.introspection.table_names()
+        )
+    return _enabled[using]
+
+
+def _phrase(text):
+    """Quote `text` as a single FTS5 phrase, which matches it as a substring"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _any_trigram(text):
+    """FTS5 query matching names that share at least one trigram with `text`"""
+    text = text.lower()
+    trigrams = dict.fromkeys(
+        text[i : i + MIN_INDEXED_LENGTH]
+        for i in range(len(text) - MIN_INDEXED_LENGTH + 1)
+    )
+    return " OR ".join(_phrase(trigram) for trigram in trigrams)
+
+
+def filter_by_name(queryset, text):
+    """
+    Restrict a Card queryset to names containing `text`, case-insensitively
+
+    Same semantics as name__icontains, but served by the search index when
+    one is available.
+    """
+    if len(text) >= MIN_INDEXED_LENGTH and fts_enabled(queryset.db):
+        matches = RawSQL(
+            f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s",
+            [_phrase(text)],
+        )
+        return queryset.filter(id__in=matches)
+    return queryset.filter(name__icontains=text)
+
+
+def search_cards(text, limit=20, fuzzy=False, for_sale=True, using="default"):
+    """
+    Rank cards by how well their name matches `text`
+
+    Names starting with `text` come first, then other substring matches by
+    bm25 score. With `fuzzy`, names sharing any trigram with `text` are also
+    considered, so small typos still find the card.
+
+    Returns:
+        list: Card ids, best match first
+    """
+    text = text.strip()
+    if not text:
+        return []
+
+    if len(text) < MIN_INDEXED_LENGTH or not fts_enabled(using):
+        queryset = Card.objects.using(using).filter(name__icontains=text)
+        if for_sale:
+            queryset = queryset.filter(price__gte=0)
+        # Prefix matches first, then the rest in name order
+        starts = list(
+            queryset.filter(name__istartswith=text)
+            .order_by("name", "id")
+            .values_list("id", flat=True)[:limit]
+        )
+        rest = (
+            queryset.exclude(id__in=starts)
+            .order_by("name", "id")
+            .values_list("id", flat=True)[: limit - len(starts)]
+        )
+        return starts + list(rest)
+
+    sql = (
+        f"SELECT c.id FROM {SEARCH_TABLE} s JOIN apis_card c ON c.id = s.rowid "
+        f"WHERE {SEARCH_TABLE} MATCH %s"
+        + (" AND c.price >= 0" if for_sale else "")
+        + f" ORDER BY instr(lower(c.name), %s) != 1, bm25({SEARCH_TABLE}), c.id"
+        " LIMIT %s"
+    )
+    expression = _any_trigram(text) if fuzzy else _phrase(text)
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, [expression, text.lower(), limit])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def rebuild(using="default"):
+    """Rebuild the search index from apis_card"""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if fts_enabled(using):
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"
+            )
+        elif connection.vendor == "postgresql":
+            cursor.execute(f"REINDEX INDEX {TRIGRAM_INDEX}")
+        else:
+            return False
+    return True
+
+
+def suspend(using="default"):
+    """
+    Stop maintaining the search index, ahead of a bulk load
+
+    Must be followed by resume(); until then name searches don't see cards
+    added or renamed in the meantime.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if fts_enabled(using):
+            for operation in ("insert", "delete", "update"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {SEARCH_TABLE}_{operation}")
+        elif connection.vendor == "postgresql":
+            cursor.execute(f"DROP INDEX IF EXISTS {TRIGRAM_INDEX}")
+
+
+def resume(using="default"):
+    """Put back what suspend() removed and index everything loaded meanwhile"""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if fts_enabled(using):
+            for statement in SQLITE_TRIGGERS:
+                cursor.execute(statement)
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')"
+            )
+        elif connection.vendor == "postgresql":
+            cursor.execute(POSTGRES_INDEX)
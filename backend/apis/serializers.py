@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.db import transaction
 
+from . import ledger
 from .models import Card, TestModel, TradeOffer
 from django.contrib.auth.models import User
 
@@ -30,6 +31,7 @@ class CardSerializer(serializers.ModelSerializer):
     class Meta:
         model = Card
         fields = "__all__"
+        read_only_fields = ["version"]
         
     def get_owner_username(self, obj):
         return obj.owner.username
@@ -48,34 +50,28 @@ class CardSerializer(serializers.ModelSerializer):
             
         Raises:
             serializers.ValidationError: If the transaction cannot be completed
+            ConcurrentUpdate: If the card changed since it was loaded
         """
         # Check if card is for sale
         if card.price < 0:
             raise serializers.ValidationError("This card is not for sale")
             
-        # Check if buyer has enough balance
-        if buyer.account_balance < card.price:
-            raise serializers.ValidationError("Insufficient funds")
-            
         # Check that buyer isn't the owner
-        if buyer == card.owner:
+        if buyer.pk == card.owner_id:
             raise serializers.ValidationError("You already own this card")
             
         # Perform the transaction
-        seller = card.owner
+        seller_id = card.owner_id
         price = card.price
         
-        # Update balances
-        buyer.account_balance -= price
-        seller.account_balance += price
-        
-        # Update card ownership
-        card.owner = buyer
+        # Move the money; the balance check is part of the debit's UPDATE
+        if not ledger.transfer(buyer.pk, seller_id, price, card=card):
+            raise serializers.ValidationError("Insufficient funds")
         
-        # Save all changes
-        buyer.save()
-        seller.save()
-        card.save()
+        # Update card ownership, unless someone else bought it first
+        card.update_versioned(owner=buyer)
+        TradeOffer.cancel_pending([card.pk])
+        buyer.account_balance = ledger.balance(buyer.pk)
         
         return True
 
@@ -109,11 +105,11 @@ class TradeOfferSerializer(serializers.ModelSerializer):
         
         # Validate that the sender owns the sender_card
         sender = self.context['request'].user
-        if data['sender_card'].owner != sender:
+        if data['sender_card'].owner_id != sender.pk:
             raise serializers.ValidationError("You don't own the card you're offering")
         
         # Validate that the recipient owns the recipient_card
-        if data['recipient_card'].owner != data['recipient']:
+        if data['recipient_card'].owner_id != data['recipient'].pk:
             raise serializers.ValidationError("The recipient doesn't own the card you're requesting")
         
         # Validate that neither card is for sale
@@ -0,0 +1,79 @@
+from django.db.backends.signals import connection_created
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import authentication, instrumentation, ledger, storage
+from .models import Card, CustomUser, TradeOffer
+
+
+@receiver(post_save, sender=CustomUser)
+def record_opening_balance(sender, instance, created, raw=False, **kwargs):
+    """Users can start with credits; put those on the ledger"""
+    if created and not raw:
+        ledger.record_opening_balances([instance])
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def forget_cached_user(sender, instance, **kwargs):
+    """Make the next request authenticated as this user load them again"""
+    authentication.get_user_cache().forget(instance.pk)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    """Let QueryInstrumentationMiddleware see queries from any thread"""
+    instrumentation.install(connection)
+
+
+@receiver(connection_created)
+def configure_storage(sender, connection, **kwargs):
+    """Apply the SQLite storage profile; see apis/storage.py"""
+    storage.configure(connection)
+
+
+def _card_changed(card):
+    owners = {card.owner_id, getattr(card, "_loaded_owner_id", None)}
+    # Listed before or after; a card loaded without its price may have been
+    loaded_price = getattr(card, "_loaded_price", -1)
+    listed = card.price >= 0 or loaded_price is None or loaded_price >= 0
+    card.record_change(owners, listed=listed)
+    card._loaded_owner_id = card.owner_id
+    card._loaded_price = card.price
+
+
+@receiver(post_save, sender=Card)
+def card_saved(sender, instance, created, **kwargs):
+    """
+    Invalidate cached collections holding the card and log the change
+
+    Updates made through Card.update_versioned record the change
+    themselves, since QuerySet.update() sends no signals.
+    """
+    _card_changed(instance)
+    if created:
+        return
+
+    # Trade offers show card names, so the card's offers changed as well;
+    # only those still in the trade list, the rest are history
+    offers = list(
+        TradeOffer.objects.filter(
+            Q(sender_card=instance) | Q(recipient_card=instance),
+            Q(status='pending') | Q(updated_at__gte=TradeOffer.settled_horizon()),
+        ).only("sender_id", "recipient_id")
+    )
+    if offers:
+        TradeOffer.record_changes(offers)
+
+
+@receiver(post_delete, sender=Card)
+def card_deleted(sender, instance, **kwargs):
+    # Its offers are deleted with it, and record that themselves
+    _card_changed(instance)
+
+
+@receiver(post_save, sender=TradeOffer)
+@receiver(post_delete, sender=TradeOffer)
+def trade_offer_changed(sender, instance, **kwargs):
+    instance.record_change()
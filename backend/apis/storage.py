@@ -0,0 +1,62 @@
+"""
+SQLite storage profiles
+
+A profile is applied to every new SQLite connection from the
+connection_created signal, and picked with the SQLITE_PROFILE setting:
+
+    tuned: WAL journal, so readers and the writer stop blocking each
+        other; synchronous=NORMAL, which is durable enough under WAL; a
+        busy timeout; memory-mapped reads and a larger page cache; and
+        transactions that take the write lock as soon as they begin, so
+        two of them can't both read and then deadlock upgrading.
+    default: SQLite's own behaviour, rollback journal and deferred
+        transactions. The journal mode is stored in the database file,
+        so this profile sets it back explicitly.
+
+Lock errors that still happen are retried by retry_on_conflict.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+PROFILES = {
+    "default": {
+        "pragmas": {"journal_mode": "DELETE"},
+        "transaction_mode": None,
+    },
+    "tuned": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            # Milliseconds to wait for another connection's lock
+            "busy_timeout": 5000,
+            "mmap_size": 256 * 1024 * 1024,
+            # Negative means KiB rather than pages
+            "cache_size": -16 * 1024,
+            "temp_store": "MEMORY",
+        },
+        "transaction_mode": "IMMEDIATE",
+    },
+}
+
+
+def get_profile():
+    name = getattr(settings, "SQLITE_PROFILE", "default")
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"SQLITE_PROFILE must be one of {', '.join(PROFILES)}, not {name!r}"
+        )
+
+
+def configure(connection):
+    """Apply the storage profile to a newly opened connection"""
+    if connection.vendor != "sqlite":
+        return
+    profile = get_profile()
+    # Straight on the driver connection: these aren't the request's queries
+    for pragma, value in profile["pragmas"].items():
+        connection.connection.execute(f"PRAGMA {pragma} = {value}")
+    # An explicit OPTIONS["transaction_mode"] wins
+    if connection.transaction_mode is None and profile["transaction_mode"]:
+        connection.transaction_mode = profile["transaction_mode"]
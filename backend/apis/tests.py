@@ -1,3 +1,1798 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, router, transaction
+from django.test import (
+    AsyncClient,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import (
+    authentication,
+    caching,
+    events,
+    ledger,
+    matching,
+    metrics,
+    projections,
+    renderers,
+    routing,
+    search,
+    storage,
+    throttling,
+)
+from .concurrency import ConcurrentUpdate
+from .instrumentation import QueryBudgetExceeded, collect_queries
+from .management.commands import bench_endpoints
+from .management.commands.import_cards import read_json
+from .models import (
+    ArchivedTradeOffer,
+    BalanceSnapshot,
+    Card,
+    ChangeLogEntry,
+    CustomUser,
+    Generation,
+    ImportCheckpoint,
+    LedgerEntry,
+    TradeOffer,
+    batch_changes,
+)
+from .serializers import CardSerializer, TradeOfferSerializer
+from .views import CardMarketplaceView
+
+
+class CardMarketplaceViewTests(TestCase):
+    def setUp(self):
+        self.seller = CustomUser.objects.create_user(username="seller", password="pw")
+        self.buyer = CustomUser.objects.create_user(username="buyer", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+        self.url = reverse("card-marketplace")
+
+        for i, price in enumerate([30, 10, 20, 10, 50]):
+            Card.objects.create(name=f"Pikachu {i}", owner=self.seller, price=price)
+        Card.objects.create(name="Charmander", owner=self.buyer, price=15)
+        Card.objects.create(name="Unlisted", owner=self.seller, price=-1)
+
+    def collect(self, **params):
+        """Walk every page and return the listed prices and names"""
+        cards = []
+        cursor = None
+        while True:
+            query = dict(params, limit=2)
+            if cursor:
+                query["cursor"] = cursor
+            response = self.client.get(self.url, query)
+            self.assertEqual(response.status_code, 200)
+            cards.extend(response.json()["cards"])
+            cursor = response.json()["next_cursor"]
+            if cursor is None:
+                return cards
+
+    def test_pages_by_price_ascending(self):
+        cards = self.collect(sort="price")
+        self.assertEqual([c["price"] for c in cards], [10, 10, 15, 20, 30, 50])
+        self.assertEqual(len({c["id"] for c in cards}), 6)
+
+    def test_pages_by_price_descending(self):
+        cards = self.collect(sort="-price")
+        self.assertEqual([c["price"] for c in cards], [50, 30, 20, 15, 10, 10])
+
+    def test_newest_first_by_default(self):
+        cards = self.collect()
+        ids = [c["id"] for c in cards]
+        self.assertEqual(ids, sorted(ids, reverse=True))
+
+    def test_filters(self):
+        cards = self.collect(min_price=15, max_price=30, exclude_mine="true")
+        self.assertEqual(sorted(c["price"] for c in cards), [20, 30])
+
+        cards = self.collect(name="pika")
+        self.assertEqual(len(cards), 5)
+
+    def test_counts(self):
+        response = self.client.get(self.url, {"limit": 1})
+        self.assertNotIn("count", response.json())
+
+        response = self.client.get(self.url, {"limit": 1, "count": "exact"})
+        self.assertEqual(response.json()["count"], 6)
+
+        with mock.patch.object(CardMarketplaceView, "APPROX_COUNT_CAP", 3):
+            response = self.client.get(self.url, {"count": "approx"})
+        self.assertEqual(response.json()["count"], 3)
+        self.assertFalse(response.json()["count_exact"])
+
+    def test_rejects_bad_parameters(self):
+        for params in ({"sort": "name"}, {"cursor": "garbage"}, {"limit": "x"}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+
+
+@override_settings(QUERY_BUDGET_STRICT=True, QUERY_INSTRUMENTATION_HEADERS=True)
+class QueryBudgetTests(TestCase):
+    """List endpoints must run a constant number of queries"""
+
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(username="alice", password="pw")
+        self.bob = CustomUser.objects.create_user(username="bob", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+        for i in range(10):
+            mine = Card.objects.create(name=f"Mine {i}", owner=self.alice, price=-1)
+            theirs = Card.objects.create(name=f"Theirs {i}", owner=self.bob, price=-1)
+            Card.objects.create(name=f"Listed {i}", owner=self.bob, price=10 + i)
+            TradeOffer.objects.create(
+                sender=self.alice,
+                recipient=self.bob,
+                sender_card=mine,
+                recipient_card=theirs,
+            )
+
+    def test_list_endpoints_stay_within_budget(self):
+        urls = [
+            reverse("card-list"),
+            reverse("card-list") + "?owner=bob",
+            reverse("card-marketplace") + "?count=exact",
+            reverse("cards-by-user") + "?username=bob",
+            reverse("trade-offers-list"),
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn("X-DB-N-Plus-One", response)
+
+    async def test_async_endpoints_match_sync_ones(self):
+        token = str(AccessToken.for_user(self.alice))
+        # Both sides authenticate the same way, so their query counts compare
+        client = APIClient(headers={"Authorization": f"Bearer {token}"})
+        async_client = AsyncClient()
+        pairs = [
+            ("card-marketplace", "async-card-marketplace", "?count=exact&limit=4"),
+            ("cards-by-user", "async-cards-by-user", "?username=bob"),
+            ("trade-offers-list", "async-trade-list", ""),
+        ]
+        for sync_name, async_name, query in pairs:
+            with self.subTest(url=async_name):
+                authentication.get_user_cache().clear()
+                expected = await sync_to_async(client.get)(
+                    reverse(sync_name) + query
+                )
+                # Both views share the collection and user caches; make them
+                # both build and both load the user
+                caching.get_cache().local.clear()
+                authentication.get_user_cache().clear()
+                response = await async_client.get(
+                    reverse(async_name) + query,
+                    headers={"Authorization": f"Bearer {token}"},
+                )
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json(), expected.json())
+                # The query collector follows async views onto the ORM thread
+                self.assertEqual(
+                    response["X-DB-Query-Count"], expected["X-DB-Query-Count"]
+                )
+
+    async def test_async_endpoints_require_a_token(self):
+        response = await AsyncClient().get(reverse("async-trade-list"))
+        self.assertEqual(response.status_code, 401)
+
+    def test_going_over_budget_fails(self):
+        with mock.patch.object(CardMarketplaceView, "query_budget", {"get": 1}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(reverse("card-marketplace") + "?count=exact")
+
+    def test_reports_n_plus_one_origin(self):
+        with collect_queries(trace_origins=True) as collector:
+            CardSerializer(Card.objects.all(), many=True).data
+
+        repeated = collector.repeated_queries(threshold=3)
+        self.assertEqual(len(repeated), 1)
+        _, runs, origin = repeated[0]
+        self.assertEqual(runs, 30)
+        self.assertEqual(origin, "CardSerializer.owner_username")
+
+
+class IndexUsageTests(TestCase):
+    """The hot endpoints must be answered from an index, not a table scan"""
+
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(username="alice", password="pw")
+        self.bob = CustomUser.objects.create_user(username="bob", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+        mine = Card.objects.create(name="Pikachu", owner=self.alice, price=-1)
+        theirs = Card.objects.create(name="Eevee", owner=self.bob, price=-1)
+        Card.objects.create(name="Mew", owner=self.bob, price=100)
+        TradeOffer.objects.create(
+            sender=self.alice, recipient=self.bob, sender_card=mine, recipient_card=theirs
+        )
+
+    def query_plans(self, url):
+        """Run EXPLAIN QUERY PLAN on every query issued while serving `url`"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        plans = []
+        with connection.cursor() as cursor:
+            for query in context.captured_queries:
+                cursor.execute("EXPLAIN QUERY PLAN " + query["sql"])
+                plans.extend(row[3] for row in cursor.fetchall())
+        return plans
+
+    def test_endpoints_avoid_table_scans(self):
+        urls = [
+            reverse("card-list") + "?owner=bob",
+            reverse("card-marketplace"),
+            reverse("card-marketplace") + "?sort=price&count=exact",
+            reverse("card-marketplace") + "?sort=-price&min_price=5&max_price=500",
+            reverse("cards-by-user") + "?username=bob",
+            reverse("trade-offers-list"),
+            reverse("trade-offers-list") + "?status=pending",
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                plans = self.query_plans(url)
+                scans = [
+                    plan
+                    for plan in plans
+                    if plan.startswith(("SCAN apis_card", "SCAN apis_tradeoffer"))
+                    and "USING" not in plan
+                ]
+                self.assertEqual(scans, [], plans)
+
+
+class CardSearchTests(TestCase):
+    def setUp(self):
+        self.seller = CustomUser.objects.create_user(username="seller", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.seller)
+
+        self.pikachu = Card.objects.create(name="Pikachu", owner=self.seller, price=10)
+        self.raichu = Card.objects.create(name="Shiny Pikachu", owner=self.seller, price=20)
+        self.eevee = Card.objects.create(name="Eevee", owner=self.seller, price=5)
+        Card.objects.create(name="Pikachu Promo", owner=self.seller, price=-1)
+
+    def test_index_is_used_on_sqlite(self):
+        self.assertTrue(search.fts_enabled())
+
+    def test_substring_matches_are_ranked_prefix_first(self):
+        ids = search.search_cards("PIKA")
+        self.assertEqual(ids, [self.pikachu.id, self.raichu.id])
+
+    def test_fuzzy_tolerates_typos(self):
+        self.assertEqual(search.search_cards("pikahu"), [])
+        self.assertIn(self.pikachu.id, search.search_cards("pikahu", fuzzy=True))
+
+    def test_index_follows_saves_and_deletes(self):
+        self.eevee.name = "Espeon"
+        self.eevee.save()
+        self.assertEqual(search.search_cards("eevee"), [])
+        self.assertEqual(search.search_cards("espeon"), [self.eevee.id])
+
+        self.pikachu.delete()
+        self.assertEqual(search.search_cards("pikachu"), [self.raichu.id])
+
+        call_command("rebuild_card_search", stdout=StringIO())
+        self.assertEqual(search.search_cards("pikachu"), [self.raichu.id])
+
+    def test_marketplace_name_filter_uses_search(self):
+        response = self.client.get(reverse("card-marketplace"), {"name": "kachu"})
+        names = sorted(card["name"] for card in response.json()["cards"])
+        self.assertEqual(names, ["Pikachu", "Shiny Pikachu"])
+
+        # Queries shorter than a trigram fall back to icontains
+        response = self.client.get(reverse("card-marketplace"), {"name": "ee"})
+        self.assertEqual([card["name"] for card in response.json()["cards"]], ["Eevee"])
+
+    def test_search_endpoint(self):
+        response = self.client.get(reverse("card-search"), {"q": "pika"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [card["name"] for card in response.data["cards"]],
+            ["Pikachu", "Shiny Pikachu"],
+        )
+
+        response = self.client.get(reverse("card-search"))
+        self.assertEqual(response.status_code, 400)
+
+
+class CardPurchaseViewTests(TestCase):
+    def setUp(self):
+        self.seller = CustomUser.objects.create_user(
+            username="seller", password="pw", account_balance=5
+        )
+        self.buyer = CustomUser.objects.create_user(
+            username="buyer", password="pw", account_balance=100
+        )
+        self.card = Card.objects.create(name="Mew", owner=self.seller, price=60)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+        self.url = reverse("card-purchase")
+
+    def test_purchase_moves_credits_with_narrow_updates(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(self.url, {"card_id": self.card.id})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["new_balance"], 40)
+        self.assertEqual(CustomUser.balance_of(self.seller.pk), 65)
+        self.card.refresh_from_db()
+        self.assertEqual((self.card.owner, self.card.price), (self.buyer, -1))
+
+        # Balances are only ever touched by conditional single-column UPDATEs
+        user_writes = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith('UPDATE "apis_customuser"')
+        ]
+        self.assertEqual(len(user_writes), 2)
+        for sql in user_writes:
+            self.assertNotIn("password", sql)
+
+    def test_insufficient_funds_changes_nothing(self):
+        self.card.update_versioned(price=500)
+        response = self.client.post(self.url, {"card_id": self.card.id})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("your balance is 100", response.data["error"])
+        self.assertEqual(CustomUser.balance_of(self.buyer.pk), 100)
+        self.assertEqual(CustomUser.balance_of(self.seller.pk), 5)
+        self.card.refresh_from_db()
+        self.assertEqual(self.card.owner, self.seller)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_bucket_refills_at_its_rate_up_to_the_burst(self):
+        store = throttling.BucketStore(max_buckets=10)
+        self.assertEqual(
+            [store.take("ash", rate=2, burst=3, now=0) for _ in range(4)],
+            [0, 0, 0, 0.5],
+        )
+        # One token back after half a second, but never more than the burst
+        self.assertEqual(store.take("ash", rate=2, burst=3, now=0.5), 0)
+        self.assertEqual(store.take("ash", rate=2, burst=3, now=100), 0)
+        self.assertEqual(store.take("ash", rate=2, burst=3, now=100), 0)
+        self.assertEqual(store.take("ash", rate=2, burst=3, now=100), 0)
+        self.assertGreater(store.take("ash", rate=2, burst=3, now=100), 0)
+
+    def test_rates(self):
+        self.assertEqual(throttling.parse_rate("5/s"), (5, 5))
+        self.assertEqual(throttling.parse_rate(("60/min", 10)), (1, 10))
+
+    def test_concurrency_limit_follows_latency(self):
+        limit = throttling.ConcurrencyLimit(initial=10, min_limit=2, max_limit=40)
+        for _ in range(10):
+            self.assertTrue(limit.acquire())
+        self.assertFalse(limit.acquire())
+        self.assertEqual(limit.rejected, 1)
+
+        def busy(latency, requests):
+            for _ in range(requests):
+                limit.release(latency)
+                while limit.acquire():
+                    pass
+
+        # Busy and as fast as usual: the cap grows
+        busy(0.01, 20)
+        grown = limit.limit
+        self.assertGreater(grown, 10)
+
+        # Busy and much slower: it shrinks, but not below the minimum
+        busy(1.0, 50)
+        self.assertLess(limit.limit, grown / 2)
+        self.assertGreaterEqual(limit.limit, 2)
+
+
+@override_settings(THROTTLING={"RATES": {"purchase": ("1/m", 2)}})
+class ThrottlingTests(TestCase):
+    def setUp(self):
+        throttling.get_store().clear()
+        self.ash = CustomUser.objects.create_user(username="ash", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.ash)
+
+    def test_writes_over_the_rate_get_429(self):
+        codes = [
+            self.client.post(reverse("card-purchase"), {"card_id": 0}).status_code
+            for _ in range(3)
+        ]
+        self.assertEqual(codes, [404, 404, 429])
+        response = self.client.post(reverse("card-purchase"), {"card_id": 0})
+        self.assertEqual(int(response["Retry-After"]), 60)
+
+        # Other users and other endpoints have their own buckets
+        self.client.force_authenticate(
+            CustomUser.objects.create_user(username="brock", password="pw")
+        )
+        self.assertEqual(
+            self.client.post(reverse("card-purchase"), {"card_id": 0}).status_code, 404
+        )
+        self.client.force_authenticate(self.ash)
+        self.assertEqual(
+            self.client.post(reverse("card-transfer"), {}).status_code, 400
+        )
+
+    def test_reads_are_not_throttled(self):
+        for _ in range(5):
+            self.assertEqual(
+                self.client.get(reverse("card-marketplace")).status_code, 200
+            )
+
+    def test_full_route_groups_shed_requests(self):
+        purchases = throttling.get_limit("purchase")
+        taken = 0
+        while purchases.acquire():
+            taken += 1
+        try:
+            response = self.client.post(reverse("card-purchase"), {"card_id": 0})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response["Retry-After"], "1")
+            # Reads have a cap of their own
+            self.assertEqual(
+                self.client.get(reverse("card-marketplace")).status_code, 200
+            )
+        finally:
+            for _ in range(taken):
+                purchases.release(0.001)
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        self.admin = CustomUser.objects.create_superuser(username="root", password="pw")
+        self.ash = CustomUser.objects.create_user(
+            username="ash", password="pw", account_balance=100
+        )
+        self.client.force_login(self.admin)
+
+    def test_ledger_is_read_only(self):
+        entry = LedgerEntry.objects.get(user=self.ash)
+        self.assertEqual(
+            self.client.get(reverse("admin:apis_ledgerentry_changelist")).status_code, 200
+        )
+        response = self.client.post(
+            reverse("admin:apis_ledgerentry_delete", args=[entry.pk]), {"post": "yes"}
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(LedgerEntry.objects.filter(pk=entry.pk).exists())
+
+    def test_balance_is_not_editable(self):
+        url = reverse("admin:apis_customuser_change", args=[self.ash.pk])
+        response = self.client.get(url)
+        self.assertNotIn("account_balance", response.context["adminform"].form.fields)
+
+        data = {
+            "username": "ash",
+            "account_balance": 1_000_000,
+            "date_joined_0": "2024-01-01",
+            "date_joined_1": "00:00:00",
+            "is_active": "on",
+        }
+        self.client.post(url, data)
+        self.assertEqual(CustomUser.balance_of(self.ash.pk), 100)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.clear()
+        self.seller = CustomUser.objects.create_user(username="seller", password="pw")
+        self.buyer = CustomUser.objects.create_user(
+            username="buyer", password="pw", account_balance=100
+        )
+        self.card = Card.objects.create(name="Mew", owner=self.seller, price=60)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+        self.staff = CustomUser.objects.create_user(
+            username="oak", password="pw", is_staff=True
+        )
+
+    def scrape(self, **headers):
+        scraper = APIClient()
+        if not headers:
+            scraper.force_login(self.staff)
+        response = scraper.get(reverse("metrics"), **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        return response.content.decode()
+
+    def test_requests_and_business_events(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("card-purchase"), {"card_id": self.card.id})
+        self.client.get(reverse("card-marketplace"))
+        body = self.scrape()
+
+        self.assertIn(
+            'poketrade_http_requests_total{route="card-purchase",method="POST",status="200"} 1',
+            body,
+        )
+        self.assertIn(
+            'poketrade_http_request_duration_seconds_count{route="card-marketplace",method="GET"} 1',
+            body,
+        )
+        self.assertIn(
+            'poketrade_http_request_queries_bucket{route="card-marketplace",method="GET",le="+Inf"} 1',
+            body,
+        )
+        self.assertIn("poketrade_purchases_total 1", body)
+        self.assertIn("poketrade_credits_moved_total 60", body)
+        self.assertIn('poketrade_events_total{type="card.sold"} 1', body)
+
+    def test_histograms_are_cumulative(self):
+        histogram = metrics.REQUEST_QUERIES
+        for count in (1, 4, 4, 200):
+            histogram.observe(count, route="test", method="GET")
+        lines = [
+            line for line in self.scrape().splitlines() if 'route="test"' in line
+        ]
+        self.assertIn(
+            'poketrade_http_request_queries_bucket{route="test",method="GET",le="1"} 1',
+            lines,
+        )
+        self.assertIn(
+            'poketrade_http_request_queries_bucket{route="test",method="GET",le="5"} 3',
+            lines,
+        )
+        self.assertIn(
+            'poketrade_http_request_queries_bucket{route="test",method="GET",le="+Inf"} 4',
+            lines,
+        )
+        self.assertIn('poketrade_http_request_queries_sum{route="test",method="GET"} 209', lines)
+
+    def test_threads_that_exit_keep_their_counts(self):
+        threads = [
+            threading.Thread(target=metrics.PURCHASES.inc, kwargs={"amount": 2})
+            for _ in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn("poketrade_purchases_total 6", self.scrape())
+        self.assertIn("poketrade_purchases_total 6", self.scrape())
+
+    def test_processes_are_added_up(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # What another worker wrote before it exited
+            with open(os.path.join(directory, "metrics-1.json"), "w") as file:
+                json.dump([["poketrade_purchases_total", [], [5]]], file)
+            metrics.PURCHASES.inc()
+            with override_settings(METRICS={"MULTIPROCESS_DIR": directory}):
+                body = self.scrape()
+            self.assertIn("poketrade_purchases_total 6", body)
+            self.assertTrue(
+                os.path.exists(os.path.join(directory, f"metrics-{os.getpid()}.json"))
+            )
+
+    def test_only_staff_by_default(self):
+        self.assertEqual(APIClient().get(reverse("metrics")).status_code, 403)
+        token = AccessToken.for_user(self.buyer)
+        response = APIClient().get(
+            reverse("metrics"), HTTP_AUTHORIZATION=f"Bearer {token}"
+        )
+        self.assertEqual(response.status_code, 403)
+        self.scrape(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.staff)}")
+
+    @override_settings(METRICS={"TOKEN": "s3cret"})
+    def test_token(self):
+        self.assertEqual(APIClient().get(reverse("metrics")).status_code, 403)
+        response = APIClient().get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong"
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(
+            "# TYPE poketrade_purchases_total counter",
+            self.scrape(HTTP_AUTHORIZATION="Bearer s3cret"),
+        )
+
+
+class CachedAuthenticationTests(TestCase):
+    def setUp(self):
+        authentication.get_user_cache().clear()
+        self.seller = CustomUser.objects.create_user(username="seller", password="pw")
+        self.buyer = CustomUser.objects.create_user(
+            username="buyer", password="pw", account_balance=100
+        )
+        self.card = Card.objects.create(name="Mew", owner=self.seller, price=60)
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.buyer)}"
+        )
+
+    def user_lookups(self):
+        """Request the change cursor and count the queries for the user"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("changes"))
+        self.assertEqual(response.status_code, 200)
+        return sum(
+            'FROM "apis_customuser"' in query["sql"]
+            for query in context.captured_queries
+        )
+
+    def test_user_is_loaded_once_until_saved(self):
+        self.assertEqual(self.user_lookups(), 1)
+        self.assertEqual(self.user_lookups(), 0)
+
+        self.buyer.email = "buyer@example.com"
+        self.buyer.save(update_fields=["email"])
+        self.assertEqual(self.user_lookups(), 1)
+
+    def test_purchase_ignores_the_cached_balance(self):
+        self.user_lookups()
+        # Spent elsewhere; QuerySet.update() leaves the cached user as it was
+        CustomUser.objects.filter(pk=self.buyer.pk).update(account_balance=50)
+
+        response = self.client.post(reverse("card-purchase"), {"card_id": self.card.id})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("your balance is 50", response.data["error"])
+
+    def test_deleted_users_are_not_authenticated(self):
+        self.user_lookups()
+        self.buyer.delete()
+        self.assertEqual(self.client.get(reverse("changes")).status_code, 401)
+
+
+class CollectionCacheTests(TestCase):
+    def setUp(self):
+        caching.get_cache().local.clear()
+        self.seller = CustomUser.objects.create_user(username="seller", password="pw")
+        self.buyer = CustomUser.objects.create_user(
+            username="buyer", password="pw", account_balance=100
+        )
+        self.card = Card.objects.create(name="Mew", owner=self.seller, price=60)
+        Card.objects.create(name="Ditto", owner=self.buyer, price=-1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def get(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertEqual(response.status_code, 200)
+        return response["X-Cache"], response.json()
+
+    def test_writes_invalidate_cached_pages(self):
+        self.assertEqual(self.get("card-marketplace")[0], "miss")
+        self.assertEqual(self.get("card-marketplace")[0], "local")
+        self.assertEqual(self.get("cards-by-user", username="buyer")[0], "miss")
+        self.assertEqual(self.get("cards-by-user", username="seller")[0], "miss")
+
+        self.client.post(reverse("card-purchase"), {"card_id": self.card.id})
+
+        source, data = self.get("card-marketplace")
+        self.assertEqual((source, data["cards"]), ("miss", []))
+        source, data = self.get("cards-by-user", username="buyer")
+        self.assertEqual(source, "miss")
+        self.assertEqual(sorted(card["name"] for card in data), ["Ditto", "Mew"])
+        # The seller's collection only held unlisted cards, but it still
+        # lost a card, so it was invalidated too
+        self.assertEqual(self.get("cards-by-user", username="seller")[0], "miss")
+
+    def test_save_moving_a_card_invalidates_both_owners(self):
+        self.get("cards-by-user", username="seller")
+        before = Generation.current(Generation.owner_key(self.seller.pk))
+
+        card = Card.objects.get(pk=self.card.pk)
+        card.owner = self.buyer
+        card.save()
+
+        self.assertNotEqual(
+            Generation.current(Generation.owner_key(self.seller.pk)), before
+        )
+
+    def test_conditional_requests(self):
+        urls = [
+            reverse("card-list") + "?owner=buyer",
+            reverse("cards-by-user") + "?username=buyer",
+            reverse("card-marketplace"),
+            reverse("trade-offers-list"),
+        ]
+        etags = {}
+        for url in urls:
+            with self.subTest(url=url):
+                etags[url] = self.client.get(url)["ETag"]
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response["ETag"], etags[url])
+                self.assertEqual(response.content, b"")
+                # Only the generations were read, and nothing was built
+                queries = [q["sql"] for q in context.captured_queries]
+                self.assertIn("apis_generation", queries[-1])
+
+        self.client.post(reverse("card-purchase"), {"card_id": self.card.id})
+        for url in urls[:3]:
+            with self.subTest(url=url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response["ETag"], etags[url])
+
+    def test_etag_varies_with_the_viewer(self):
+        url = reverse("card-marketplace") + "?exclude_mine=true"
+        mine = self.client.get(url)["ETag"]
+        self.client.force_authenticate(self.seller)
+        self.assertNotEqual(self.client.get(url)["ETag"], mine)
+
+    def test_lru_evicts_by_size(self):
+        lru = caching.LRUCache(max_bytes=10)
+        lru.set("a", b"1234")
+        lru.set("b", b"1234")
+        lru.get("a")
+        lru.set("c", b"1234")
+
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), b"1234")
+        self.assertEqual((lru.size, lru.stats["evictions"]), (8, 1))
+
+        # Entries larger than the whole cache are not stored at all
+        lru.set("d", b"x" * 11)
+        self.assertIsNone(lru.get("d"))
+
+    def test_shared_tier(self):
+        cache = caching.CollectionCache(max_bytes=0, shared_alias="default")
+        cache.shared.clear()
+        build = mock.Mock(return_value={"cards": []})
+        self.assertEqual(cache.get_or_build("k", build)[1], "miss")
+        self.assertEqual(cache.get_or_build("k", build)[1], "shared")
+        build.assert_called_once()
+        self.assertEqual(cache.get_stats()["hit_rate"], 0.5)
+
+
+class ChangesTests(TestCase):
+    def setUp(self):
+        self.seller = CustomUser.objects.create_user(username="seller", password="pw")
+        self.buyer = CustomUser.objects.create_user(
+            username="buyer", password="pw", account_balance=100
+        )
+        self.card = Card.objects.create(name="Mew", owner=self.seller, price=60)
+        self.ditto = Card.objects.create(name="Ditto", owner=self.buyer, price=-1)
+        self.client = APIClient()
+        self.url = reverse("changes")
+
+    def changes(self, user, since, **params):
+        self.client.force_authenticate(user)
+        response = self.client.get(self.url, dict(params, since=since))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_saving_a_card_logs_its_offers_in_constant_queries(self):
+        counts = []
+        for offers in (1, 4):
+            card = Card.objects.create(name=f"Card {offers}", owner=self.seller, price=-1)
+            for i in range(offers):
+                TradeOffer.objects.create(
+                    sender=self.buyer,
+                    recipient=self.seller,
+                    sender_card=Card.objects.create(name="Bid", owner=self.buyer, price=-1),
+                    recipient_card=card,
+                )
+            card.name = "Renamed"
+            with CaptureQueriesContext(connection) as context:
+                card.save()
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_saving_a_card_skips_settled_history(self):
+        old = TradeOffer.objects.create(
+            sender=self.buyer,
+            recipient=self.seller,
+            sender_card=self.ditto,
+            recipient_card=self.card,
+            status='declined',
+        )
+        TradeOffer.objects.filter(pk=old.pk).update(
+            updated_at=TradeOffer.settled_horizon() - timedelta(days=1)
+        )
+        cursor = ChangeLogEntry.objects.latest("id").id
+        self.ditto.name = "Renamed"
+        self.ditto.save()
+        self.assertFalse(
+            ChangeLogEntry.objects.filter(
+                id__gt=cursor, kind=ChangeLogEntry.TRADE, object_id=old.pk
+            ).exists()
+        )
+
+    def test_saving_an_unlisted_card_leaves_the_marketplace_alone(self):
+        self.ditto = Card.objects.get(pk=self.ditto.pk)
+        before = Generation.current(Generation.MARKETPLACE)
+        self.ditto.name = "Renamed"
+        self.ditto.save()
+        self.assertEqual(Generation.current(Generation.MARKETPLACE), before)
+
+        self.ditto.price = 5
+        self.ditto.save()
+        self.assertNotEqual(Generation.current(Generation.MARKETPLACE), before)
+
+    def test_sync_after_purchase_and_trade(self):
+        self.client.force_authenticate(self.buyer)
+        cursor = self.client.get(self.url).data["cursor"]
+
+        self.client.post(reverse("card-purchase"), {"card_id": self.card.id})
+        seller_card = Card.objects.create(name="Eevee", owner=self.seller, price=-1)
+        offer = TradeOffer.objects.create(
+            sender=self.buyer,
+            recipient=self.seller,
+            sender_card=self.ditto,
+            recipient_card=seller_card,
+        )
+
+        buyer = self.changes(self.buyer, cursor)
+        self.assertEqual([card["name"] for card in buyer["cards"]], ["Mew"])
+        self.assertEqual([trade["id"] for trade in buyer["trades"]], [offer.id])
+
+        seller = self.changes(self.seller, cursor)
+        self.assertEqual(seller["removed_cards"], [self.card.id])
+        self.assertEqual([card["name"] for card in seller["cards"]], ["Eevee"])
+
+        # Nothing new after the returned cursor
+        again = self.changes(self.buyer, buyer["cursor"])
+        self.assertEqual((again["cards"], again["trades"]), ([], []))
+        self.assertEqual(again["cursor"], buyer["cursor"])
+
+        # Deleting the card deletes the offer too
+        seller_card_id = seller_card.id
+        seller_card.delete()
+        seller = self.changes(self.seller, seller["cursor"])
+        self.assertEqual(seller["removed_cards"], [seller_card_id])
+        self.assertEqual(seller["removed_trades"], [offer.id])
+
+    def test_pages_through_entries(self):
+        self.client.force_authenticate(self.buyer)
+        cursor = self.client.get(self.url).data["cursor"]
+        for price in (1, 2, 3):
+            self.ditto.update_versioned(price=price)
+
+        first = self.changes(self.buyer, cursor, limit=2)
+        self.assertTrue(first["has_more"])
+        # Changes resolve to the card's current state, on every page
+        self.assertEqual([card["price"] for card in first["cards"]], [3])
+        second = self.changes(self.buyer, first["cursor"], limit=2)
+        self.assertFalse(second["has_more"])
+        self.assertEqual([card["price"] for card in second["cards"]], [3])
+
+    def test_compacted_cursor_expires(self):
+        self.client.force_authenticate(self.buyer)
+        cursor = self.client.get(self.url).data["cursor"]
+        self.ditto.update_versioned(price=5)
+        self.ditto.update_versioned(price=6)
+
+        out = StringIO()
+        call_command("compact_change_log", keep_days=0, stdout=out)
+        self.assertIn("Deleted", out.getvalue())
+
+        response = self.client.get(self.url, {"since": cursor})
+        self.assertEqual(response.status_code, 410)
+        # The newest entry survives, so current cursors still work
+        latest = self.client.get(self.url).data["cursor"]
+        self.assertEqual(self.changes(self.buyer, latest)["cards"], [])
+
+
+class FastPathTests(TestCase):
+    def setUp(self):
+        alice = CustomUser.objects.create_user(username="alice", password="pw")
+        bob = CustomUser.objects.create_user(username="bob", password="pw")
+        mine = Card.objects.create(name="Mew \u2028", owner=alice, price=-1)
+        theirs = Card.objects.create(name="Ditto", owner=bob, price=5)
+        TradeOffer.objects.create(
+            sender=alice, recipient=bob, sender_card=mine, recipient_card=theirs
+        )
+
+    def test_projections_match_serializers(self):
+        cards = Card.objects.select_related("owner").order_by("id")
+        self.assertEqual(
+            list(projections.cards(cards)),
+            [dict(row) for row in CardSerializer(cards, many=True).data],
+        )
+
+        offers = TradeOffer.objects.order_by("id")
+        expected = [dict(row) for row in TradeOfferSerializer(offers, many=True).data]
+        rows = [projections.format_trade(row) for row in projections.trades(offers)]
+        self.assertEqual(rows, expected)
+
+    def test_renderer_matches_drf(self):
+        offers = TradeOffer.objects.order_by("id")
+        data = {
+            "trades": TradeOfferSerializer(offers, many=True).data,
+            "raw": list(offers.values("created_at", "sender_card__name")),
+            "price": Decimal("1.50"),
+        }
+        self.assertEqual(
+            renderers.FastJSONRenderer().render(data), JSONRenderer().render(data)
+        )
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        alice = CustomUser.objects.create_user(username="alice", password="pw")
+        bob = CustomUser.objects.create_user(username="bob", password="pw")
+        Card.objects.create(name="Mew", owner=alice, price=-1)
+        Card.objects.create(name="Abra, Kadabra", owner=alice, price=4)
+        Card.objects.create(name="Ditto", owner=bob, price=5)
+        self.url = reverse("card-export")
+
+    def test_ndjson(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([row["name"] for row in rows], ["Mew", "Abra, Kadabra", "Ditto"])
+        self.assertEqual(rows[2]["owner_username"], "bob")
+
+    def test_csv_filtered(self):
+        response = self.client.get(
+            self.url, {"format": "csv", "owner": "alice", "for_sale": "true"}
+        )
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn('filename="cards.csv"', response["Content-Disposition"])
+        rows = list(csv.reader(
+            b"".join(response.streaming_content).decode().splitlines()
+        ))
+        self.assertEqual(rows[0], ["id", "name", "price", "version", "owner", "owner_username"])
+        self.assertEqual([row[1:3] for row in rows[1:]], [["Abra, Kadabra", "4"]])
+
+    def test_accept_header(self):
+        response = self.client.get(self.url, HTTP_ACCEPT="text/csv")
+        self.assertEqual(response["Content-Type"], "text/csv")
+
+    def test_unknown_format(self):
+        response = self.client.get(self.url, {"format": "xml"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_async_stream(self):
+        async def export():
+            response = await AsyncClient().get(self.url)
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        self.assertEqual(len(async_to_sync(export)().splitlines()), 3)
+
+
+class EventTests(TestCase):
+    def setUp(self):
+        self.seller = CustomUser.objects.create_user(username="seller", password="pw")
+        self.buyer = CustomUser.objects.create_user(
+            username="buyer", password="pw", account_balance=100
+        )
+        self.card = Card.objects.create(name="Mew", owner=self.seller, price=60)
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def test_purchase_publishes_after_commit(self):
+        broker = mock.Mock()
+        with mock.patch.object(events, "get_broker", return_value=broker):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                self.client.post(reverse("card-purchase"), {"card_id": self.card.id})
+                # Nothing goes out until the purchase has committed
+                broker.publish.assert_not_called()
+
+        self.assertEqual(len(callbacks), 1)
+        event = broker.publish.call_args.args[0]
+        self.assertEqual(event["type"], "card.sold")
+        self.assertEqual(event["card"]["owner_username"], "buyer")
+        self.assertEqual(event["previous_owner"], self.seller.pk)
+
+    def test_offers_canceled_by_a_purchase_are_published(self):
+        trainer = CustomUser.objects.create_user(username="trainer", password="pw")
+        offered = Card.objects.create(name="Eevee", owner=trainer, price=-1)
+        offer = TradeOffer.objects.create(
+            sender=trainer, recipient=self.seller, sender_card=offered, recipient_card=self.card
+        )
+        broker = events.InProcessBroker()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def subscribe():
+            return broker.subscribe()
+
+        async def received():
+            # Let the deliveries queued from this thread run
+            await asyncio.sleep(0)
+            published = []
+            while not subscription.queue.empty():
+                published.append(subscription.queue.get_nowait())
+            return published
+
+        subscription = loop.run_until_complete(subscribe())
+        with mock.patch.object(events, "get_broker", return_value=broker):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(reverse("card-purchase"), {"card_id": self.card.id})
+
+        self.assertEqual(response.data["canceled_offers"], 1)
+        canceled = [
+            event for event in loop.run_until_complete(received())
+            if event["type"] == "trade.canceled"
+        ]
+        self.assertEqual(len(canceled), 1)
+        self.assertEqual(canceled[0]["trade"]["id"], offer.pk)
+        self.assertEqual(canceled[0]["trade"]["status"], "canceled")
+        self.assertEqual(canceled[0]["users"], [trainer.pk, self.seller.pk])
+
+    def test_failed_purchase_publishes_nothing(self):
+        self.card.update_versioned(price=500)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse("card-purchase"), {"card_id": self.card.id})
+        self.assertEqual(callbacks, [])
+
+    def test_broker_delivers_across_threads(self):
+        broker = events.InProcessBroker(max_queue=2)
+
+        async def listen():
+            subscription = broker.subscribe()
+            thread = threading.Thread(
+                target=lambda: [broker.publish({"n": n}) for n in range(3)]
+            )
+            thread.start()
+            thread.join()
+            first = await asyncio.wait_for(subscription.get(), 1)
+            await subscription.get()
+            subscription.close()
+            return first, subscription.overflowed
+
+        first, overflowed = asyncio.run(listen())
+        self.assertEqual(first, {"n": 0, "id": 1})
+        # The third event did not fit in the queue
+        self.assertTrue(overflowed)
+
+    def test_trade_events_only_reach_the_parties(self):
+        event = {"type": "trade.created", "users": [1, 2]}
+        self.assertTrue(events.visible_to(event, 2))
+        self.assertFalse(events.visible_to(event, 3))
+        self.assertTrue(events.visible_to({"users": None}, 3))
+
+    async def test_stream_requires_a_token(self):
+        response = await AsyncClient().get(reverse("event-stream"))
+        self.assertEqual(response.status_code, 401)
+
+
+class ImportCardsTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(username="alice", password="pw")
+        self.bob = CustomUser.objects.create_user(username="bob", password="pw")
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as file:
+            file.write(content)
+        return path
+
+    def test_csv(self):
+        path = self.write(
+            "cards.csv", "name,owner,price\nMew,alice,\nDitto,bob,5\nAbra,alice,-1\n"
+        )
+        call_command("import_cards", path, batch_size=2, stdout=StringIO())
+
+        cards = Card.objects.order_by("id").values_list("name", "owner__username", "price")
+        self.assertEqual(
+            list(cards), [("Mew", "alice", -1), ("Ditto", "bob", 5), ("Abra", "alice", -1)]
+        )
+        self.assertFalse(ImportCheckpoint.objects.exists())
+        self.assertEqual(
+            ChangeLogEntry.objects.filter(user=self.alice, kind="card").count(), 2
+        )
+        self.assertNotEqual(Generation.current(Generation.MARKETPLACE)["marketplace"], 0)
+
+    def test_json_array_is_read_in_chunks(self):
+        rows = [{"name": f"Card {i}", "owner": "bob"} for i in range(50)]
+        stream = StringIO(json.dumps(rows, indent=1))
+        self.assertEqual(list(read_json(stream, chunk_size=7)), rows)
+
+        stream = StringIO("\n".join(json.dumps(row) for row in rows))
+        self.assertEqual(list(read_json(stream, chunk_size=7)), rows)
+
+    def test_exports_reload(self):
+        Card.objects.create(name="Mew", owner=self.alice, price=3)
+        response = self.client.get(reverse("card-export"))
+        path = self.write("cards.ndjson", b"".join(response.streaming_content).decode())
+        call_command("import_cards", path, stdout=StringIO())
+        self.assertEqual(Card.objects.filter(name="Mew", owner=self.alice, price=3).count(), 2)
+
+    def test_bad_row_stops_and_resumes(self):
+        path = self.write("cards.csv", "name,owner\nMew,alice\nDitto,nobody\nAbra,bob\n")
+        with self.assertRaisesMessage(CommandError, "Row 2: no user named 'nobody'"):
+            call_command("import_cards", path, batch_size=1, stdout=StringIO())
+        self.assertEqual(list(Card.objects.values_list("name", flat=True)), ["Mew"])
+
+        self.write("cards.csv", "name,owner\nMew,alice\nDitto,alice\nAbra,bob\n")
+        out = StringIO()
+        call_command("import_cards", path, batch_size=1, stdout=out)
+        self.assertIn("Resuming after row 1", out.getvalue())
+        self.assertEqual(
+            list(Card.objects.order_by("id").values_list("name", flat=True)),
+            ["Mew", "Ditto", "Abra"],
+        )
+
+    def test_skip_invalid(self):
+        path = self.write(
+            "cards.json",
+            '[{"name": "Mew", "owner": "alice"}, {"name": "", "owner": "bob"},'
+            ' {"name": "Ditto", "owner": "nobody"}, {"name": "Abra", "owner": "bob", "price": "x"}]',
+        )
+        out = StringIO()
+        call_command("import_cards", path, skip_invalid=True, stdout=out)
+        self.assertIn("1 cards added, 3 skipped", out.getvalue())
+
+
+class ImportCardsIndexTests(TransactionTestCase):
+    def test_defer_indexes(self):
+        CustomUser.objects.create_user(username="alice", password="pw")
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as file:
+            file.write("name,owner,price\nCharizard,alice,9\nMew,alice,-1\n")
+            file.flush()
+            call_command("import_cards", file.name, defer_indexes=True, stdout=StringIO())
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, "apis_card")
+        for index in Card._meta.indexes:
+            self.assertIn(index.name, constraints)
+
+        charizard = Card.objects.get(name="Charizard")
+        self.assertEqual(search.search_cards("izar"), [charizard.pk])
+        # The triggers are back too
+        Card.objects.create(name="Charmander", owner=charizard.owner, price=1)
+        self.assertEqual(len(search.search_cards("char")), 2)
+
+
+class BenchmarkTests(TestCase):
+    def test_seed_and_bench_every_endpoint(self):
+        call_command(
+            "seed_data", users=10, cards=200, offers=100, stdout=StringIO()
+        )
+        whale = CustomUser.objects.get(username="seed_0")
+        self.assertGreater(whale.cards.count(), 200 * 0.5)
+        cards = Card.objects.count()
+
+        out = StringIO()
+        call_command(
+            "bench_endpoints", requests=3, warmup=0, stdout=out, stderr=StringIO()
+        )
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["meta"]["population"]["cards"], cards)
+        self.assertEqual(report["meta"]["writes"], "rolled back")
+        for name, endpoint in report["endpoints"].items():
+            self.assertEqual(endpoint["errors"], 0, (name, endpoint["statuses"]))
+            self.assertEqual(endpoint["requests"], 3)
+            self.assertLessEqual(
+                endpoint["latency_ms"]["p50"], endpoint["latency_ms"]["p99"]
+            )
+        self.assertGreater(report["endpoints"]["card-purchase"]["queries"]["mean"], 0)
+
+        # Everything the benchmark wrote was rolled back
+        self.assertEqual(Card.objects.count(), cards)
+        self.assertFalse(CustomUser.objects.filter(username__contains="bench").exists())
+
+    def test_every_route_is_benchmarked(self):
+        named = {
+            name for name in get_resolver("apis.urls").reverse_dict if isinstance(name, str)
+        }
+        endpoints = bench_endpoints.Command().endpoints()
+        self.assertEqual(bench_endpoints.covered_routes(endpoints), named)
+
+
+class LedgerTests(TestCase):
+    def setUp(self):
+        self.seller = CustomUser.objects.create_user(
+            username="seller", password="pw", account_balance=0
+        )
+        self.buyer = CustomUser.objects.create_user(
+            username="buyer", password="pw", account_balance=100
+        )
+
+    def test_opening_balances_and_transfers_reconcile(self):
+        self.assertTrue(ledger.transfer(self.buyer.pk, self.seller.pk, 30))
+        self.assertFalse(ledger.transfer(self.buyer.pk, self.seller.pk, 500))
+
+        self.assertEqual(ledger.balance(self.buyer.pk), 70)
+        self.assertEqual(ledger.balance(self.seller.pk), 30)
+        self.assertEqual(ledger.reconcile(), [])
+
+    @override_settings(LEDGER_BALANCE_SHARDS=4)
+    def test_sharded_credits_are_spendable(self):
+        for _ in range(5):
+            ledger.transfer(self.buyer.pk, self.seller.pk, 10)
+
+        # The sales went to shards, not the seller's row
+        self.assertEqual(CustomUser.balance_of(self.seller.pk), 0)
+        self.assertEqual(ledger.balance(self.seller.pk), 50)
+
+        # Spending more than account_balance folds the shards in first
+        self.assertTrue(ledger.transfer(self.seller.pk, self.buyer.pk, 45))
+        self.assertEqual(ledger.balance(self.seller.pk), 5)
+        self.assertEqual(ledger.reconcile(), [])
+
+    def test_compaction_keeps_totals(self):
+        ledger.transfer(self.buyer.pk, self.seller.pk, 30)
+        written, pruned = ledger.compact(prune=True, settle_seconds=0)
+        self.assertEqual((written, pruned), (2, 3))
+
+        ledger.transfer(self.seller.pk, self.buyer.pk, 10)
+        self.assertEqual(ledger.compact(settle_seconds=0)[0], 2)
+        self.assertEqual(ledger.reconcile(), [])
+        self.assertEqual(
+            BalanceSnapshot.objects.get(user=self.seller).balance, 20
+        )
+
+    def test_reconcile_finds_changes_made_outside_the_ledger(self):
+        CustomUser.objects.filter(pk=self.seller.pk).update(account_balance=7)
+        self.assertEqual(ledger.reconcile(), [(self.seller.pk, 0, 7)])
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command("reconcile_ledger", stdout=out)
+        call_command("reconcile_ledger", fix=True, stdout=out)
+        self.assertEqual(ledger.reconcile(), [])
+
+
+class StorageProfileTests(TestCase):
+    def test_tuned_profile_is_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual(cursor.fetchone()[0], "wal")
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+        self.assertEqual(connection.transaction_mode, "IMMEDIATE")
+
+    def test_unknown_profile(self):
+        with override_settings(SQLITE_PROFILE="fast"):
+            with self.assertRaises(ImproperlyConfigured):
+                storage.get_profile()
+
+
+@override_settings(READ_REPLICAS={"ALIASES": ["replica"]})
+class ReplicaRouterTests(SimpleTestCase):
+    def test_reads_go_to_the_primary_unless_allowed(self):
+        self.assertEqual(router.db_for_read(Card), "default")
+        with routing.reading_from_replicas():
+            self.assertEqual(router.db_for_read(Card), "replica")
+            self.assertEqual(router.db_for_write(Card), "default")
+
+    @override_settings(READ_REPLICAS={"ALIASES": ["replica", "other"]})
+    def test_one_replica_per_request(self):
+        for _ in range(10):
+            with routing.reading_from_replicas():
+                aliases = {router.db_for_read(model) for model in (Card, CustomUser) * 5}
+            self.assertEqual(len(aliases), 1)
+
+    def test_related_reads_stay_on_the_instance_database(self):
+        card = Card(name="Eevee", price=-1)
+        card._state.db = "default"
+        with routing.reading_from_replicas():
+            self.assertEqual(router.db_for_read(CustomUser, instance=card), "default")
+
+
+# The primary stands in for the replica, so the views' queries still work
+@override_settings(READ_REPLICAS={"ALIASES": ["default"], "STICKY_SECONDS": 60})
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.alice = CustomUser.objects.create_user(username="alice", password="pw")
+        self.card = Card.objects.create(name="Eevee", owner=self.alice, price=-1)
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.alice)}"
+        )
+
+    def test_safe_reads_of_opted_in_views_use_replicas(self):
+        response = self.client.get(reverse("card-marketplace"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.wsgi_request.replica_reads)
+
+        response = self.client.get(reverse("changes"))
+        self.assertFalse(response.wsgi_request.replica_reads)
+
+    def test_writers_stick_to_the_primary(self):
+        other = APIClient()
+        other.force_authenticate(CustomUser.objects.create_user(username="bob"))
+
+        response = self.client.post(
+            reverse("card-marketplace"), {"card_id": self.card.id, "price": 10}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.wsgi_request.replica_reads)
+
+        response = self.client.get(reverse("card-marketplace"))
+        self.assertFalse(response.wsgi_request.replica_reads)
+        # Anonymous to the middleware, so not held back by alice's write
+        response = other.get(reverse("card-marketplace"))
+        self.assertTrue(response.wsgi_request.replica_reads)
+
+    def test_transactions_read_from_the_primary(self):
+        with override_settings(READ_REPLICAS={"ALIASES": ["replica"]}):
+            with routing.reading_from_replicas(), transaction.atomic():
+                self.assertEqual(router.db_for_read(Card), "default")
+
+
+class TradeHistoryTests(TestCase):
+    def setUp(self):
+        self.ash = CustomUser.objects.create_user(username="ash", password="pw")
+        self.brock = CustomUser.objects.create_user(username="brock", password="pw")
+        self.cards = [
+            Card.objects.create(name=f"Geodude {i}", owner=owner, price=-1)
+            for i, owner in enumerate([self.ash, self.brock] * 2)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.ash)
+
+    def offer(self, status, days_ago):
+        offer = TradeOffer.objects.create(
+            sender=self.ash,
+            recipient=self.brock,
+            sender_card=self.cards[0],
+            recipient_card=self.cards[1],
+            status=status,
+        )
+        when = timezone.now() - timedelta(days=days_ago)
+        TradeOffer.objects.filter(pk=offer.pk).update(created_at=when, updated_at=when)
+        return offer.pk
+
+    def history(self, **params):
+        response = self.client.get(reverse("trade-history"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_trade_list_only_shows_recently_settled_offers(self):
+        old_pending = self.offer("pending", 90)
+        recent = self.offer("accepted", 5)
+        old = self.offer("declined", 60)
+
+        response = self.client.get(reverse("trade-offers-list"))
+        self.assertEqual([trade["id"] for trade in response.json()], [recent, old_pending])
+        self.assertEqual([trade["id"] for trade in self.history()["trades"]], [old])
+
+    def test_archived_offers_read_the_same_in_history(self):
+        old = [self.offer(status, 60) for status in ("declined", "canceled", "accepted")]
+        self.offer("accepted", 5)
+        before = self.history()
+
+        # Part of the way, so the history has to merge both tables
+        ArchivedTradeOffer.archive_batch(TradeOffer.settled_horizon(), batch_size=2)
+        self.assertEqual(ArchivedTradeOffer.objects.count(), 2)
+        self.assertEqual(self.history(), before)
+
+        first = self.history(limit=2)
+        second = self.history(limit=2, cursor=first["next_cursor"])
+        self.assertIsNone(second["next_cursor"])
+        self.assertEqual(
+            [trade["id"] for trade in first["trades"] + second["trades"]], old[::-1]
+        )
+
+        call_command("archive_trades", stdout=StringIO())
+        self.assertEqual(TradeOffer.objects.count(), 1)
+        self.assertEqual(self.history(), before)
+        archived = ArchivedTradeOffer.objects.get(pk=old[0])
+        self.assertEqual(archived.sender_card_name, "Geodude 0")
+
+    def test_archived_offers_are_removed_from_delta_sync(self):
+        old = self.offer("declined", 60)
+        cursor = self.client.get(reverse("changes")).data["cursor"]
+
+        call_command("archive_trades", stdout=StringIO())
+        for user in (self.ash, self.brock):
+            self.client.force_authenticate(user)
+            response = self.client.get(reverse("changes"), {"since": cursor})
+            self.assertEqual(response.data["removed_trades"], [old])
+            self.assertEqual(response.data["trades"], [])
+
+
+class StaleOfferTests(TestCase):
+    def setUp(self):
+        self.ash, self.brock, self.misty = [
+            CustomUser.objects.create_user(username=name, password="pw")
+            for name in ("ash", "brock", "misty")
+        ]
+        self.pikachu, self.onix, self.staryu = [
+            Card.objects.create(name=name, owner=owner, price=-1)
+            for name, owner in [
+                ("Pikachu", self.ash), ("Onix", self.brock), ("Staryu", self.misty)
+            ]
+        ]
+        # Everyone wants Onix; Brock would rather have Staryu
+        self.offers = [
+            TradeOffer.objects.create(
+                sender=sender, recipient=recipient, sender_card=offered, recipient_card=wanted
+            )
+            for sender, offered, recipient, wanted in [
+                (self.ash, self.pikachu, self.brock, self.onix),
+                (self.misty, self.staryu, self.brock, self.onix),
+                (self.brock, self.onix, self.misty, self.staryu),
+            ]
+        ]
+        self.client = APIClient()
+
+    def statuses(self):
+        return [
+            TradeOffer.objects.get(pk=offer.pk).status for offer in self.offers
+        ]
+
+    def test_listing_a_card_cancels_its_offers(self):
+        self.client.force_authenticate(self.brock)
+        response = self.client.post(
+            reverse("card-marketplace"), {"card_id": self.onix.id, "price": 100}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["canceled_offers"], 3)
+        self.assertEqual(self.statuses(), ["canceled"] * 3)
+
+        # And off the pending lists straight away
+        self.client.force_authenticate(self.ash)
+        trades = self.client.get(reverse("trade-offers-list")).json()
+        self.assertEqual([trade["status"] for trade in trades], ["canceled"])
+
+    def test_accepting_cancels_other_offers_for_both_cards(self):
+        self.client.force_authenticate(self.brock)
+        response = self.client.post(
+            reverse("trade-action"), {"trade_id": self.offers[0].id, "action": "accept"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["canceled_offers"], 2)
+        self.assertEqual(self.statuses(), ["accepted", "canceled", "canceled"])
+
+    def test_transfer_cancels_the_cards_offers(self):
+        self.client.force_authenticate(self.ash)
+        response = self.client.post(
+            reverse("card-transfer"),
+            {"card_id": self.pikachu.id, "recipient_username": "misty"},
+        )
+        self.assertEqual(response.data["canceled_offers"], 1)
+        self.assertEqual(self.statuses(), ["canceled", "pending", "pending"])
+
+
+class BatchTradeActionTests(TestCase):
+    def setUp(self):
+        self.ash, self.brock = [
+            CustomUser.objects.create_user(username=name, password="pw")
+            for name in ("ash", "brock")
+        ]
+        self.cards = {
+            owner: [
+                Card.objects.create(name=f"{owner.username} {i}", owner=owner, price=-1)
+                for i in range(6)
+            ]
+            for owner in (self.ash, self.brock)
+        }
+        # Ash offers each of their cards for the Brock card of the same number
+        self.offers = [
+            TradeOffer.objects.create(
+                sender=self.ash,
+                recipient=self.brock,
+                sender_card=offered,
+                recipient_card=wanted,
+            )
+            for offered, wanted in zip(self.cards[self.ash], self.cards[self.brock])
+        ]
+        self.client = APIClient()
+
+    def batch(self, *actions):
+        return self.client.post(
+            reverse("trade-action-batch"),
+            {"actions": [
+                {"trade_id": trade_id, "action": action} for trade_id, action in actions
+            ]},
+            format="json",
+        )
+
+    def test_results_come_back_in_request_order(self):
+        self.client.force_authenticate(self.brock)
+        response = self.batch(
+            (self.offers[2].id, "decline"),
+            (self.offers[0].id, "accept"),
+            (self.offers[1].id, "cancel"),
+            (0, "decline"),
+            (self.offers[0].id, "decline"),
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.data["results"]
+        self.assertEqual(
+            [(result["trade_id"], result["ok"]) for result in results],
+            [
+                (self.offers[2].id, True),
+                (self.offers[0].id, True),
+                (self.offers[1].id, False),
+                (0, False),
+                (self.offers[0].id, False),
+            ],
+        )
+        self.assertEqual(results[0]["status"], "declined")
+        self.assertEqual(results[1]["status"], "accepted")
+        self.assertEqual(results[1]["canceled_offers"], 0)
+        self.assertEqual(results[2]["error"], "Only the sender can cancel a trade offer")
+        self.assertEqual(results[3]["error"], "Trade offer not found")
+        self.assertIn("more than once", results[4]["error"])
+
+        self.cards[self.ash][0].refresh_from_db()
+        self.assertEqual(self.cards[self.ash][0].owner, self.brock)
+        self.assertEqual(
+            [offer.status for offer in TradeOffer.objects.order_by("pk")],
+            ["accepted", "pending", "declined", "pending", "pending", "pending"],
+        )
+
+    def test_repeated_items_get_their_own_result(self):
+        self.client.force_authenticate(self.brock)
+        response = self.batch(
+            (self.offers[0].id, "decline"), (self.offers[0].id, "decline")
+        )
+        first, second = response.data["results"]
+        self.assertEqual((first["ok"], first["status"]), (True, "declined"))
+        self.assertFalse(second["ok"])
+        self.assertIn("more than once", second["error"])
+
+    def test_accepts_fail_one_at_a_time(self):
+        # Ash's first card is gone before Brock gets to the offer
+        self.cards[self.ash][0].owner = self.brock
+        self.cards[self.ash][0].save()
+
+        self.client.force_authenticate(self.brock)
+        response = self.batch(
+            (self.offers[0].id, "accept"), (self.offers[1].id, "accept")
+        )
+        results = response.data["results"]
+        self.assertFalse(results[0]["ok"])
+        self.assertIn("no longer be available", results[0]["error"])
+        self.assertTrue(results[1]["ok"])
+        self.assertEqual(
+            [offer.status for offer in TradeOffer.objects.order_by("pk")[:2]],
+            ["canceled", "accepted"],
+        )
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        self.client.force_authenticate(self.ash)
+        counts = []
+        for offers in (self.offers[:2], self.offers[2:]):
+            with CaptureQueriesContext(connection) as context:
+                response = self.batch(*[(offer.id, "cancel") for offer in offers])
+            self.assertTrue(all(result["ok"] for result in response.data["results"]))
+            counts.append(len(context.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    @override_settings(QUERY_INSTRUMENTATION_HEADERS=True)
+    def test_accept_writes_its_changes_once(self):
+        self.client.force_authenticate(self.brock)
+        response = self.client.post(
+            reverse("trade-action"), {"trade_id": self.offers[0].id, "action": "accept"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-DB-N-Plus-One", response)
+
+    @override_settings(QUERY_INSTRUMENTATION_HEADERS=True)
+    def test_accepts_only_cancel_offers_for_their_own_cards(self):
+        self.client.force_authenticate(self.brock)
+        response = self.batch(*[(offer.id, "accept") for offer in self.offers[:3]])
+        self.assertEqual(
+            [result["ok"] for result in response.data["results"]], [True, True, True]
+        )
+        self.assertEqual(
+            [offer.status for offer in TradeOffer.objects.order_by("pk")[:4]],
+            ["accepted", "accepted", "accepted", "pending"],
+        )
+        for card in self.cards[self.ash][:3]:
+            card.refresh_from_db()
+            self.assertEqual((card.owner, card.version), (self.brock, 1))
+        self.assertNotIn("X-DB-N-Plus-One", response)
+
+    def test_an_accept_cancels_later_offers_for_its_cards(self):
+        rival = TradeOffer.objects.create(
+            sender=self.ash,
+            recipient=self.brock,
+            sender_card=self.cards[self.ash][5],
+            recipient_card=self.cards[self.brock][0],
+        )
+        self.client.force_authenticate(self.brock)
+        response = self.batch((rival.id, "accept"), (self.offers[0].id, "accept"))
+        rival_result, first_result = response.data["results"]
+        self.assertFalse(rival_result["ok"])
+        self.assertIn("no longer be available", rival_result["error"])
+        self.assertEqual(first_result["canceled_offers"], 1)
+        rival.refresh_from_db()
+        self.assertEqual(rival.status, "canceled")
+
+    def test_batched_changes_are_dropped_with_their_savepoint(self):
+        logged = ChangeLogEntry.objects.filter(user=self.ash, object_id__lt=0)
+        with transaction.atomic(), batch_changes():
+            ChangeLogEntry.record(ChangeLogEntry.CARD, -1, [self.ash.pk])
+            with self.assertRaises(ConcurrentUpdate):
+                with transaction.atomic(), batch_changes():
+                    ChangeLogEntry.record(ChangeLogEntry.CARD, -2, [self.ash.pk])
+                    raise ConcurrentUpdate
+            # Held back until the outer block ends
+            self.assertFalse(logged.exists())
+        self.assertEqual(list(logged.values_list("object_id", flat=True)), [-1])
+
+    def test_rejects_malformed_batches(self):
+        self.client.force_authenticate(self.ash)
+        for body in (
+            {},
+            {"actions": []},
+            {"actions": [{"trade_id": "1", "action": "cancel"}]},
+            {"actions": [{"trade_id": self.offers[0].id, "action": "steal"}]},
+        ):
+            response = self.client.post(
+                reverse("trade-action-batch"), body, format="json"
+            )
+            self.assertEqual(response.status_code, 400, body)
+
+
+class WantsGraphTests(SimpleTestCase):
+    def setUp(self):
+        self.graph = matching.WantsGraph()
+        # Offer id, offered card, wanted card: 1 -> 2 -> 3 -> 4 -> 1, plus
+        # a dead end and a second offer for the same cards
+        for offer in [(10, 1, 2), (11, 2, 3), (12, 3, 4), (13, 4, 1), (14, 2, 5), (15, 2, 3)]:
+            self.graph.add(*offer)
+
+    def test_finds_the_cycle_through_an_offer(self):
+        self.assertEqual(self.graph.find_cycle(12, max_length=4), [12, 13, 10, 11])
+        self.assertIsNone(self.graph.find_cycle(12, max_length=3))
+        self.assertIsNone(self.graph.find_cycle(14))
+
+    def test_removed_offers_break_cycles(self):
+        self.graph.remove(11)
+        self.assertEqual(self.graph.find_cycle(10), [10, 15, 12, 13])
+        self.graph.remove(15)
+        self.assertIsNone(self.graph.find_cycle(10))
+        self.assertEqual(len(self.graph), 4)
+
+
+# Matched as offers commit, inside the test's transaction
+@override_settings(TRADE_MATCHING={"BACKGROUND": False})
+class TradeMatchingTests(TestCase):
+    def setUp(self):
+        matching.get_engine().cursor = None
+        self.users = [
+            CustomUser.objects.create_user(username=name, password="pw")
+            for name in ("ash", "brock", "misty")
+        ]
+        self.cards = [
+            Card.objects.create(name=name, owner=user, price=-1)
+            for name, user in zip(("Pikachu", "Onix", "Staryu"), self.users)
+        ]
+
+    def offer(self, giver, taker):
+        """Have user `giver` offer their card for user `taker`'s"""
+        return TradeOffer.objects.create(
+            sender=self.users[giver],
+            recipient=self.users[taker],
+            sender_card=self.cards[giver],
+            recipient_card=self.cards[taker],
+        )
+
+    def owners(self):
+        return [
+            Card.objects.get(pk=card.pk).owner.username for card in self.cards
+        ]
+
+    def test_offer_closing_a_cycle_completes_the_trade(self):
+        first, second = self.offer(0, 1), self.offer(1, 2)
+        client = APIClient()
+        client.force_authenticate(self.users[2])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                reverse("trade-offers-list"),
+                {
+                    "recipient": self.users[0].pk,
+                    "sender_card": self.cards[2].pk,
+                    "recipient_card": self.cards[0].pk,
+                },
+            )
+
+        self.assertEqual(response.status_code, 201)
+        # Matched after the response was made
+        self.assertEqual(response.data["status"], "pending")
+        # Everyone gets the card they asked for
+        self.assertEqual(self.owners(), ["misty", "ash", "brock"])
+        for offer in (first, second, TradeOffer.objects.get(pk=response.data["id"])):
+            offer.refresh_from_db()
+            self.assertEqual(offer.status, "accepted")
+
+    def test_stale_offer_is_canceled_and_nothing_moves(self):
+        first, second = self.offer(0, 1), self.offer(1, 2)
+        # Ash's card goes elsewhere after he offered it
+        gary = CustomUser.objects.create_user(username="gary")
+        self.cards[0].update_versioned(owner_id=gary.pk)
+        self.users[0] = gary
+        third = self.offer(2, 0)
+
+        self.assertIsNone(matching.get_engine().match(third.pk))
+        self.assertEqual(self.owners(), ["gary", "brock", "misty"])
+        first.refresh_from_db()
+        third.refresh_from_db()
+        self.assertEqual((first.status, third.status), ("canceled", "pending"))
+
+    @override_settings(TRADE_MATCHING={"BACKGROUND": True})
+    def test_new_offers_go_to_the_worker_once_committed(self):
+        worker = mock.Mock()
+        with mock.patch.object(matching, "get_worker", return_value=worker):
+            with self.captureOnCommitCallbacks(execute=True):
+                offer = self.offer(0, 1)
+                matching.offer_created(offer)
+                worker.submit.assert_not_called()
+        worker.submit.assert_called_once_with(offer.pk)
+
+    def test_worker_is_restarted_after_a_fork(self):
+        with mock.patch("threading.Thread.start"):
+            inherited = matching.MatchingWorker(matching.get_engine())
+        inherited.pid += 1
+        with mock.patch.object(matching, "_worker", inherited), mock.patch.object(
+            matching, "_engine", inherited.engine
+        ), mock.patch.object(matching, "MatchingWorker") as worker_class:
+            with self.assertLogs("apis.matching", "WARNING"):
+                worker = matching.get_worker()
+        self.assertIs(worker, worker_class.return_value)
+        # With an engine of its own, whose lock no other thread can hold
+        self.assertIsNot(worker_class.call_args.args[0], inherited.engine)
+
+    def test_worker_matches_waiting_offers_in_one_batch(self):
+        engine = mock.Mock()
+        with mock.patch("threading.Thread.start"):
+            worker = matching.MatchingWorker(engine)
+        for offer_id in (1, 2, 3):
+            worker.submit(offer_id)
+        worker.stop()
+        worker._run()
+        # Loaded first, then one sync for everything queued
+        self.assertEqual(
+            engine.match_many.call_args_list, [mock.call([]), mock.call([1, 2, 3])]
+        )
+
+    @override_settings(TRADE_MATCHING={"ON_CREATE": False})
+    def test_match_trades_command(self):
+        self.offer(0, 1), self.offer(1, 0)
+        call_command("match_trades", stdout=StringIO())
+        self.assertEqual(self.owners(), ["brock", "ash", "misty"])
+
+
+class ConcurrencyTests(TransactionTestCase):
+    def test_concurrent_market_activity_conserves_credits_and_cards(self):
+        out = StringIO()
+        call_command(
+            "stress_market",
+            users=6,
+            cards=40,
+            offers=20,
+            operations=200,
+            workers=8,
+            stdout=out,
+        )
+        self.assertIn("Credits and cards conserved", out.getvalue())
+
+    def test_only_one_buyer_wins(self):
+        seller = CustomUser.objects.create_user(username="seller", password="pw")
+        buyers = [
+            CustomUser.objects.create_user(
+                username=f"buyer{i}", password="pw", account_balance=100
+            )
+            for i in range(2)
+        ]
+        card = Card.objects.create(name="Mew", owner=seller, price=60)
+
+        # Both buyers loaded the card before either one bought it
+        stale = Card.objects.get(pk=card.pk)
+        card.update_versioned(owner=buyers[0], price=-1)
+        with self.assertRaises(ConcurrentUpdate):
+            stale.update_versioned(owner=buyers[1], price=-1)
+
+        card.refresh_from_db()
+        self.assertEqual(card.owner, buyers[0])
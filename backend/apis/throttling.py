@@ -0,0 +1,337 @@
+"""
+Rate limiting and load shedding
+
+TokenBucketThrottle is a DRF throttle that gives every user a token bucket
+per `throttle_scope` declared on a view. Each write takes a token; tokens
+come back at the scope's rate, up to its burst. Reads are never throttled.
+A user over their rate gets a 429 with Retry-After set to when their next
+token is due.
+
+AdaptiveConcurrencyMiddleware caps the requests in flight per route group
+and sheds the excess with an immediate 503, before authentication or any
+query. The cap of each group adapts to its latency, in the manner of
+Netflix's gradient limiter: while requests take about as long as they
+usually do, the cap grows by a small queue allowance; when they slow down,
+it shrinks in proportion, down to half per update. Groups have separate
+caps, so a rush of purchases, which SQLite serialises, can't take the
+threads the marketplace reads need.
+
+A view picks its group with `concurrency_group`, a name for the whole view
+or, like `query_budget`, a dict keyed by viewset action or lowercase
+method. Anything else is "read" for GET and HEAD and "write" otherwise.
+
+Both keep their state in this process. With several worker processes a
+user gets each rate once per process, and each process adapts its caps to
+what it sees.
+
+Settings:
+    THROTTLING: {
+        "ENABLED": default True
+        "RATES": scope -> "N/period" (s, m, h or d), or ("N/period", burst);
+            the burst defaults to N. Scopes without a rate aren't throttled.
+        "MAX_BUCKETS": buckets kept per process, least recently used
+            dropped first, default 100000
+    }
+    CONCURRENCY_LIMITS: {
+        "ENABLED": default True
+        "GROUPS": group -> {"INITIAL", "MIN", "MAX", "TOLERANCE",
+            "SMOOTHING"}, each defaulting to DEFAULT_LIMIT's
+    }
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework.throttling import BaseThrottle
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+DEFAULT_LIMIT = {
+    # Requests in flight to start with, and the bounds of the cap
+    "INITIAL": 20,
+    "MIN": 4,
+    "MAX": 200,
+    # How much slower than usual requests may get before the cap shrinks
+    "TOLERANCE": 1.5,
+    # Weight of each update in the cap
+    "SMOOTHING": 0.2,
+}
+# Completed requests the latencies are averaged over
+SHORT_WINDOW = 10
+LONG_WINDOW = 600
+
+
+def throttle_settings():
+    options = getattr(settings, "THROTTLING", {})
+    return {
+        "ENABLED": options.get("ENABLED", True),
+        "RATES": options.get("RATES", {}),
+        "MAX_BUCKETS": options.get("MAX_BUCKETS", 100_000),
+    }
+
+
+def parse_rate(limit):
+    """
+    Returns:
+        tuple: (tokens per second, burst) for a "N/period" string, or a
+            ("N/period", burst) pair
+    """
+    burst = None
+    if not isinstance(limit, str):
+        limit, burst = limit
+    count, period = limit.split("/")
+    count = int(count)
+    return count / PERIODS[period[0]], burst or count
+
+
+class BucketStore:
+    """Thread-safe token buckets by key, least recently used dropped first"""
+
+    def __init__(self, max_buckets):
+        self.max_buckets = max_buckets
+        # key -> (tokens, when they were counted)
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        """
+        Take a token from the bucket at `key`, which starts full
+
+        Returns:
+            float: 0 if a token was taken, or else the seconds until one is due
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            tokens, counted = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - counted) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            # A dropped bucket starts full again, which only errs towards
+            # letting a request through
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = BucketStore(throttle_settings()["MAX_BUCKETS"])
+    return _store
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Throttle writes per user and `throttle_scope` of the view"""
+
+    def allow_request(self, request, view):
+        self.wait_seconds = None
+        options = throttle_settings()
+        if not options["ENABLED"] or request.method in SAFE_METHODS:
+            return True
+        scope = getattr(view, "throttle_scope", None)
+        limit = options["RATES"].get(scope) if scope else None
+        if limit is None:
+            return True
+
+        if request.user and request.user.is_authenticated:
+            ident = f"user:{request.user.pk}"
+        else:
+            ident = f"ip:{self.get_ident(request)}"
+        rate, burst = parse_rate(limit)
+        wait = get_store().take(f"{scope}:{ident}", rate, burst)
+        if wait:
+            self.wait_seconds = wait
+            return False
+        return True
+
+    def wait(self):
+        return self.wait_seconds
+
+
+def concurrency_settings():
+    options = getattr(settings, "CONCURRENCY_LIMITS", {})
+    return {
+        "ENABLED": options.get("ENABLED", True),
+        "GROUPS": options.get("GROUPS", {}),
+    }
+
+
+class ConcurrencyLimit:
+    """A cap on requests in flight that follows their latency"""
+
+    def __init__(self, initial=20, min_limit=4, max_limit=200, tolerance=1.5, smoothing=0.2):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.rejected = 0
+        # Moving averages of recent latency, and of latency in general
+        self.short_latency = None
+        self.long_latency = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Returns:
+            bool: Whether the request may go ahead; if so, release() it
+        """
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency):
+        with self._lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            self._update(latency, in_flight)
+
+    def _update(self, latency, in_flight):
+        if self.long_latency is None:
+            self.short_latency = self.long_latency = latency
+            return
+        self.short_latency += (latency - self.short_latency) / SHORT_WINDOW
+        self.long_latency += (latency - self.long_latency) / LONG_WINDOW
+        # After a lasting slow-down has passed, don't take the slow times as usual
+        if self.long_latency > 2 * self.short_latency:
+            self.long_latency *= 0.95
+        # A cap that isn't being reached says nothing about what we can take
+        if in_flight < self.limit / 2:
+            return
+
+        gradient = 1.0
+        if self.short_latency > 0:
+            gradient = max(
+                0.5, min(1.0, self.tolerance * self.long_latency / self.short_latency)
+            )
+        target = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit * (1 - self.smoothing) + target * self.smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+                "latency_ms": round((self.short_latency or 0) * 1000, 2),
+            }
+
+
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def get_limit(group):
+    limit = _limits.get(group)
+    if limit is None:
+        with _limits_lock:
+            limit = _limits.get(group)
+            if limit is None:
+                options = {
+                    **DEFAULT_LIMIT,
+                    **concurrency_settings()["GROUPS"].get(group, {}),
+                }
+                limit = _limits[group] = ConcurrencyLimit(
+                    initial=options["INITIAL"],
+                    min_limit=options["MIN"],
+                    max_limit=options["MAX"],
+                    tolerance=options["TOLERANCE"],
+                    smoothing=options["SMOOTHING"],
+                )
+    return limit
+
+
+def concurrency_stats():
+    """Returns: dict of group -> the stats of its limit"""
+    return {group: limit.stats() for group, limit in list(_limits.items())}
+
+
+def view_concurrency_group(view_func, method):
+    """Look up the route group of the view behind `view_func`"""
+    view_class = getattr(view_func, "cls", None) or getattr(view_func, "view_class", None)
+    group = getattr(view_class, "concurrency_group", None)
+
+    if isinstance(group, dict):
+        actions = getattr(view_func, "actions", None) or {}
+        group = group.get(actions.get(method.lower(), method.lower()))
+    if group is None:
+        group = "read" if method in SAFE_METHODS else "write"
+    return group
+
+
+class AdaptiveConcurrencyMiddleware:
+    """
+    Shed requests beyond the concurrency cap of their route group
+
+    The request holds its place from just before the view runs until the
+    response is returned; a streaming response gives it back before it is
+    streamed.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        try:
+            return self.get_response(request)
+        finally:
+            self.release(request)
+
+    async def __acall__(self, request):
+        try:
+            return await self.get_response(request)
+        finally:
+            self.release(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not concurrency_settings()["ENABLED"]:
+            return None
+        group = view_concurrency_group(view_func, request.method)
+        limit = get_limit(group)
+        if not limit.acquire():
+            return JsonResponse(
+                {"error": "The server is busy, please try again"},
+                status=503,
+                headers={"Retry-After": "1"},
+            )
+        request.concurrency_slot = (limit, time.perf_counter())
+        return None
+
+    def release(self, request):
+        slot = getattr(request, "concurrency_slot", None)
+        if slot is not None:
+            request.concurrency_slot = None
+            limit, started = slot
+            limit.release(time.perf_counter() - started)
@@ -11,7 +11,17 @@ from .views import (
     CardMarketplaceView,
     CardTradeViewSet,
     TradeOfferActionView,
-    GetUserCardsView
+    TradeOfferBatchActionView,
+    TradeHistoryView,
+    GetUserCardsView,
+    CardSearchView,
+    EventStreamView,
+    CacheStatsView,
+    MetricsView,
+    ChangesView,
+    AsyncCardMarketplaceView,
+    AsyncGetUserCardsView,
+    AsyncTradeListView,
 )
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
@@ -24,9 +34,6 @@ router.register(r"trades", CardTradeViewSet, basename="trade-offers")
 
 # URL patterns using the router
 urlpatterns = [
-    # Include the router URLs first
-    path("", include(router.urls)),
-    
     # Auth endpoints
     path("token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
@@ -40,7 +47,35 @@ urlpatterns = [
     path("cards/purchase/", CardPurchaseView.as_view(), name="card-purchase"),
     path("cards/marketplace/", CardMarketplaceView.as_view(), name="card-marketplace"),
     path("cards/by-user/", GetUserCardsView.as_view(), name="cards-by-user"),
+    path("cards/search/", CardSearchView.as_view(), name="card-search"),
     
     # Trade endpoints
     path("trades/action/", TradeOfferActionView.as_view(), name="trade-action"),
+    path("trades/action/batch/", TradeOfferBatchActionView.as_view(), name="trade-action-batch"),
+    path("trades/history/", TradeHistoryView.as_view(), name="trade-history"),
+
+    # Delta sync of the user's cards and trades
+    path("changes/", ChangesView.as_view(), name="changes"),
+
+    # Collection cache statistics (admin only)
+    path("cache/stats/", CacheStatsView.as_view(), name="cache-stats"),
+
+    # Prometheus metrics
+    path("metrics/", MetricsView.as_view(), name="metrics"),
+
+    # Async versions of the read-heavy endpoints (ASGI only)
+    path(
+        "async/cards/marketplace/",
+        AsyncCardMarketplaceView.as_view(),
+        name="async-card-marketplace",
+    ),
+    path("async/cards/by-user/", AsyncGetUserCardsView.as_view(), name="async-cards-by-user"),
+    path("async/trades/", AsyncTradeListView.as_view(), name="async-trade-list"),
+
+    # Server-sent change events (ASGI only)
+    path("events/", EventStreamView.as_view(), name="event-stream"),
+
+    # The router URLs go last: their detail routes (e.g. trades/<pk>/) would
+    # otherwise swallow the explicit paths above (e.g. trades/action/)
+    path("", include(router.urls)),
 ]
\ No newline at end of file
@@ -1,9 +1,18 @@
+import asyncio
+import hmac
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
+from django.views import View
 from rest_framework import viewsets, generics, status
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import (
     IsAuthenticated,
+    IsAdminUser,
     IsAuthenticatedOrReadOnly,
     AllowAny,
 )
@@ -11,7 +20,29 @@ from django.db import transaction
 from django.db.models import Q
 
 from .serializers import CardSerializer, TestModelSerializer, UserSerializer, TradeOfferSerializer
-from .models import Card, TestModel, CustomUser, TradeOffer
+from .models import (
+    ArchivedTradeOffer,
+    Card,
+    Generation,
+    TestModel,
+    CustomUser,
+    TradeOffer,
+    batch_changes,
+)
+from .concurrency import ConcurrentUpdate, retry_on_conflict
+from .pagination import (
+    InvalidCursor,
+    acapped_count,
+    apaginate_keyset,
+    capped_count,
+    encode_cursor,
+    paginate_keyset,
+)
+from . import (
+    caching, changelog, events, exports, ledger, matching, metrics, projections, search
+)
+from .authentication import raw_token, user_from_token
+from .renderers import CSVRenderer, NDJSONRenderer
 
 
 # Create your views here.
@@ -46,28 +77,68 @@ class CardViewSet(viewsets.ModelViewSet):
     queryset = Card.objects.all()
     serializer_class = CardSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+    # A list by owner also resolves the owner and reads their generation
+    query_budget = {"list": 4, "retrieve": 2, "export": 2}
+    # Not export: its rows are read while streaming, after the request is routed
+    replica_reads = ("list", "retrieve")
 
     def get_queryset(self):
         """
         Optionally restricts the returned cards to a given user,
         by filtering against the 'owner' query parameter.
         """
-        queryset = Card.objects.all()
+        queryset = Card.objects.select_related("owner")
         owner_username = self.request.query_params.get("owner")
 
         if owner_username:
-            try:
-                owner = CustomUser.objects.get(username=owner_username)
-                queryset = queryset.filter(owner=owner)
-            except CustomUser.DoesNotExist:
-                # If user doesn't exist, return empty queryset
-                queryset = Card.objects.none()
+            # Joining on the username returns nothing for unknown users
+            queryset = queryset.filter(owner__username=owner_username)
 
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        owner_username = request.query_params.get("owner")
+        owner_id = None
+        if owner_username:
+            owner_id = CustomUser.objects.filter(username=owner_username).values_list(
+                "pk", flat=True
+            ).first()
+        if owner_id is None:
+            # Every card, or nobody's; only per-owner lists have a generation
+            return super().list(request, *args, **kwargs)
+
+        def build():
+            return list(projections.cards(self.get_queryset()))
+
+        return caching.cached_response(
+            request, "card-list", [Generation.owner_key(owner_id)], build, owner=owner_id
+        )
+
+    @action(detail=False, renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request, *args, **kwargs):
+        """
+        Stream cards as NDJSON (default) or CSV, e.g. ?format=csv
+
+        Query parameters:
+            owner: only this user's cards
+            for_sale: only cards on the marketplace
+        """
+        queryset = self.get_queryset()
+        if request.query_params.get("for_sale", "").lower() in ("1", "true", "yes"):
+            queryset = queryset.filter(price__gte=0)
+
+        return exports.streaming_export(
+            request,
+            projections.cards(queryset).order_by("id"),
+            projections.CARD_FIELDS + ("owner_username",),
+            request.accepted_renderer.format,
+            "cards",
+        )
+
 
 class CardTransferView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = "transfer"
 
     def post(self, request, *args, **kwargs):
         # Get required parameters from request
@@ -81,16 +152,27 @@ class CardTransferView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        try:
+            return self.transfer(request, card_id, recipient_username)
+        except ConcurrentUpdate:
+            return Response(
+                {"error": "The card changed during the transfer, please try again"},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+    @retry_on_conflict
+    @batch_changes()
+    def transfer(self, request, card_id, recipient_username):
         # Check if card exists and user owns it
         try:
-            card = Card.objects.get(id=card_id)
+            card = Card.objects.select_for_update().get(id=card_id)
         except Card.DoesNotExist:
             return Response(
                 {"error": "Card not found"}, status=status.HTTP_404_NOT_FOUND
             )
 
         # Verify current user owns the card
-        if card.owner != request.user:
+        if card.owner_id != request.user.pk:
             return Response(
                 {"error": "You do not own this card"}, status=status.HTTP_403_FORBIDDEN
             )
@@ -112,15 +194,23 @@ class CardTransferView(APIView):
             )
 
         # Perform the transfer
-        card.owner = recipient
-        card.save()
+        previous_owner_id = card.owner_id
+        card.transfer_to(recipient)
+        # Offers made for the card by or to its old owner can't happen now
+        canceled_offers = len(TradeOffer.cancel_pending([card.pk]))
 
         # Return success response with updated card info
         serializer = CardSerializer(card)
+        events.publish(
+            "card.transferred",
+            card=serializer.data,
+            previous_owner=previous_owner_id,
+        )
         return Response(
             {
                 "message": f"Card '{card.name}' successfully transferred to {recipient.username}",
                 "card": serializer.data,
+                "canceled_offers": canceled_offers,
             },
             status=status.HTTP_200_OK,
         )
@@ -128,8 +218,9 @@ class CardTransferView(APIView):
 
 class CardPurchaseView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = "purchase"
+    concurrency_group = "purchase"
 
-    @transaction.atomic
     def post(self, request, *args, **kwargs):
         # Get required parameters from request
         card_id = request.data.get("card_id")
@@ -140,9 +231,28 @@ class CardPurchaseView(APIView):
                 {"error": "Card ID is required"}, status=status.HTTP_400_BAD_REQUEST
             )
 
+        try:
+            return self.purchase(request, card_id)
+        except ConcurrentUpdate:
+            return Response(
+                {"error": "The card changed while you were buying it, please try again"},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+    @retry_on_conflict
+    @batch_changes()
+    def purchase(self, request, card_id):
+        """
+        Buy the card in a single transaction
+
+        The card is locked and its write is conditional on its version, so two
+        buyers racing for the same card cannot both win; the loser is retried
+        from the start. Balances move through conditional UPDATEs on the
+        account_balance column alone, never through a full-row save.
+        """
         # Check if card exists
         try:
-            card = Card.objects.get(id=card_id)
+            card = Card.objects.select_for_update().get(id=card_id)
         except Card.DoesNotExist:
             return Response(
                 {"error": "Card not found"}, status=status.HTTP_404_NOT_FOUND
@@ -156,79 +266,172 @@ class CardPurchaseView(APIView):
             )
 
         # Check if user is trying to buy their own card
-        if card.owner == request.user:
+        if card.owner_id == request.user.pk:
             return Response(
                 {"error": "You already own this card"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Check if user has enough balance
-        buyer = request.user
-        if buyer.account_balance < card.price:
+        # Move the money; this fails if the buyer's balance is too low
+        price = card.price
+        if not ledger.transfer(request.user.pk, card.owner_id, price, card=card):
+            balance = ledger.balance(request.user.pk)
             return Response(
                 {
-                    "error": f"Insufficient funds. Card costs {card.price} but your balance is {buyer.account_balance}"
+                    "error": f"Insufficient funds. Card costs {price} but your balance is {balance}"
                 },
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Perform the transaction
-        try:
-            seller = card.owner
-            price = card.price
+        # Update card ownership and set it as not for sale after purchase.
+        # Losing this race rolls the balance changes back and retries.
+        seller_id = card.owner_id
+        card.update_versioned(owner=request.user, price=-1)
+        canceled_offers = len(TradeOffer.cancel_pending([card.pk]))
 
-            # Update balances
-            buyer.account_balance -= price
-            seller.account_balance += price
+        # Return success response
+        serializer = CardSerializer(card)
+        events.publish(
+            "card.sold", card=serializer.data, previous_owner=seller_id, price=price
+        )
+        return Response(
+            {
+                "message": f"Successfully purchased card '{card.name}' for {price} credits",
+                "card": serializer.data,
+                "new_balance": ledger.balance(request.user.pk),
+                "canceled_offers": canceled_offers,
+            },
+            status=status.HTTP_200_OK,
+        )
 
-            # Update card ownership
-            card.owner = buyer
-            # Set card as not for sale after purchase
-            card.price = -1
 
-            # Save all changes
-            buyer.save()
-            seller.save()
-            card.save()
+class CardMarketplaceView(APIView):
+    permission_classes = [IsAuthenticated]
+    # Setting prices; reads are never throttled
+    throttle_scope = "listing"
+    # Listing: authentication, generation, page and count. Setting a price:
+    # authentication, the locked read and update in their savepoint, the
+    # generation bumps and the change log entries, then the card's pending
+    # offers and, if there were any, their cancellation, bumps and entries
+    query_budget = {"get": 4, "post": 12}
+    replica_reads = ("get",)
 
-            # Return success response
-            serializer = CardSerializer(card)
-            return Response(
-                {
-                    "message": f"Successfully purchased card '{card.name}' for {price} credits",
-                    "card": serializer.data,
-                    "new_balance": buyer.account_balance,
-                },
-                status=status.HTTP_200_OK,
+    # Keyset orderings; the trailing id makes every position unique
+    SORT_ORDERINGS = {
+        "newest": ("-id",),
+        "price": ("price", "id"),
+        "-price": ("-price", "-id"),
+    }
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 200
+    APPROX_COUNT_CAP = 1000
+
+    def get(self, request, *args, **kwargs):
+        """
+        Get one page of the cards that are currently for sale
+
+        Query parameters:
+            name: case-insensitive substring of the card name
+            sort: one of "newest" (default), "price" or "-price"
+            min_price / max_price: inclusive price bounds
+            exclude_mine: hide the requesting user's own listings
+            limit: page size (default 50, at most 200)
+            cursor: the next_cursor value returned by the previous page
+            count: "exact" for a full count, "approx" for one capped at 1000
+        """
+        params = request.query_params
+        try:
+            cards_for_sale, ordering, limit, count_mode = self.listing_query(
+                params, request.user
             )
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        except Exception as e:
-            # Roll back transaction if anything fails
-            return Response(
-                {"error": f"Transaction failed: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        def build():
+            cards, next_cursor = paginate_keyset(
+                projections.cards(cards_for_sale),
+                ordering,
+                cursor=params.get("cursor"),
+                limit=limit,
             )
+            data = {"cards": cards, "next_cursor": next_cursor}
 
+            # Counting is a full scan of the matches, so only do it on request
+            if count_mode == "exact":
+                data["count"] = cards_for_sale.count()
+                data["count_exact"] = True
+            elif count_mode == "approx":
+                data["count"], data["count_exact"] = capped_count(
+                    cards_for_sale, self.APPROX_COUNT_CAP
+                )
+            return data
 
-class CardMarketplaceView(APIView):
-    permission_classes = [IsAuthenticated]
+        try:
+            # Every viewer asking for the same page shares one cache entry
+            return caching.cached_response(
+                request,
+                "marketplace",
+                [Generation.MARKETPLACE],
+                build,
+                query=str(cards_for_sale.query),
+                ordering=ordering,
+                limit=limit,
+                cursor=params.get("cursor"),
+                count=count_mode,
+                count_cap=self.APPROX_COUNT_CAP,
+            )
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-    def get(self, request, *args, **kwargs):
-        """Get all cards that are currently for sale"""
-        # Get all cards with price >= 0 (for sale)
-        cards_for_sale = Card.objects.filter(price__gte=0)
+    @classmethod
+    def listing_query(cls, params, user):
+        """
+        Build the marketplace query described by the GET parameters
+
+        Returns:
+            tuple: (queryset, ordering, page size, count mode)
+
+        Raises:
+            ValueError: With a message for the client if a parameter is invalid
+        """
+        sort = params.get("sort", "newest")
+        if sort not in cls.SORT_ORDERINGS:
+            raise ValueError(f"Sort must be one of: {', '.join(cls.SORT_ORDERINGS)}")
+
+        count_mode = params.get("count")
+        if count_mode not in (None, "exact", "approx"):
+            raise ValueError("Count must be either exact or approx")
+
+        try:
+            limit = int(params.get("limit", cls.DEFAULT_LIMIT))
+            min_price = params.get("min_price")
+            min_price = int(min_price) if min_price is not None else None
+            max_price = params.get("max_price")
+            max_price = int(max_price) if max_price is not None else None
+        except ValueError:
+            raise ValueError("limit, min_price and max_price must be valid integers")
+
+        if limit <= 0:
+            raise ValueError("Limit must be a positive number")
+        limit = min(limit, cls.MAX_LIMIT)
+
+        # Get all cards with price >= 0 (for sale). The condition is kept
+        # verbatim so the partial marketplace indexes stay usable.
+        cards_for_sale = Card.objects.select_related("owner").filter(price__gte=0)
+        if min_price is not None:
+            cards_for_sale = cards_for_sale.filter(price__gte=min_price)
+        if max_price is not None:
+            cards_for_sale = cards_for_sale.filter(price__lte=max_price)
 
         # Optionally filter by name if provided
-        name_filter = request.query_params.get("name")
+        name_filter = params.get("name")
         if name_filter:
-            cards_for_sale = cards_for_sale.filter(name__icontains=name_filter)
+            cards_for_sale = search.filter_by_name(cards_for_sale, name_filter)
 
-        # Serialize and return the data
-        serializer = CardSerializer(cards_for_sale, many=True)
-        return Response(
-            {"count": cards_for_sale.count(), "cards": serializer.data},
-            status=status.HTTP_200_OK,
-        )
+        if params.get("exclude_mine", "").lower() in ("1", "true", "yes"):
+            cards_for_sale = cards_for_sale.exclude(owner=user)
+
+        return cards_for_sale, cls.SORT_ORDERINGS[sort], limit, count_mode
 
     def post(self, request, *args, **kwargs):
         """Put a card up for sale or remove it from sale"""
@@ -259,42 +462,97 @@ class CardMarketplaceView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        try:
+            return self.set_price(request, card_id, price)
+        except ConcurrentUpdate:
+            return Response(
+                {"error": "The card changed while it was being listed, please try again"},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+    @retry_on_conflict
+    @batch_changes()
+    def set_price(self, request, card_id, price):
         # Check if card exists and user owns it
         try:
-            card = Card.objects.get(id=card_id)
+            card = Card.objects.select_for_update().get(id=card_id)
         except Card.DoesNotExist:
             return Response(
                 {"error": "Card not found"}, status=status.HTTP_404_NOT_FOUND
             )
 
         # Verify current user owns the card
-        if card.owner != request.user:
+        if card.owner_id != request.user.pk:
             return Response(
                 {"error": "You do not own this card"}, status=status.HTTP_403_FORBIDDEN
             )
 
-        # Update the card price
-        card.price = price
-        card.save()
+        # Update the card price; cards for sale can't be traded
+        card.update_versioned(price=price)
+        canceled_offers = len(TradeOffer.cancel_pending([card.pk])) if price >= 0 else 0
 
         # Return success response
         serializer = CardSerializer(card)
 
         if price == -1:
             message = f"Card '{card.name}' removed from marketplace"
+            events.publish("card.delisted", card=serializer.data)
         else:
             message = f"Card '{card.name}' is now for sale at {price} credits"
+            events.publish("card.listed", card=serializer.data)
 
         return Response(
-            {"message": message, "card": serializer.data}, status=status.HTTP_200_OK
+            {"message": message, "card": serializer.data, "canceled_offers": canceled_offers},
+            status=status.HTTP_200_OK,
         )
 
+class CardSearchView(APIView):
+    """
+    View for ranked search of marketplace cards by name
+    """
+    permission_classes = [IsAuthenticated]
+    query_budget = 3
+
+    MAX_LIMIT = 100
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get("q", "").strip()
+        fuzzy = request.query_params.get("fuzzy", "").lower() in ("1", "true", "yes")
+
+        if not query:
+            return Response(
+                {"error": "Query parameter q is required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            limit = min(int(request.query_params.get("limit", 20)), self.MAX_LIMIT)
+        except ValueError:
+            return Response(
+                {"error": "Limit must be a valid integer"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Rank first, then load the matching cards and restore the ranking
+        ids = search.search_cards(query, limit=max(limit, 1), fuzzy=fuzzy)
+        cards = Card.objects.select_related("owner").in_bulk(ids)
+        ranked = [cards[card_id] for card_id in ids if card_id in cards]
+
+        serializer = CardSerializer(ranked, many=True)
+        return Response({"cards": serializer.data}, status=status.HTTP_200_OK)
+
+
 class CardTradeViewSet(viewsets.ModelViewSet):
     """
     ViewSet for creating and managing trade offers
     """
     serializer_class = TradeOfferSerializer
     permission_classes = [IsAuthenticated]
+    throttle_scope = "trade"
+    concurrency_group = {"create": "trade"}
+    # Authentication, generation and offers
+    query_budget = {"list": 3, "retrieve": 2}
+    replica_reads = ("list",)
     
     def get_queryset(self):
         """
@@ -302,14 +560,24 @@ class CardTradeViewSet(viewsets.ModelViewSet):
         - All pending trade offers where the user is either sender or recipient
         - All completed trades (accepted/declined/canceled) from the last 30 days
         """
-        user = self.request.user
-        
-        # Get the 'status' query parameter if provided
-        status_filter = self.request.query_params.get('status')
-        
+        return self.visible_trades(
+            self.request.user, self.request.query_params.get('status')
+        )
+
+    @staticmethod
+    def visible_trades(user, status_filter=None, horizon=None):
+        """
+        Trade offers `user` sent or received, newest first: every pending
+        one, and the ones settled since `horizon` (TradeOffer.settled_horizon()
+        by default)
+        """
         # Base queryset - trades where user is sender or recipient
-        queryset = TradeOffer.objects.filter(
+        queryset = TradeOffer.objects.select_related(
+            "sender", "sender_card", "recipient_card"
+        ).filter(
             Q(sender=user) | Q(recipient=user)
+        ).filter(
+            Q(status='pending') | Q(updated_at__gte=horizon or TradeOffer.settled_horizon())
         )
         
         # Apply status filter if provided
@@ -318,18 +586,54 @@ class CardTradeViewSet(viewsets.ModelViewSet):
             
         return queryset.order_by('-created_at')
     
+    def list(self, request, *args, **kwargs):
+        # Settled offers leave the list at midnight, without a generation bump
+        horizon = TradeOffer.settled_horizon()
+
+        def build():
+            queryset = self.visible_trades(
+                request.user, request.query_params.get('status'), horizon
+            )
+            return [
+                projections.format_trade(row)
+                for row in projections.trades(queryset)
+            ]
+
+        return caching.cached_response(
+            request,
+            "trades",
+            [Generation.trades_key(request.user.pk)],
+            build,
+            user=request.user.pk,
+            status=request.query_params.get('status'),
+            horizon=horizon.isoformat(),
+        )
+
     def get_serializer_context(self):
         """Add request to serializer context"""
         context = super().get_serializer_context()
         context['request'] = self.request
         return context
 
+    def perform_create(self, serializer):
+        trade_offer = serializer.save()
+        events.publish(
+            "trade.created",
+            users=[trade_offer.sender_id, trade_offer.recipient_id],
+            trade=TradeOfferSerializer(trade_offer).data,
+        )
+        # The offer may complete a multi-party trade; that is looked for
+        # once it commits, without holding up the response
+        matching.offer_created(trade_offer)
+
 
 class TradeOfferActionView(APIView):
     """
     View for accepting, declining, or canceling a trade offer
     """
     permission_classes = [IsAuthenticated]
+    throttle_scope = "trade"
+    concurrency_group = "trade"
     
     def post(self, request, *args, **kwargs):
         # Get required parameters
@@ -349,61 +653,308 @@ class TradeOfferActionView(APIView):
                 {"error": "Action must be one of: accept, decline, cancel"},
                 status=status.HTTP_400_BAD_REQUEST
             )
-            
+
+        try:
+            return self.perform_action(request, trade_id, action)
+        except ConcurrentUpdate:
+            return Response(
+                {"error": "The trade changed while it was being processed, please try again"},
+                status=status.HTTP_409_CONFLICT
+            )
+
+    @retry_on_conflict
+    @batch_changes()
+    def perform_action(self, request, trade_id, action):
         # Get the trade offer
         try:
-            trade_offer = TradeOffer.objects.get(id=trade_id)
+            trade_offer = TradeOffer.objects.select_for_update().get(id=trade_id)
         except TradeOffer.DoesNotExist:
             return Response(
                 {"error": "Trade offer not found"},
                 status=status.HTTP_404_NOT_FOUND
             )
             
-        # Check permissions:
-        # - Only recipient can accept/decline
-        # - Only sender can cancel
-        user = request.user
-        
-        if action in ['accept', 'decline'] and trade_offer.recipient != user:
+        denied = self.permission_error(trade_offer, request.user, action)
+        if denied:
+            return Response({"error": denied}, status=status.HTTP_403_FORBIDDEN)
+            
+        # Perform the action; each one re-checks that the trade is still pending
+        was_pending = trade_offer.status == 'pending'
+        canceled_offers = 0
+        if action == 'accept':
+            success = trade_offer.accept()
+            canceled_offers = trade_offer.canceled_offers
+        elif action == 'decline':
+            success = trade_offer.decline()
+        else:
+            success = trade_offer.cancel()
+
+        if not success:
             return Response(
-                {"error": "Only the recipient can accept or decline a trade offer"},
-                status=status.HTTP_403_FORBIDDEN
+                {"error": self.failure_error(trade_offer, action, was_pending)},
+                status=status.HTTP_400_BAD_REQUEST
             )
             
-        if action == 'cancel' and trade_offer.sender != user:
+        # Return the updated trade offer
+        serializer = TradeOfferSerializer(trade_offer)
+        events.publish(
+            f"trade.{trade_offer.status}",
+            users=[trade_offer.sender_id, trade_offer.recipient_id],
+            trade=serializer.data,
+        )
+        
+        return Response({
+            "message": f"Trade {action}ed successfully",
+            "trade": serializer.data,
+            "canceled_offers": canceled_offers,
+        }, status=status.HTTP_200_OK)
+
+    @staticmethod
+    def permission_error(trade_offer, user, action):
+        """
+        Only the recipient can accept or decline, and only the sender can cancel
+
+        Returns:
+            str: Why `user` may not take `action`, or None if they may
+        """
+        if action in ['accept', 'decline'] and trade_offer.recipient_id != user.pk:
+            return "Only the recipient can accept or decline a trade offer"
+        if action == 'cancel' and trade_offer.sender_id != user.pk:
+            return "Only the sender can cancel a trade offer"
+        return None
+
+    @staticmethod
+    def failure_error(trade_offer, action, was_pending):
+        if action == 'accept' and was_pending:
+            return "Trade could not be completed. Cards may no longer be available."
+        return f"Cannot {action} a trade that is already {trade_offer.status}"
+
+
+class TradeOfferBatchActionView(APIView):
+    """
+    Accept, decline or cancel many trade offers in one request
+
+    The offers and their cards are read and locked in two queries, in id
+    order, in one transaction. Declines and cancellations are then one
+    UPDATE each, and accepts go through TradeOffer.accept_many() in a
+    savepoint, so a card changing hands under them fails the accepts alone.
+    Accepting an offer cancels the other offers for its cards, including
+    ones later in the batch.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_scope = "trade"
+    concurrency_group = "trade"
+    MAX_ACTIONS = 500
+    NEW_STATUS = {"decline": "declined", "cancel": "canceled"}
+
+    def post(self, request, *args, **kwargs):
+        """
+        Body:
+            actions: a list of {"trade_id": id, "action": "accept", "decline"
+                or "cancel"}, at most 500
+
+        Returns one result per action, in the same order, each with the
+        trade_id, action, ok and either the offer's new status or an error.
+        """
+        actions = request.data.get("actions")
+        if not isinstance(actions, list) or not actions:
             return Response(
-                {"error": "Only the sender can cancel a trade offer"},
-                status=status.HTTP_403_FORBIDDEN
+                {"error": "actions must be a non-empty list"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-            
-        # Check if trade is still pending
-        if trade_offer.status != 'pending':
+        if len(actions) > self.MAX_ACTIONS:
             return Response(
-                {"error": f"Cannot {action} a trade that is already {trade_offer.status}"},
-                status=status.HTTP_400_BAD_REQUEST
+                {"error": f"At most {self.MAX_ACTIONS} actions per request"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-            
-        # Perform the action
-        with transaction.atomic():
-            if action == 'accept':
-                success = trade_offer.accept()
-                if not success:
-                    return Response(
-                        {"error": "Trade could not be completed. Cards may no longer be available."},
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-            elif action == 'decline':
-                trade_offer.decline()
-            elif action == 'cancel':
-                trade_offer.cancel()
-                
-            # Return the updated trade offer
-            serializer = TradeOfferSerializer(trade_offer)
-            
-            return Response({
-                "message": f"Trade {action}ed successfully",
-                "trade": serializer.data
-            }, status=status.HTTP_200_OK)
+
+        items = []
+        for item in actions:
+            if not isinstance(item, dict):
+                return Response(
+                    {"error": "Every action must be an object"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            trade_id, action = item.get("trade_id"), item.get("action")
+            if not isinstance(trade_id, int) or isinstance(trade_id, bool):
+                return Response(
+                    {"error": "Every action needs an integer trade_id"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            if action not in ("accept", "decline", "cancel"):
+                return Response(
+                    {"error": "Action must be one of: accept, decline, cancel"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            items.append((trade_id, action))
+
+        try:
+            results = self.perform_actions(request, items)
+        except ConcurrentUpdate:
+            return Response(
+                {"error": "The trades changed while they were being processed, please try again"},
+                status=status.HTTP_409_CONFLICT,
+            )
+        return Response({"results": results}, status=status.HTTP_200_OK)
+
+    @retry_on_conflict
+    @batch_changes()
+    def perform_actions(self, request, items):
+        # Only the offers are locked here, their cards after, in id order too
+        offers = TradeOffer.objects.select_for_update(of=("self",)).select_related(
+            "sender", "sender_card", "recipient_card"
+        ).filter(pk__in={trade_id for trade_id, _ in items}).order_by("pk").in_bulk()
+        # Request index -> result, so repeated items keep results of their own
+        results = {}
+        seen = set()
+        todo = {"accept": [], "decline": [], "cancel": []}
+        for index, (trade_id, action) in enumerate(items):
+            offer = offers.get(trade_id)
+            if trade_id in seen:
+                error = "The trade appears more than once in this batch"
+            elif offer is None:
+                error = "Trade offer not found"
+            else:
+                error = TradeOfferActionView.permission_error(offer, request.user, action)
+            seen.add(trade_id)
+            if error:
+                results[index] = {"ok": False, "error": error}
+            else:
+                todo[action].append((index, offer))
+
+        accepted = todo["accept"]
+        cards = (
+            TradeOffer._lock_cards([offer for _, offer in accepted]) if accepted else {}
+        )
+
+        for action, new_status in self.NEW_STATUS.items():
+            moved = {
+                offer.pk
+                for offer in TradeOffer.transition_many(
+                    [offer for _, offer in todo[action]], new_status
+                )
+            }
+            for index, offer in todo[action]:
+                results[index] = (
+                    {"ok": True, "status": new_status}
+                    if offer.pk in moved
+                    else {"ok": False, "error": TradeOfferActionView.failure_error(
+                        offer, action, was_pending=False
+                    )}
+                )
+
+        was_pending = {offer.pk: offer.status == 'pending' for _, offer in accepted}
+        succeeded = set()
+        if accepted:
+            try:
+                with transaction.atomic(), batch_changes():
+                    succeeded = {
+                        offer.pk
+                        for offer in TradeOffer.accept_many(
+                            [offer for _, offer in accepted], cards
+                        )
+                    }
+            except ConcurrentUpdate:
+                # Rolled back to the savepoint
+                for _, offer in accepted:
+                    offer.refresh_from_db(fields=["status", "updated_at"])
+        for index, offer in accepted:
+            if offer.pk in succeeded:
+                results[index] = {
+                    "ok": True,
+                    "status": offer.status,
+                    "canceled_offers": offer.canceled_offers,
+                }
+            else:
+                results[index] = {
+                    "ok": False,
+                    "error": TradeOfferActionView.failure_error(
+                        offer, "accept", was_pending[offer.pk]
+                    ),
+                }
+
+        response = []
+        for index, (trade_id, action) in enumerate(items):
+            result = results[index]
+            if result["ok"]:
+                offer = offers[trade_id]
+                events.publish(
+                    f"trade.{offer.status}",
+                    users=[offer.sender_id, offer.recipient_id],
+                    trade=TradeOfferSerializer(offer).data,
+                )
+            response.append({"trade_id": trade_id, "action": action, **result})
+        return response
+
+
+class TradeHistoryView(APIView):
+    """
+    The user's trade offers settled before the trade list's window, newest
+    first, whether archive_trades has moved them to the archive yet or not
+    """
+    permission_classes = [IsAuthenticated]
+    # Authentication, then a page from each table
+    query_budget = 3
+    DEFAULT_LIMIT = 50
+    MAX_LIMIT = 200
+
+    def get(self, request, *args, **kwargs):
+        """
+        Query parameters:
+            status: only offers that ended accepted, declined or canceled
+            limit: page size (default 50, at most 200)
+            cursor: the next_cursor value returned by the previous page
+        """
+        params = request.query_params
+        try:
+            limit = min(int(params.get("limit", self.DEFAULT_LIMIT)), self.MAX_LIMIT)
+        except ValueError:
+            return Response(
+                {"error": "Limit must be a valid integer"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if limit <= 0:
+            return Response(
+                {"error": "Limit must be a positive number"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        mine = Q(sender=request.user) | Q(recipient=request.user)
+        unarchived = TradeOffer.objects.filter(
+            mine,
+            status__in=TradeOffer.SETTLED,
+            updated_at__lt=TradeOffer.settled_horizon(),
+        )
+        archived = ArchivedTradeOffer.objects.filter(mine)
+        if params.get("status"):
+            unarchived = unarchived.filter(status=params["status"])
+            archived = archived.filter(status=params["status"])
+
+        # Ids are shared between the tables, so a page of each by id merges
+        rows, more = [], False
+        try:
+            for queryset in (
+                projections.trades(unarchived),
+                projections.archived_trades(archived),
+            ):
+                page, next_cursor = paginate_keyset(
+                    queryset, ("-id",), cursor=params.get("cursor"), limit=limit
+                )
+                rows += page
+                more = more or next_cursor is not None
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows.sort(key=lambda row: row["id"], reverse=True)
+        more = more or len(rows) > limit
+        rows = rows[:limit]
+        return Response(
+            {
+                "trades": [projections.format_trade(row) for row in rows],
+                "next_cursor": encode_cursor([rows[-1]["id"]]) if more else None,
+            },
+            status=status.HTTP_200_OK,
+        )
 
 
 class GetUserCardsView(APIView):
@@ -411,6 +962,9 @@ class GetUserCardsView(APIView):
     View for getting cards of a specific user by username
     """
     permission_classes = [IsAuthenticated]
+    # Authentication, user, generation and cards
+    query_budget = 4
+    replica_reads = True
     
     def get(self, request, *args, **kwargs):
         username = request.query_params.get('username')
@@ -423,15 +977,267 @@ class GetUserCardsView(APIView):
             
         try:
             user = CustomUser.objects.get(username=username)
-            
-            # Get cards not for sale (price < 0)
-            cards = Card.objects.filter(owner=user, price__lt=0)
-            
-            serializer = CardSerializer(cards, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
-            
         except CustomUser.DoesNotExist:
             return Response(
                 {"error": f"User '{username}' not found"},
                 status=status.HTTP_404_NOT_FOUND
-            )
\ No newline at end of file
+            )
+
+        def build():
+            # Get cards not for sale (price < 0)
+            return list(projections.cards(Card.objects.filter(owner=user, price__lt=0)))
+
+        return caching.cached_response(
+            request, "by-user", [Generation.owner_key(user.pk)], build, owner=user.pk
+        )
+
+
+class ChangesView(APIView):
+    """
+    Delta sync: what changed in the user's cards and trades since a cursor
+    """
+    permission_classes = [IsAuthenticated]
+    # Authentication, horizon, entries, cards and trades
+    query_budget = 5
+    MAX_LIMIT = 500
+
+    def get(self, request, *args, **kwargs):
+        """
+        Query parameters:
+            since: the cursor returned by the previous call. Without it only
+                the current cursor is returned, to sync from after a full fetch
+            limit: the most log entries to fold into one response (max 500)
+        """
+        since = request.query_params.get("since")
+        if since is None:
+            return Response(
+                {"cursor": changelog.current_cursor()}, status=status.HTTP_200_OK
+            )
+
+        try:
+            since = int(since)
+            limit = min(int(request.query_params.get("limit", self.MAX_LIMIT)), self.MAX_LIMIT)
+        except ValueError:
+            return Response(
+                {"error": "since and limit must be valid integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if limit <= 0:
+            return Response(
+                {"error": "Limit must be a positive number"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            changes = changelog.changes_since(request.user, since, limit)
+        except changelog.CursorExpired as e:
+            # The client has to refetch everything and start from a new cursor
+            return Response({"error": str(e)}, status=status.HTTP_410_GONE)
+
+        changes["cards"] = CardSerializer(changes["cards"], many=True).data
+        changes["trades"] = TradeOfferSerializer(changes["trades"], many=True).data
+        return Response(changes, status=status.HTTP_200_OK)
+
+
+class CacheStatsView(APIView):
+    """Hit, miss and eviction counts of this process's collection cache"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(caching.get_cache().get_stats(), status=status.HTTP_200_OK)
+
+
+class MetricsView(View):
+    """
+    Request and business metrics in the Prometheus text format, summed over
+    every worker when METRICS['MULTIPROCESS_DIR'] is set (see apis/metrics.py)
+
+    Only for scrapers sending METRICS['TOKEN'] as a bearer token, and for
+    staff, signed in or with an access token.
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not self.allowed(request):
+            return JsonResponse(
+                {"error": "Metrics need the metrics token or a staff account"},
+                status=403,
+            )
+        return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    def allowed(self, request):
+        token = metrics.metrics_settings()["TOKEN"]
+        if token and hmac.compare_digest(
+            request.headers.get("Authorization", ""), f"Bearer {token}"
+        ):
+            return True
+        user = getattr(request, "user", None)
+        if user is None or not user.is_authenticated:
+            user = user_from_token(raw_token(request))
+        return bool(user and user.is_staff)
+
+
+class AsyncReadView(View):
+    """
+    Base class for the async endpoints, which must be served under ASGI
+
+    These are plain Django views rather than DRF ones, since DRF views cannot
+    be async. They accept the same JWT access tokens and set request.user
+    before the handler runs.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        user = await sync_to_async(user_from_token)(raw_token(request))
+        if user is None:
+            return JsonResponse(
+                {"error": "A valid access token is required"}, status=401
+            )
+        request.user = user
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncCardMarketplaceView(AsyncReadView):
+    """Async version of GET cards/marketplace/, with the same parameters"""
+    query_budget = CardMarketplaceView.query_budget["get"]
+    replica_reads = True
+
+    async def get(self, request, *args, **kwargs):
+        params = request.GET
+        try:
+            # The name filter may need to look up the search index once
+            cards_for_sale, ordering, limit, count_mode = await sync_to_async(
+                CardMarketplaceView.listing_query
+            )(params, request.user)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+        async def build():
+            cards, next_cursor = await apaginate_keyset(
+                projections.cards(cards_for_sale),
+                ordering,
+                cursor=params.get("cursor"),
+                limit=limit,
+            )
+            data = {"cards": cards, "next_cursor": next_cursor}
+
+            if count_mode == "exact":
+                data["count"] = await cards_for_sale.acount()
+                data["count_exact"] = True
+            elif count_mode == "approx":
+                data["count"], data["count_exact"] = await acapped_count(
+                    cards_for_sale, CardMarketplaceView.APPROX_COUNT_CAP
+                )
+            return data
+
+        try:
+            # Shares its entries with the sync view
+            return await caching.acached_response(
+                request,
+                "marketplace",
+                [Generation.MARKETPLACE],
+                build,
+                query=str(cards_for_sale.query),
+                ordering=ordering,
+                limit=limit,
+                cursor=params.get("cursor"),
+                count=count_mode,
+                count_cap=CardMarketplaceView.APPROX_COUNT_CAP,
+            )
+        except InvalidCursor as e:
+            return JsonResponse({"error": str(e)}, status=400)
+
+
+class AsyncGetUserCardsView(AsyncReadView):
+    """Async version of GET cards/by-user/"""
+    query_budget = GetUserCardsView.query_budget
+    replica_reads = True
+
+    async def get(self, request, *args, **kwargs):
+        username = request.GET.get("username")
+        if not username:
+            return JsonResponse({"error": "Username parameter is required"}, status=400)
+
+        try:
+            user = await CustomUser.objects.aget(username=username)
+        except CustomUser.DoesNotExist:
+            return JsonResponse({"error": f"User '{username}' not found"}, status=404)
+
+        async def build():
+            queryset = projections.cards(Card.objects.filter(owner=user, price__lt=0))
+            return [card async for card in queryset.aiterator()]
+
+        return await caching.acached_response(
+            request, "by-user", [Generation.owner_key(user.pk)], build, owner=user.pk
+        )
+
+
+class AsyncTradeListView(AsyncReadView):
+    """Async version of GET trades/"""
+    query_budget = CardTradeViewSet.query_budget["list"]
+    replica_reads = True
+
+    async def get(self, request, *args, **kwargs):
+        horizon = TradeOffer.settled_horizon()
+        queryset = CardTradeViewSet.visible_trades(
+            request.user, request.GET.get("status"), horizon
+        )
+
+        async def build():
+            return [
+                projections.format_trade(row)
+                async for row in projections.trades(queryset).aiterator()
+            ]
+
+        return await caching.acached_response(
+            request,
+            "trades",
+            [Generation.trades_key(request.user.pk)],
+            build,
+            user=request.user.pk,
+            status=request.GET.get("status"),
+            horizon=horizon.isoformat(),
+        )
+
+
+class EventStreamView(AsyncReadView):
+    """
+    Server-sent events stream of card and trade changes
+
+    Clients apply these to their local state instead of refetching whole
+    lists. EventSource cannot send headers, so the access token may be given
+    as ?token=. The stream holds its connection open, so it must be served
+    by an ASGI server (see backend/asgi.py).
+    """
+    KEEPALIVE_SECONDS = 15
+
+    async def get(self, request, *args, **kwargs):
+        response = StreamingHttpResponse(
+            self.stream(request.user.pk), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        # Stop reverse proxies from buffering the stream
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    async def stream(self, user_id):
+        subscription = events.get_broker().subscribe()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        subscription.get(), self.KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                if subscription.overflowed:
+                    # We fell behind and lost events; the client must refetch
+                    subscription.overflowed = False
+                    yield "event: resync\ndata: {}\n\n"
+
+                if events.visible_to(event, user_id):
+                    data = json.dumps({key: value for key, value in event.items() if key != "users"})
+                    yield f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+        finally:
+            subscription.close()
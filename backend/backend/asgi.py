@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_asgi_application()
+
+# Load the trade matching graph now rather than on the first offer
+from apis import matching  # noqa: E402
+
+matching.start()
@@ -44,19 +44,33 @@ INSTALLED_APPS = [
 ]
 
 REST_FRAMEWORK = {
+    # Renders with orjson when it is installed (see apis/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': [
+        'apis.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # Caches users between requests (see apis/authentication.py)
+        'apis.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
         'rest_framework.permissions.IsAuthenticatedOrReadOnly'
     ],
+    # Per-user rates of the views' throttle_scope, from THROTTLING below
+    'DEFAULT_THROTTLE_CLASSES': [
+        'apis.throttling.TokenBucketThrottle',
+    ],
 }
 
 MIDDLEWARE = [
+    'apis.metrics.MetricsMiddleware',
+    'apis.instrumentation.QueryInstrumentationMiddleware',
+    'apis.throttling.AdaptiveConcurrencyMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'apis.routing.ReplicaRoutingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -67,6 +81,80 @@ MIDDLEWARE = [
 
 CORS_ALLOW_ALL_ORIGINS = True
 
+# Query instrumentation (see apis/instrumentation.py)
+QUERY_INSTRUMENTATION_HEADERS = DEBUG
+# Raise instead of logging when a view goes over its query_budget;
+# QueryBudgetTests turn it on
+QUERY_BUDGET_STRICT = False
+N_PLUS_ONE_THRESHOLD = 3
+CORS_EXPOSE_HEADERS = ['X-DB-Query-Count', 'X-DB-Time-Ms', 'X-DB-N-Plus-One']
+
+# Spread incoming credits over this many counters per user (see apis/ledger.py);
+# 0 credits account_balance directly
+LEDGER_BALANCE_SHARDS = 0
+
+# Users resolved from access tokens (see apis/authentication.py)
+AUTH_USER_CACHE = {
+    'TIMEOUT': 30,
+    'MAX_ENTRIES': 10_000,
+}
+
+# Settled trade offers stay in the trade list for this many days, then move to
+# trades/history/ (and to the archive table, with archive_trades)
+TRADE_HISTORY_DAYS = 30
+
+# Multi-party trades found among pending offers (see apis/matching.py)
+TRADE_MATCHING = {
+    'MAX_CYCLE_LENGTH': 4,
+    'MAX_VISITS': 20_000,
+    'ON_CREATE': True,
+    # Match new offers in a thread of each worker process, off the request path
+    'BACKGROUND': True,
+}
+
+# Fans card and trade events out to the event stream (see apis/events.py)
+EVENT_BROKER = 'apis.events.InProcessBroker'
+
+# Cache of rendered marketplace and collection pages (see apis/caching.py)
+COLLECTION_CACHE = {
+    'MAX_BYTES': 32 * 1024 * 1024,
+    'SHARED_ALIAS': None,
+    'TIMEOUT': 300,
+}
+
+# Token buckets for writes, per user and view throttle_scope: "N/period", or
+# ("N/period", burst) (see apis/throttling.py)
+THROTTLING = {
+    'ENABLED': True,
+    'RATES': {
+        'purchase': ('5/s', 10),
+        'listing': ('5/s', 20),
+        'transfer': ('5/s', 20),
+        'trade': ('10/s', 30),
+    },
+    'MAX_BUCKETS': 100_000,
+}
+
+# Requests in flight per route group, adapting to latency; the rest get a 503
+CONCURRENCY_LIMITS = {
+    'ENABLED': True,
+    'GROUPS': {
+        'read': {'INITIAL': 64, 'MAX': 512},
+        'write': {'INITIAL': 16, 'MAX': 64},
+        'purchase': {'INITIAL': 8, 'MAX': 32},
+        'trade': {'INITIAL': 8, 'MAX': 32},
+    },
+}
+
+# Prometheus metrics at /api/metrics/ (see apis/metrics.py). Give every worker
+# process the same MULTIPROCESS_DIR to serve their combined numbers.
+METRICS = {
+    'ENABLED': True,
+    'MULTIPROCESS_DIR': None,
+    'FLUSH_INTERVAL': 5,
+    'TOKEN': None,
+}
+
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -95,9 +183,35 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Reuse connections across requests instead of reopening the file
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        # A file rather than shared-cache memory, so the concurrency tests
+        # see SQLite's real locking behaviour
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# Reads of the views that allow it go to these replicas (see apis/routing.py).
+# A local SQLite replica, refreshed with `manage.py sync_replicas`:
+#
+# DATABASES['replica'] = {
+#     'ENGINE': 'django.db.backends.sqlite3',
+#     'NAME': BASE_DIR / 'replica.sqlite3',
+#     'CONN_MAX_AGE': 600,
+#     'TEST': {'MIRROR': 'default'},
+# }
+DATABASE_ROUTERS = ['apis.routing.ReplicaRouter']
+READ_REPLICAS = {
+    'ALIASES': [],
+    'STICKY_SECONDS': 5,
+    'CACHE_ALIAS': 'default',
+}
+
+# PRAGMAs and transaction mode for SQLite connections, "tuned" or "default"
+# (see apis/storage.py)
+SQLITE_PROFILE = 'tuned'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -1,10 +1,11 @@
 "use client";
 
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import { useAuth } from "@/contexts/AuthContext";
 import { useToast } from "@/contexts/ToastContext";
 import Card, { CardType } from "@/components/Card";
 import { getMarketplaceCards, purchaseCard } from "@/utils/cards-api";
+import { subscribeToChanges } from "@/utils/events";
 import { Input } from "@/components/ui/input";
 import { Button } from "@/components/ui/button";
 import { Search, RefreshCw } from "lucide-react";
@@ -12,6 +13,12 @@ import { Search, RefreshCw } from "lucide-react";
 export default function Marketplace() {
   const [cards, setCards] = useState<CardType[]>([]);
   const [isLoading, setIsLoading] = useState(true);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
+  // The filter the shown pages were fetched with, for fetching more of them
+  const [activeFilter, setActiveFilter] = useState<string | undefined>();
+  // The same, for the change stream's handlers, which outlive renders
+  const activeFilterRef = useRef<string | undefined>();
   const [searchTerm, setSearchTerm] = useState("");
   const [userBalance, setUserBalance] = useState<number | null>(null);
   const { user } = useAuth();
@@ -20,8 +27,11 @@ export default function Marketplace() {
   const fetchMarketplaceCards = async (nameFilter?: string) => {
     setIsLoading(true);
     try {
-      const marketplaceCards = await getMarketplaceCards(nameFilter);
-      setCards(marketplaceCards);
+      const page = await getMarketplaceCards(nameFilter);
+      setCards(page.cards);
+      setNextCursor(page.next_cursor);
+      setActiveFilter(nameFilter);
+      activeFilterRef.current = nameFilter;
     } catch (error) {
       console.error("Failed to fetch marketplace cards:", error);
       addToast({
@@ -34,10 +44,52 @@ export default function Marketplace() {
     }
   };
 
+  const loadMoreCards = async () => {
+    if (!nextCursor) return;
+    setIsLoadingMore(true);
+    try {
+      const page = await getMarketplaceCards(activeFilter, nextCursor);
+      setCards(prevCards => [...prevCards, ...page.cards]);
+      setNextCursor(page.next_cursor);
+    } catch (error) {
+      console.error("Failed to fetch more marketplace cards:", error);
+      addToast({
+        title: "Error",
+        description: "Failed to load more cards. Please try again.",
+        variant: "destructive",
+      });
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
   useEffect(() => {
     fetchMarketplaceCards();
   }, []);
 
+  // Keep the listings current as cards are listed, delisted and sold
+  useEffect(() => {
+    return subscribeToChanges(
+      (event) => {
+        if (!event.card) return;
+        const card = event.card;
+        if (event.type === "card.listed") {
+          const filter = activeFilterRef.current?.toLowerCase();
+          if (filter && !card.name.toLowerCase().includes(filter)) return;
+          setCards(prevCards =>
+            prevCards.some(c => c.id === card.id)
+              ? prevCards.map(c => c.id === card.id ? card : c)
+              : [card, ...prevCards]
+          );
+        } else {
+          // Delisted, sold or transferred: no longer for sale
+          setCards(prevCards => prevCards.filter(c => c.id !== card.id));
+        }
+      },
+      () => fetchMarketplaceCards(activeFilterRef.current)
+    );
+  }, []);
+
   const handleSearch = (e: React.FormEvent) => {
     e.preventDefault();
     fetchMarketplaceCards(searchTerm);
@@ -133,6 +185,19 @@ export default function Marketplace() {
           ))}
         </div>
       )}
+
+      {!isLoading && nextCursor && (
+        <div className="flex justify-center">
+          <Button
+            type="button"
+            variant="outline"
+            onClick={loadMoreCards}
+            disabled={isLoadingMore}
+          >
+            {isLoadingMore ? "Loading..." : "Load more"}
+          </Button>
+        </div>
+      )}
     </div>
   );
 }
\ No newline at end of file
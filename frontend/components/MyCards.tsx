@@ -5,6 +5,7 @@ import { useAuth } from "@/contexts/AuthContext";
 import { useToast } from "@/contexts/ToastContext";
 import Card, { CardType } from "@/components/Card";
 import { getUserCards, listCardForSale, removeCardFromSale } from "@/utils/cards-api";
+import { subscribeToChanges } from "@/utils/events";
 import ListCardDialog from "@/components/ListCardDialog";
 import { Button } from "@/components/ui/button";
 import { Tabs, TabsContent, TabsList, TabsTrigger } from "@/components/ui/tabs";
@@ -38,6 +39,27 @@ export default function MyCards() {
     fetchUserCards();
   }, []);
 
+  // Keep the collection current as cards are sold, traded or relisted
+  useEffect(() => {
+    if (!user) return;
+    return subscribeToChanges(
+      (event) => {
+        if (!event.card) return;
+        const card = event.card;
+        if (card.owner_username === user.username) {
+          setCards(prevCards =>
+            prevCards.some(c => c.id === card.id)
+              ? prevCards.map(c => c.id === card.id ? card : c)
+              : [...prevCards, card]
+          );
+        } else {
+          setCards(prevCards => prevCards.filter(c => c.id !== card.id));
+        }
+      },
+      fetchUserCards
+    );
+  }, [user?.username]);
+
   const handleListForSale = (card: CardType) => {
     setSelectedCardForListing(card);
   };
@@ -4,6 +4,7 @@ import { useState, useEffect } from "react";
 import { useAuth } from "@/contexts/AuthContext";
 import { useToast } from "@/contexts/ToastContext";
 import { getUserTradeOffers, tradeOfferAction, TradeOfferType } from "@/utils/cards-api";
+import { subscribeToChanges } from "@/utils/events";
 import { Button } from "@/components/ui/button";
 import { Tabs, TabsContent, TabsList, TabsTrigger } from "@/components/ui/tabs";
 import { Loader2, CheckCircle2, XCircle, RefreshCw, Clock8 } from "lucide-react";
@@ -35,6 +36,22 @@ export default function TradeOffers() {
     fetchTradeOffers();
   }, []);
 
+  // Show offers as they are made, accepted, declined or canceled
+  useEffect(() => {
+    return subscribeToChanges(
+      (event) => {
+        if (!event.trade) return;
+        const trade = event.trade;
+        setTradeOffers(prevOffers =>
+          prevOffers.some(offer => offer.id === trade.id)
+            ? prevOffers.map(offer => offer.id === trade.id ? trade : offer)
+            : [trade, ...prevOffers]
+        );
+      },
+      fetchTradeOffers
+    );
+  }, []);
+
   const handleTradeAction = async (tradeId: number, action: 'accept' | 'decline' | 'cancel') => {
     try {
       const result = await tradeOfferAction(tradeId, action);
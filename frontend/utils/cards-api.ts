@@ -61,14 +61,31 @@ export const getTradableCardsByUsername = async (username: string): Promise<Card
   }
 };
 
-// Get marketplace listings
-export const getMarketplaceCards = async (nameFilter?: string): Promise<CardType[]> => {
+// A page of marketplace listings
+export interface MarketplacePage {
+  cards: CardType[];
+  // Pass back as `cursor` to get the next page, null on the last one
+  next_cursor: string | null;
+}
+
+// Get marketplace listings, a page at a time
+export const getMarketplaceCards = async (
+  nameFilter?: string,
+  cursor?: string | null
+): Promise<MarketplacePage> => {
   try {
-    const url = nameFilter 
-      ? `/api/cards/marketplace/?name=${encodeURIComponent(nameFilter)}` 
-      : "/api/cards/marketplace/";
-    const response = await api.get(url);
-    return response.data.cards;
+    const params = new URLSearchParams();
+    if (nameFilter) {
+      params.set("name", nameFilter);
+    }
+    if (cursor) {
+      params.set("cursor", cursor);
+    }
+    const query = params.toString();
+    const response = await api.get(
+      query ? `/api/cards/marketplace/?${query}` : "/api/cards/marketplace/"
+    );
+    return response.data;
   } catch (error) {
     console.error("Error fetching marketplace cards:", error);
     throw error;
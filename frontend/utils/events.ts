@@ -0,0 +1,44 @@
+import Cookies from "js-cookie";
+import { CardType } from "@/components/Card";
+import { TradeOfferType } from "@/utils/cards-api";
+
+export type ChangeEvent = {
+	id: number;
+	type: string;
+	card?: CardType;
+	trade?: TradeOfferType;
+	previous_owner?: number;
+};
+
+const EVENT_TYPES = [
+	"card.listed",
+	"card.delisted",
+	"card.sold",
+	"card.transferred",
+	"trade.created",
+	"trade.accepted",
+	"trade.declined",
+	"trade.canceled",
+];
+
+// Subscribe to card and trade changes. `onResync` is called when events were
+// missed and the caller should refetch. Returns a function that closes the stream.
+export function subscribeToChanges(
+	onEvent: (event: ChangeEvent) => void,
+	onResync: () => void
+): () => void {
+	// EventSource cannot set headers, so the token goes in the query string
+	const token = Cookies.get("access_token") ?? "";
+	const source = new EventSource(
+		`http://localhost:8000/api/events/?token=${encodeURIComponent(token)}`
+	);
+
+	for (const type of EVENT_TYPES) {
+		source.addEventListener(type, (message) => {
+			onEvent(JSON.parse((message as MessageEvent).data));
+		});
+	}
+	source.addEventListener("resync", onResync);
+
+	return () => source.close();
+}